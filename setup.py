@@ -6,7 +6,8 @@ setup(
     author='B.A. van den Berg',
     author_email='b.a.vandenberg@gmail.com',
     packages=['spice', 'spice.plotpy', 'spice.job_runner'],
-    scripts=['bin/featext', 'bin/classification', 'bin/classify', 'bin/job_runner'],
+    scripts=['bin/featext', 'bin/classification', 'bin/classify', 'bin/job_runner',
+             'bin/model_server'],
     url='http://pypi.python.org/pypi/SPiCE/',
     license='LICENSE.txt',
     description='Sequence-based Protein Classification and Exploration',
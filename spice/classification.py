@@ -1,8 +1,18 @@
 import os
 import sys
+import time
 import operator
+import traceback
+import multiprocessing
+import Queue
+import StringIO
+import hashlib
+import tempfile
+import cPickle
 
 import numpy
+from scipy import sparse
+from scipy import optimize
 
 # HACK TODO remove if sklearn is updated to 0.14 on compute servers...
 import sklearn
@@ -19,11 +29,13 @@ from sklearn import naive_bayes
 from sklearn import tree
 from sklearn import ensemble
 from sklearn.grid_search import GridSearchCV
+from sklearn.grid_search import ParameterGrid
 from sklearn import preprocessing
 from sklearn import cross_validation
 from sklearn import metrics
 
 from biopy import roc
+from spice import predictor
 
 
 # classification performance measures
@@ -47,6 +59,13 @@ metric_rand_max_score = {
     'f1': (0.0, 1.0)
 }
 
+# classifiers that can be trained on sparse data, other classifiers obtain a
+# dense copy of sparse data sets
+sparse_classifier_types = (svm.LinearSVC, svm.SVC,
+                           neighbors.KNeighborsClassifier,
+                           neighbors.RadiusNeighborsClassifier,
+                           naive_bayes.MultinomialNB, naive_bayes.BernoulliNB)
+
 # default classifier parameters
 svm_default_param = {'class_weight': 'auto'}
 libsvm_default_param = {'class_weight': 'auto', 'probability': True,
@@ -71,6 +90,48 @@ default_param_range = {
     'gamma': 10.0 ** numpy.arange(-1, 2)
 }
 
+# number of data rows on which an exported predictor is validated
+EXPORT_VALIDATION_ROWS = 1000
+
+# maximum number of squared distance matrix entries up to which the
+# candidate feature subsets of distance based classifiers (rbf svc, nearest
+# neighbors) are scored on a cached distance matrix in feature selection: the
+# shared matrix of the base features plus two matrices per worker (the
+# updated distances and the kernel or neighbors derived from them)
+DISTANCE_CACHE_MAX_ENTRIES = 5 * 10 ** 7
+
+# number of objects up to which the kernel matrix of the linear and rbf svc
+# is computed once in cv_score, and shared by all folds and grid points
+KERNEL_CACHE_MAX_OBJECTS = 5000
+
+# successive halving parameter search: fraction of the configurations that
+# is promoted to the next rung, which uses halving_factor times more objects
+halving_factor = 3
+
+# largest C value that is fitted on the warm-started path (see
+# path_grid_search), for larger C values liblinear stops at its iteration
+# limit far from the optimum that the path finds
+PATH_MAX_C = 1.0
+
+# runtime estimates: number of objects on which the fit time is benchmarked,
+# and the minimal time (seconds) over which a benchmark fit is repeated
+BENCHMARK_OBJECTS = 400
+BENCHMARK_MIN_TIME = 0.05
+
+# persistent cache of grid search and CV results (see set_result_cache), and
+# its default maximal size in bytes
+result_cache = None
+RESULT_CACHE_SIZE = 1024 ** 3
+
+# version of the cached results, part of each cache key together with the
+# sklearn version, increase it if the cached results change
+RESULT_CACHE_VERSION = 1
+
+# a full cache is reduced to this fraction of its maximal size, and
+# temporary files of interrupted writes are removed after this many seconds
+RESULT_CACHE_LOW_WATER = 0.9
+RESULT_CACHE_TMP_AGE = 3600
+
 # timed parameters
 # timed_param = ['C', 'radius', 'n_neighbors']
 
@@ -81,17 +142,30 @@ default_param_range = {
 
 def cv_scores_no_scaling(data, target, classifier, n, scoring, cv=None):
 
+    # consult the result cache
+    key = None
+    if(result_cache is not None):
+        key = cache_key('cv_scores', data, target, classifier, n, scoring, cv)
+        scores = result_cache.get(key)
+        if(scores is not None):
+            return scores
+
     # if no cv sets provided, split data in train and test sets
     if(cv is None):
         cv = cross_validation.StratifiedKFold(target, n)
 
     # return cross-validation scores
-    return cross_validation.cross_val_score(classifier, data, target, cv=cv,
-                                            scoring=scoring)
+    scores = cross_validation.cross_val_score(classifier, data, target, cv=cv,
+                                              scoring=scoring)
+
+    if(key):
+        result_cache.put(key, scores)
+
+    return scores
 
 
 def grid_search(data, target, classifier, n, scoring, param, cv=None, cpu=1,
-                log_f=None):
+                log_f=None, halving=False, timeout=None, path=False):
     '''
     This method does a CV grid search to find the best classifier parameters
     for the given data. The method returns the average CV-performance of the
@@ -107,26 +181,574 @@ def grid_search(data, target, classifier, n, scoring, param, cv=None, cpu=1,
     scoring:    scoring function to use as classifier performance measure
     cpu:        number of cpu's to use (didn't work for me thus far)
     log_f:      (open) file to log data to
+    halving:    use successive halving instead of the full grid search
+    timeout:    wall-clock budget in seconds of the successive halving
+    path:       fit the C values as warm-started path, if supported (see
+                path_grid_search)
+
+    The halving, timeout, and path arguments are passed by the cv_score,
+    ffs, and bfs functions as their search dictionary.
+
+    The result and the log are stored in the result cache, if set (see
+    set_result_cache), and obtained from it for a repeated search. Searches
+    with a timeout are not cached, their result depends on the run time.
     '''
 
+    if(result_cache is None or timeout):
+        return _grid_search(data, target, classifier, n, scoring, param,
+                            cv=cv, cpu=cpu, log_f=log_f, halving=halving,
+                            timeout=timeout, path=path)
+
+    key = cache_key('grid_search', data, target, classifier, n, scoring,
+                    param, cv, halving, timeout, path)
+    cached = result_cache.get(key)
+
+    if(cached is None):
+        search_log_f = StringIO.StringIO()
+        result = _grid_search(data, target, classifier, n, scoring, param,
+                              cv=cv, cpu=cpu, log_f=search_log_f,
+                              halving=halving, timeout=timeout, path=path)
+        cached = (result, search_log_f.getvalue())
+        result_cache.put(key, cached)
+
+    (result, log) = cached
+    if(log_f):
+        log_f.write(log)
+
+    return result
+
+
+def _grid_search(data, target, classifier, n, scoring, param, cv=None, cpu=1,
+                 log_f=None, halving=False, timeout=None, path=False):
+
+    if(path and path_supported(classifier, param, target)):
+        return path_grid_search(data, target, classifier, n, scoring, param,
+                                cv=cv, cpu=cpu, log_f=log_f)
+
+    if(halving or timeout):
+        return halving_search(data, target, classifier, n, scoring, param,
+                              cv=cv, cpu=cpu, log_f=log_f, timeout=timeout)
+
     # if no cv sets provided, split data in train and test sets
     if(cv is None):
         cv = cross_validation.StratifiedKFold(target, n)
 
     # run grid search
-    clf = GridSearchCV(classifier, param, scoring=scoring, cv=cv, refit=False,
-                       n_jobs=cpu)
-    clf.fit(data, target)
+    scored = grid_scores(data, target, classifier, scoring, param, cv, cpu=cpu)
 
     # log results if requested
     if(log_f):
-        for params, mean_score, scores in clf.grid_scores_:
+        for params, mean_score, scores in scored:
             log_f.write('%0.3f;%0.3f;[%s];%r\n' % (mean_score, scores.std(),
                         ', '.join(['%.3f' % (s) for s in scores]), params))
         log_f.write('\n')
 
-    # return best parameters, and score
-    return (clf.best_score_, clf.best_params_)
+    # return best parameters, and score (first one for equal scores)
+    (best_params, best_score, _) = max(scored, key=lambda s: s[1])
+    return (best_score, best_params)
+
+
+def grid_scores(data, target, classifier, scoring, param, cv, cpu=1):
+    '''
+    This function returns the CV scores of all parameter configurations in the
+    grid param, as the grid_scores_ of GridSearchCV: a list of (parameters,
+    average score weighted by test set size, fold scores) in grid order.
+
+    With cpu > 1, the fits of all configurations and folds are distributed
+    over forked worker processes (see map_tasks). The workers share the data
+    with this process and only receive the fold indices, instead of the copy
+    of the data that is pickled for each fit by the GridSearchCV workers.
+    '''
+
+    if(cpu <= 1):
+        clf = GridSearchCV(classifier, param, scoring=scoring, cv=cv,
+                           refit=False)
+        clf.fit(data, target)
+        return [(params, mean_score, scores) for params, mean_score, scores
+                in clf.grid_scores_]
+
+    configs = list(ParameterGrid(param))
+    folds = list(cv)
+
+    # interleaved chunks of (configuration, fold) fits, one per worker
+    fits = [(config_i, fold_i) for config_i in xrange(len(configs))
+            for fold_i in xrange(len(folds))]
+    num_chunks = min(cpu, len(fits))
+    chunks = [fits[i::num_chunks] for i in xrange(num_chunks)]
+    tasks = [(data, target, classifier, scoring, configs, folds, chunk)
+             for chunk in chunks]
+
+    scores = numpy.zeros((len(configs), len(folds)))
+    for chunk, chunk_scores in zip(chunks, map_tasks(_grid_score_fits, tasks,
+                                                     cpu)):
+        for (config_i, fold_i), score in zip(chunk, chunk_scores):
+            scores[config_i, fold_i] = score
+
+    tst_sizes = numpy.array([len(tst) if not(tst.dtype == bool)
+                             else tst.sum() for trn, tst in folds], dtype=float)
+    mean_scores = numpy.dot(scores, tst_sizes) / tst_sizes.sum()
+
+    return [(configs[i], mean_scores[i], scores[i])
+            for i in xrange(len(configs))]
+
+
+def _grid_score_fits(task):
+    '''
+    This function returns the test scores of a chunk of (configuration index,
+    fold index) fits of grid_scores.
+    '''
+
+    (data, target, classifier, scoring, configs, folds, chunk) = task
+
+    scorer = metrics.SCORERS[scoring]
+    classifier_param = classifier.get_params()
+
+    chunk_scores = []
+    for config_i, fold_i in chunk:
+        (trn_indices, tst_indices) = folds[fold_i]
+        classifier_param.update(configs[config_i])
+        cl = type(classifier)(**classifier_param)
+        cl.fit(data[trn_indices], target[trn_indices])
+        chunk_scores.append(scorer(cl, data[tst_indices],
+                                   target[tst_indices]))
+
+    return chunk_scores
+
+def path_supported(classifier, param, target):
+    '''
+    This function returns True if the grid search of classifier over the
+    parameters param can be done with path_grid_search: a two-class linearsvc
+    with squared hinge loss and l2 penalty, and only C in the grid.
+
+    Other classifiers, including the linear kernel svc (svc_linear, libsvm
+    with hinge loss), are searched with the regular grid search, also if
+    the path search is requested.
+    '''
+    return (isinstance(classifier, svm.LinearSVC) and
+            classifier.loss in ['l2', 'squared_hinge'] and
+            classifier.penalty == 'l2' and
+            classifier.fit_intercept and
+            param.keys() == ['C'] and
+            len(numpy.unique(target)) == 2)
+
+
+def path_grid_search(data, target, classifier, n, scoring, param, cv=None,
+                     cpu=1, log_f=None):
+    '''
+    This function does the same CV grid search as grid_search for a two-class
+    linearsvc over C values only (see path_supported). Instead of fitting
+    each C value from scratch with liblinear, the squared hinge loss
+    objective of the linearsvc is minimized for the C values in increasing
+    order, each fit warm-started with the solution of the previous C value.
+    The path of each CV fold starts with the solution of the first C value in
+    the previous fold. Returns (best average CV score, best parameters).
+
+    The objective is minimized with L-BFGS (scipy) instead of the dual
+    coordinate descent of liblinear. Up to C = PATH_MAX_C both reach the same
+    optimum on standardized data, with a relative objective difference below
+    1e-4. For larger C values liblinear stops at its iteration limit, with an
+    objective that can be twice that of the path, and CV scores that differ
+    by several percent. The C values above PATH_MAX_C are therefore scored
+    with liblinear (see grid_scores, which uses cpu), so that all scores
+    match those of grid_search for the classifier that is trained with the
+    selected C value.
+    '''
+
+    # if no cv sets provided, split data in train and test sets
+    if(cv is None):
+        cv = cross_validation.StratifiedKFold(target, n)
+    cv = list(cv)
+    tst_sizes = [len(tst_indices) for trn_indices, tst_indices in cv]
+
+    cs = list(param['C'])
+    path_order = [c_i for c_i in numpy.argsort(cs, kind='mergesort')
+                  if cs[c_i] <= PATH_MAX_C]
+    scores = numpy.zeros((len(cs), len(cv)))
+
+    # score the large C values with liblinear
+    liblinear_cs = [c_i for c_i in xrange(len(cs)) if cs[c_i] > PATH_MAX_C]
+    if(liblinear_cs):
+        liblinear_scores = grid_scores(
+            data, target, classifier, scoring,
+            {'C': [cs[c_i] for c_i in liblinear_cs]}, cv, cpu=cpu)
+        for c_i, (p, mean_score, c_scores) in zip(liblinear_cs,
+                                                   liblinear_scores):
+            scores[c_i] = c_scores
+
+    classes = numpy.unique(target)
+    sample_weight = _class_sample_weight(classifier.class_weight, classes,
+                                         target)
+
+    # append the (scaled) intercept feature
+    column = numpy.empty((data.shape[0], 1))
+    column.fill(classifier.intercept_scaling)
+    if(sparse.issparse(data)):
+        data = sparse.hstack([data, column]).tocsr()
+    else:
+        data = numpy.hstack([numpy.asarray(data, dtype=float), column])
+    y = numpy.where(target == classes[1], 1.0, -1.0)
+
+    weights = None
+    for fold_i, (trn_indices, tst_indices) in enumerate(cv):
+
+        trn_data = data[trn_indices]
+        trn_y = y[trn_indices]
+        trn_weight = sample_weight[trn_indices]
+        tst_data = data[tst_indices]
+
+        if(weights is None):
+            weights = numpy.zeros(data.shape[1])
+        first_weights = weights
+
+        for path_i, c_i in enumerate(path_order):
+
+            weights = _fit_squared_hinge(trn_data, trn_y, trn_weight,
+                                         cs[c_i], weights)
+            if(path_i == 0):
+                first_weights = weights
+
+            # obtain scores as for the linearsvc (decision values as proba)
+            proba = tst_data.dot(weights)
+            pred = numpy.where(proba > 0, classes[1], classes[0])
+            if(scoring in all_score_input['proba']):
+                scores[c_i, fold_i] = all_score_funcs[scoring](
+                    target[tst_indices], proba)
+            else:
+                scores[c_i, fold_i] = all_score_funcs[scoring](
+                    target[tst_indices], pred)
+
+        # start path of the next fold with the first solution of this fold
+        weights = first_weights
+
+    best = None
+    for c_i, c in enumerate(cs):
+
+        # average weighted by test set size, like GridSearchCV
+        mean_score = numpy.average(scores[c_i], weights=tst_sizes)
+
+        if(log_f):
+            log_f.write('%0.3f;%0.3f;[%s];%r\n' % (
+                        mean_score, scores[c_i].std(),
+                        ', '.join(['%.3f' % (s) for s in scores[c_i]]),
+                        {'C': c}))
+
+        if(best is None or mean_score > best[0]):
+            best = (mean_score, {'C': c})
+
+    if(log_f):
+        log_f.write('\n')
+
+    return best
+
+
+def _fit_squared_hinge(data, y, sample_weight, c, weights):
+    '''
+    This function minimizes the linearsvc objective 0.5 * |w|^2 + c * sum_i
+    sample_weight_i * max(0, 1 - y_i * w.x_i)^2, starting at weights.
+    '''
+
+    def objective(w):
+        margin = 1.0 - y * data.dot(w)
+        active = margin > 0
+        loss = sample_weight * margin * active
+        value = 0.5 * w.dot(w) + c * (loss * margin).sum()
+        gradient = w - 2.0 * c * data.T.dot(loss * y)
+        return (value, numpy.asarray(gradient).ravel())
+
+    (weights, _, _) = optimize.fmin_l_bfgs_b(objective, weights)
+    return weights
+
+
+def _class_sample_weight(class_weight, classes, target):
+    '''
+    This function returns the weight per object of the class_weight setting
+    of a classifier: None, a {class: weight} dict, or 'auto' (inversely
+    proportional to the class frequencies).
+    '''
+    if(class_weight == 'auto'):
+        weight = numpy.array([1.0 / numpy.sum(target == c) for c in classes])
+        weight *= len(classes) / weight.sum()
+        class_weight = dict(zip(classes, weight))
+    elif(not class_weight):
+        class_weight = {}
+    return numpy.array([class_weight.get(t, 1.0) for t in target])
+
+
+class ResultCache(object):
+    '''
+    Persistent cache of CV results in directory cache_dir, with one pickle
+    file per key (see cache_key). The total size of the files is bounded by
+    max_size bytes, the least recently used results are removed first. The
+    files are written atomically, so that the cache can be shared by
+    processes.
+    '''
+
+    def __init__(self, cache_dir, max_size=RESULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not(os.path.exists(cache_dir)):
+            os.makedirs(cache_dir)
+
+        # total size of the files, None if not counted yet. It is increased
+        # by put, and recounted by _evict, which includes the files written
+        # by other processes.
+        self._size = None
+
+    def get(self, key):
+        '''
+        This function returns the result stored for key, or None.
+        '''
+        f = os.path.join(self.cache_dir, key)
+        try:
+            with open(f, 'rb') as fin:
+                value = cPickle.load(fin)
+            # mark as recently used
+            os.utime(f, None)
+        except Exception:
+            return None
+        return value
+
+    def put(self, key, value):
+        '''
+        This function stores value for key. If the cache exceeds its maximal
+        size, the least recently used results are removed until it is
+        reduced to RESULT_CACHE_LOW_WATER times its maximal size, so that the
+        cache directory is only listed once per number of stored results.
+        '''
+        (fd, tmp_f) = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                cPickle.dump(value, fout, cPickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(tmp_f)
+            os.rename(tmp_f, os.path.join(self.cache_dir, key))
+        except:
+            _remove_file(tmp_f)
+            raise
+
+        if(self._size is not None):
+            self._size += size
+        if(self._size is None or self._size > self.max_size):
+            self._evict()
+
+    def _evict(self):
+
+        now = time.time()
+
+        files = []
+        for name in os.listdir(self.cache_dir):
+            f = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(f)
+            except OSError:
+                continue
+            # remove the temporary files of interrupted writes
+            if(name.endswith('.tmp')):
+                if(now - stat.st_mtime > RESULT_CACHE_TMP_AGE):
+                    _remove_file(f)
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum([size for (mtime, size, name) in files])
+        if(total_size > self.max_size):
+            for (mtime, size, name) in sorted(files):
+                if(total_size <= RESULT_CACHE_LOW_WATER * self.max_size):
+                    break
+                _remove_file(os.path.join(self.cache_dir, name))
+                total_size -= size
+
+        self._size = total_size
+
+
+def _remove_file(f):
+    # the file may already be removed by another process
+    try:
+        os.remove(f)
+    except OSError:
+        pass
+
+
+def set_result_cache(cache_dir, max_size=RESULT_CACHE_SIZE):
+    '''
+    This function sets the persistent result cache that is consulted by
+    grid_search and cv_scores_no_scaling, None disables it. The cache is also
+    used by the worker processes that are started afterwards.
+    '''
+    global result_cache
+    if(cache_dir is None):
+        result_cache = None
+    else:
+        result_cache = ResultCache(cache_dir, max_size)
+
+
+def cache_key(*parts):
+    '''
+    This function returns a hash of parts: (sparse) data matrices, target
+    arrays, classifiers (type and parameters), parameter grids, CV folds,
+    and other settings, that is used as result cache key. The key also
+    depends on RESULT_CACHE_VERSION and the sklearn version.
+    '''
+    h = hashlib.sha1()
+    h.update('version%i sklearn%s' % (RESULT_CACHE_VERSION,
+                                       sklearn.__version__))
+    for part in parts:
+        _hash_update(h, part)
+    return h.hexdigest()
+
+
+def _hash_update(h, obj):
+
+    if(sparse.issparse(obj)):
+        obj = obj.tocsr()
+        h.update('sparse%r' % (obj.shape,))
+        for array in [obj.data, obj.indices, obj.indptr]:
+            _hash_update(h, array)
+    elif(isinstance(obj, numpy.ndarray)):
+        obj = numpy.ascontiguousarray(obj)
+        h.update('array%s%r' % (obj.dtype.str, obj.shape))
+        h.update(obj.tostring())
+    elif(hasattr(obj, 'get_params')):
+        h.update('classifier%s' % (type(obj).__name__))
+        _hash_update(h, obj.get_params())
+    elif(isinstance(obj, dict)):
+        h.update('dict%i' % (len(obj)))
+        for key in sorted(obj.keys()):
+            _hash_update(h, key)
+            _hash_update(h, obj[key])
+    elif(isinstance(obj, (list, tuple))):
+        h.update('list%i' % (len(obj)))
+        for item in obj:
+            _hash_update(h, item)
+    elif(hasattr(obj, '__iter__') and not isinstance(obj, basestring)):
+        # CV fold generator
+        _hash_update(h, list(obj))
+    else:
+        h.update(repr(obj))
+
+
+def halving_search(data, target, classifier, n, scoring, param, cv=None,
+                   cpu=1, log_f=None, timeout=None):
+    '''
+    Successive halving parameter search. All parameter configurations are
+    scored with CV on a small stratified sample of the objects, the best
+    1 / halving_factor of them are promoted to the next rung, which uses
+    halving_factor times more objects, up to the full data set (with cv, if
+    provided) in the last rung.
+
+    If a timeout (seconds) is provided, no rung is started that is not
+    expected to finish within the time budget, assuming a run time that is
+    quadratic in the number of objects. The best configuration of the last
+    finished rung is returned in that case.
+
+    The scores of each rung and the configurations that were pruned are
+    written to log_f. Returns (best average CV score, best parameters) as
+    grid_search.
+    '''
+
+    start_time = time.time()
+
+    configs = list(ParameterGrid(param))
+    num_objects = len(target)
+    num_classes = len(numpy.unique(target))
+
+    # number of objects per rung, the first rung has enough objects for the
+    # CV folds, the last one has all objects
+    num_rungs = 1
+    while(halving_factor ** (num_rungs - 1) < len(configs)):
+        num_rungs += 1
+    min_objects = 2 * n * num_classes
+    rung_sizes = [max(min_objects, num_objects //
+                      halving_factor ** (num_rungs - 1 - rung_i))
+                  for rung_i in xrange(num_rungs)]
+    rung_sizes = sorted(set([min(size, num_objects) for size in rung_sizes]))
+
+    best = None
+    last_time = None
+    for rung_i, rung_size in enumerate(rung_sizes):
+
+        is_last = rung_i == len(rung_sizes) - 1
+
+        # stop if the rung is not expected to finish in time
+        if(timeout and last_time is not None):
+            estimate = (last_time * len(configs) / last_num_configs *
+                        (float(rung_size) / last_size) ** 2)
+            if(time.time() - start_time + estimate > timeout):
+                if(log_f):
+                    log_f.write('timeout, not scored on %i objects: %s\n\n' %
+                                (rung_size, configs))
+                break
+
+        rung_start = time.time()
+
+        if(rung_size == num_objects):
+            rung_data = data
+            rung_target = target
+            rung_cv = cv
+        else:
+            object_is = _stratified_sample(target, rung_size)
+            rung_data = data[object_is, :]
+            rung_target = target[object_is]
+            rung_cv = None
+        if(rung_cv is None):
+            rung_cv = cross_validation.StratifiedKFold(rung_target, n)
+
+        # score the configurations of this rung
+        rung_scores = grid_scores(rung_data, rung_target, classifier, scoring,
+                                  [dict([(k, [v]) for k, v in c.iteritems()])
+                                   for c in configs], rung_cv, cpu=cpu)
+        scored = [(mean_score, params) for params, mean_score, scores in
+                  rung_scores]
+
+        if(log_f):
+            log_f.write('rung %i, %i objects\n' % (rung_i, rung_size))
+            for params, mean_score, scores in rung_scores:
+                log_f.write('%0.3f;%0.3f;[%s];%r\n' % (
+                            mean_score, scores.std(),
+                            ', '.join(['%.3f' % (s) for s in scores]),
+                            params))
+
+        # best configuration first, keep grid order for equal scores
+        order = sorted(range(len(scored)), key=lambda i: -scored[i][0])
+        best = scored[order[0]]
+
+        last_time = time.time() - rung_start
+        last_num_configs = len(configs)
+        last_size = rung_size
+
+        if(is_last):
+            if(log_f):
+                log_f.write('\n')
+            break
+
+        # promote the best configurations to the next rung
+        num_promoted = max(1, int(numpy.ceil(len(configs) /
+                                             float(halving_factor))))
+        configs = [scored[i][1] for i in order[:num_promoted]]
+        if(log_f):
+            log_f.write('pruned: %s\n\n' % ([scored[i][1] for i in
+                                              order[num_promoted:]]))
+
+    return best
+
+
+def _stratified_sample(target, size):
+    '''
+    This function returns the sorted indices of a reproducible random sample
+    of size objects, with the class proportions of target.
+    '''
+    random_state = numpy.random.RandomState(0)
+    classes = numpy.unique(target)
+    object_is = []
+    for class_i, label in enumerate(classes):
+        class_is = numpy.where(target == label)[0]
+        # the last class gets the remaining objects
+        if(class_i == len(classes) - 1):
+            class_size = size - len(object_is)
+        else:
+            class_size = int(round(size * len(class_is) / float(len(target))))
+        class_size = min(len(class_is), max(1, class_size))
+        object_is.extend(random_state.permutation(class_is)[:class_size])
+    return numpy.sort(numpy.array(object_is))
+
 
 #
 # Methods for unscaled data
@@ -134,10 +756,25 @@ def grid_search(data, target, classifier, n, scoring, param, cv=None, cpu=1,
 
 
 def cv_score(data, target, classifier, n, scoring, param=None, cv=None, cpu=1,
-             log_f=None, standardize=True, refit=True):
+             log_f=None, standardize=True, refit=True, search=None):
     '''
     A grid search is done if parameters (param) are provided. Otherwise the
-    parameters in the provided classifier are used.
+    parameters in the provided classifier are used. The search dictionary
+    contains extra keyword arguments of grid_search (e.g. successive halving
+    and its timeout).
+
+    For the linear and rbf svc, the Gram or squared distance matrix of all
+    objects is computed once (see pairwise_matrix), and the folds and grid
+    points are trained on slices of the precomputed kernel matrices, unless
+    a successive halving search is requested. The grid search then scores
+    the same as grid_search (see distance_grid_search), but it does not use
+    the result cache, and it runs in the fold worker, the grid search part
+    of the cpu budget is not used.
+
+    The outer CV folds, and the refit on the full data set, are run in
+    parallel. The worker budget cpu is split between the parallel folds and
+    the grid search within each fold (see split_cpu). The fold results are
+    gathered in fold order, so the output does not depend on cpu.
     '''
 
     # create stratified train and test set generator
@@ -151,58 +788,45 @@ def cv_score(data, target, classifier, n, scoring, param=None, cv=None, cpu=1,
     cv_roc_curves = roc.RocCollection()
     predictions = []
 
+    # densify sparse data if the classifier can not handle it
+    data = check_sparse(data, classifier)
+
     if(standardize):
         # create scaler and scale the data with it
-        scaler = preprocessing.StandardScaler().fit(data)
-        data = scaler.transform(data)
+        data = get_scaler(data).transform(data)
 
     print
     print 'start cross-validation...'
     print
 
-    # outer CV
-    for fold_i, (trn_indices, tst_indices) in enumerate(cv):
-
-        # slice out the train and test data
-        trn_data = data[trn_indices, :]
-        tst_data = data[tst_indices, :]
-        trn_target = target[trn_indices]
-        tst_target = target[tst_indices]
-
-        '''
-        if(standardize):
-
-            # create scaler using the training instances
-            scaler = preprocessing.StandardScaler().fit(trn_data)
-
-            # scale the train and test data
-            trn_data = scaler.transform(trn_data)
-            tst_data = scaler.transform(tst_data)
-        '''
-
-        # obtain the original classifier parameters
-        classifier_param = classifier.get_params()
-
-        # perform grid search, if parameters are provided
-        if(param):
+    # kernel matrix base of all objects, shared with the fold workers
+    matrix = None
+    if(param and uses_kernel_cache(classifier) and
+            data.shape[0] <= KERNEL_CACHE_MAX_OBJECTS and
+            not((search or {}).get('halving') or
+                (search or {}).get('timeout'))):
+        matrix = pairwise_matrix(data, classifier)
+
+    # outer CV folds, followed by the refit on the full data set
+    folds = list(cv)
+    tasks = [(trn_indices, tst_indices) for trn_indices, tst_indices in folds]
+    if(refit):
+        tasks.append((None, None))
 
-            if(log_f):
-                log_f.write('CV-loop %i\n' % (fold_i))
+    (outer_cpu, inner_cpu) = split_cpu(cpu, len(tasks))
+    tasks = [(data, target, classifier, n, scoring, param, trn_is, tst_is,
+              inner_cpu, log_f is not None, search, matrix)
+             for trn_is, tst_is in tasks]
+    results = map_tasks(_cv_fold, tasks, outer_cpu)
 
-            # optimize parameters on train set (s is train score)
-            _, p = grid_search(trn_data, trn_target, classifier, n,
-                               scoring, param, cpu=cpu, log_f=log_f)
+    for fold_i, (trn_indices, tst_indices) in enumerate(folds):
 
-            # update parameters with the optimized ones
-            classifier_param.update(p)
+        (classifier_param, _, test_result, log) = results[fold_i]
+        (score, all_scores, confusion, roc_curve, probas) = test_result
 
-        # use parameters to create new classifier object and train it
-        best_cl = type(classifier)(**classifier_param)
-        best_cl.fit(trn_data, trn_target)
-
-        # test the classifier on the test set
-        (score, all_scores, confusion, roc_curve, probas) = test_classifier(
-            tst_data, tst_target, best_cl, scoring)
+        if(param and log_f):
+            log_f.write('CV-loop %i\n' % (fold_i))
+            log_f.write(log)
 
         print 'fold %i: %.3f' % (fold_i, score)
         sys.stdout.flush()
@@ -213,7 +837,7 @@ def cv_score(data, target, classifier, n, scoring, param=None, cv=None, cpu=1,
         cv_confusion.append(confusion)
         if(roc_curve):
             cv_roc_curves.add(roc_curve)
-        predictions.extend(zip(tst_indices, probas, tst_target))
+        predictions.extend(zip(tst_indices, probas, target[tst_indices]))
 
         # store classifier parameters
         cv_params.append(classifier_param)
@@ -223,48 +847,551 @@ def cv_score(data, target, classifier, n, scoring, param=None, cv=None, cpu=1,
     print
     sys.stdout.flush()
 
-    # train classifier on full data set if requested
+    # classifier trained on full data set if requested
     all_data_cl = None
     if(refit):
+        (_, all_data_cl, _, log) = results[-1]
+        if(log_f):
+            log_f.write(log)
 
-        '''
-        # scale the whole data set
-        if(standardize):
+    # return average score over the cv loops
+    return (cv_scores, cv_params, cv_confusion, cv_all_scores, cv_roc_curves,
+            predictions, all_data_cl)
 
-            # create scaler for full data set
-            scaler = preprocessing.StandardScaler().fit(data)
-            # scale data set
-            data = scaler.transform(data)
-        '''
 
-        # obtain the original classifier parameters
+def _cv_fold(task):
+    '''
+    This function runs one outer CV fold of cv_score: a grid search on the
+    train data (if parameters are provided), training the classifier with the
+    optimized parameters, and testing it on the test data. If the fold has no
+    train and test indices, the classifier is trained on the full data set
+    (refit) and returned instead of the test results.
+
+    If the svc kernel matrix base of all objects is provided (see
+    pairwise_matrix), the grid search and the fold classifier use slices of
+    the precomputed kernel matrices.
+
+    Returns (classifier parameters, refit classifier or None, test results
+    or None, grid search log).
+    '''
+
+    (data, target, classifier, n, scoring, param, trn_indices, tst_indices,
+     cpu, log, search, matrix) = task
+
+    log_f = StringIO.StringIO() if log else None
+
+    # slice out the train data
+    if(trn_indices is None):
+        trn_data = data
+        trn_target = target
+        trn_indices = numpy.arange(len(target))
+    else:
+        trn_data = data[trn_indices, :]
+        trn_target = target[trn_indices]
+
+    # obtain the original classifier parameters
+    classifier_param = classifier.get_params()
+
+    # perform grid search, if parameters are provided
+    if(param and matrix is not None):
+
+        # optimize parameters on the train set kernel
+        _, p = distance_grid_search(
+            matrix[numpy.ix_(trn_indices, trn_indices)], trn_target,
+            classifier, n, scoring, param, data.shape[1], log_f=log_f)
+        classifier_param.update(p)
+
+    elif(param):
+
+        # optimize parameters on train set
+        _, p = grid_search(trn_data, trn_target, classifier, n, scoring,
+                           param, cpu=cpu, log_f=log_f, **(search or {}))
+
+        # update parameters with the optimized ones
+        classifier_param.update(p)
+
+    log = log_f.getvalue() if log_f else ''
+
+    if(matrix is not None and tst_indices is not None):
+
+        # train and test the fold classifier on the precomputed kernel
+        kernel = precomputed_kernel(
+            matrix[:, trn_indices], classifier_param, data.shape[1])
+        best_cl = precomputed_svc(classifier, classifier_param)
+        best_cl.fit(kernel[trn_indices], trn_target)
+        test_result = test_classifier(kernel[tst_indices],
+                                      target[tst_indices], best_cl, scoring)
+
+        return (classifier_param, None, test_result, log)
+
+    # use parameters to create new classifier object and train it
+    best_cl = type(classifier)(**classifier_param)
+    best_cl.fit(trn_data, trn_target)
+
+    if(tst_indices is None):
+        return (classifier_param, best_cl, None, log)
+
+    # test the classifier on the test set
+    test_result = test_classifier(data[tst_indices, :], target[tst_indices],
+                                  best_cl, scoring)
+
+    return (classifier_param, None, test_result, log)
+
+
+def score_feature_subsets(data, target, classifier, n, scoring, subsets,
+                          param=None, feat_names=None, log_f=None, cpu=1,
+                          base=None, search=None):
+    '''
+    This function returns the (cv score, parameters, feature indices) for
+    each list of feature indices in subsets. If parameters (param) are
+    provided, the score and parameters are those of the best grid point.
+
+    The subsets are scored in parallel, in chunks, with the worker budget cpu
+    split between the chunks and the grid searches (see split_cpu). The
+    results and the grid search log are in the order of subsets.
+
+    If each subset differs by one added or removed feature from the feature
+    indices base, and the classifier is distance based (see
+    uses_distances), the squared distance matrix of base is calculated once.
+    The subsets are then scored on this matrix plus or minus the distances
+    of one feature, with precomputed kernels or neighbors, using the full
+    grid search with the same scores as grid_search (see
+    distance_grid_search). This is only done if the matrices of all workers fit in
+    DISTANCE_CACHE_MAX_ENTRIES, and if the search dictionary does not ask for
+    successive halving or a timeout. Otherwise the search dictionary is
+    passed to grid_search (see cv_score).
+    '''
+
+    (outer_cpu, inner_cpu) = split_cpu(cpu, len(subsets))
+
+    # squared distances of the base features, shared with the workers
+    dist = None
+    if(base is not None and uses_distances(classifier) and
+            data.shape[0] ** 2 * (1 + 2 * outer_cpu) <=
+            DISTANCE_CACHE_MAX_ENTRIES and
+            not((search or {}).get('halving') or
+                (search or {}).get('timeout'))):
+        dist = squared_distances(data, base)
+
+    # a few chunks per worker, to balance differences in run time
+    num_chunks = min(len(subsets), 4 * outer_cpu)
+    chunks = [subsets[i::num_chunks] for i in xrange(num_chunks)]
+
+    tasks = [(data, target, classifier, n, scoring, param, chunk, feat_names,
+              inner_cpu, log_f is not None, dist, base, search)
+             for chunk in chunks]
+    chunk_results = map_tasks(_score_feature_subsets, tasks, outer_cpu)
+
+    # restore subset order, chunk i contains subsets i, i + num_chunks, ...
+    results = [None] * len(subsets)
+    for chunk_i, chunk_result in enumerate(chunk_results):
+        results[chunk_i::num_chunks] = chunk_result
+
+    if(log_f):
+        for (score, p, feat_is, log) in results:
+            log_f.write(log)
+
+    return [(score, p, feat_is) for (score, p, feat_is, log) in results]
+
+
+def _score_feature_subsets(task):
+
+    (data, target, classifier, n, scoring, param, subsets, feat_names, cpu,
+     log, dist, base, search) = task
+
+    # distances of the current subset, updated in place
+    if(dist is not None):
+        subset_dist = numpy.empty(dist.shape)
+
+    results = []
+    for feat_is in subsets:
+
+        log_f = StringIO.StringIO() if log else None
+
+        # log to grid search file
+        if(param and log_f):
+            log_f.write('%s' % (str(feat_is)))
+            if(feat_names):
+                log_f.write('[%s]' % (', '.join([feat_names[i]
+                            for i in feat_is])))
+            log_f.write('\n')
+
+        if(dist is not None):
+
+            # update the base distances with the added or removed feature
+            (feat_i,) = set(feat_is).symmetric_difference(base)
+            _feature_distances(data, feat_i, subset_dist)
+            if(feat_i in feat_is):
+                subset_dist += dist
+            else:
+                numpy.subtract(dist, subset_dist, subset_dist)
+            numpy.maximum(subset_dist, 0.0, subset_dist)
+
+            (best_s, best_p) = distance_grid_search(
+                subset_dist, target, classifier, n, scoring, param,
+                len(feat_is), log_f=log_f if param else None)
+
+            if not(param):
+                best_p = classifier.get_params()
+
+        elif(param):
+
+            # run parameter grid search
+            (best_s, best_p) = grid_search(data[:, feat_is], target,
+                                           classifier, n, scoring, param,
+                                           log_f=log_f, cpu=cpu,
+                                           **(search or {}))
+        else:
+            # obtain cv score (grid search not neccasary)
+            best_p = classifier.get_params()
+            best_s = numpy.mean(cv_scores_no_scaling(
+                data[:, feat_is], target, classifier, n, scoring))
+
+        results.append((best_s, best_p, feat_is,
+                        log_f.getvalue() if log_f else ''))
+
+    return results
+
+
+def uses_distances(classifier):
+    '''
+    This function returns True if the classifier only depends on the
+    euclidean distances between objects: svc with rbf kernel, and the
+    nearest neighbors classifiers.
+    '''
+    if(isinstance(classifier, svm.SVC)):
+        return classifier.kernel == 'rbf'
+    if(isinstance(classifier, (neighbors.KNeighborsClassifier,
+                               neighbors.RadiusNeighborsClassifier))):
+        return (getattr(classifier, 'metric', 'minkowski') in
+                ['minkowski', 'euclidean'] and
+                getattr(classifier, 'p', 2) == 2)
+    return False
+
+
+def squared_distances(data, feat_is):
+    '''
+    This function returns the matrix with the squared euclidean distances
+    between all rows of data, using the features (columns) feat_is. The
+    distances are summed per feature, so that the matrix of a subset that
+    differs by one feature is obtained by adding or subtracting the matrix of
+    that feature.
+    '''
+    dist = numpy.zeros((data.shape[0], data.shape[0]))
+    diff = numpy.empty(dist.shape)
+    for feat_i in feat_is:
+        _feature_distances(data, feat_i, diff)
+        dist += diff
+    return dist
+
+
+def _feature_distances(data, feat_i, out):
+
+    # squared distances between all rows of data for feature feat_i, stored
+    # in the square matrix out
+    column = data[:, feat_i]
+    if(sparse.issparse(column)):
+        column = column.toarray()
+    column = numpy.ravel(column).astype(float)
+    numpy.subtract(column[:, numpy.newaxis], column, out)
+    out **= 2
+
+
+def distance_grid_search(dist, target, classifier, n, scoring, param,
+                         num_feats, cv=None, log_f=None):
+    '''
+    This function does the same CV grid search as grid_search, for a
+    distance based classifier (see uses_distances), using the squared
+    distance matrix dist of the objects instead of their feature values.
+    The rbf svc is trained on the precomputed kernel, the nearest neighbors
+    are obtained from the distances. For the linear svc, dist is the Gram
+    matrix of the objects (see pairwise_matrix). num_feats is the number of
+    features, which determines the default rbf gamma. Returns the (best
+    average CV score, best parameters). Without param, the classifier
+    parameters are scored and empty parameters are returned.
+    '''
+
+    # if no cv sets provided, split data in train and test sets
+    if(cv is None):
+        cv = cross_validation.StratifiedKFold(target, n)
+    cv = list(cv)
+    tst_sizes = [len(tst_indices) for trn_indices, tst_indices in cv]
+
+    configs = list(ParameterGrid(param)) if param else [{}]
+    classifier_params = []
+    for p in configs:
         classifier_param = classifier.get_params()
+        classifier_param.update(p)
+        classifier_params.append(classifier_param)
+
+    # score the configurations with the same svc kernel consecutively, so
+    # that each kernel matrix is computed once
+    is_svc = isinstance(classifier, svm.SVC)
+    kernel_keys = [_svc_gamma(cp, num_feats) if is_svc else None
+                   for cp in classifier_params]
+    config_scores = [None] * len(configs)
+    matrix = dist
+    matrix_key = None
+
+    for config_i in sorted(range(len(configs)), key=lambda i: kernel_keys[i]):
+
+        classifier_param = classifier_params[config_i]
+        if(is_svc and (matrix is dist or
+                       not(kernel_keys[config_i] == matrix_key))):
+            matrix = precomputed_kernel(dist, classifier_param, num_feats)
+            matrix_key = kernel_keys[config_i]
+
+        config_scores[config_i] = numpy.array([_distance_cv_score(
+            matrix, target, trn_indices, tst_indices, classifier,
+            classifier_param, scoring)
+            for trn_indices, tst_indices in cv])
+
+    best = None
+    for p, scores in zip(configs, config_scores):
+
+        # average weighted by test set size, like GridSearchCV
+        mean_score = numpy.average(scores, weights=tst_sizes)
+
+        if(log_f):
+            log_f.write('%0.3f;%0.3f;[%s];%r\n' % (mean_score, scores.std(),
+                        ', '.join(['%.3f' % (s) for s in scores]), p))
 
-        # perform grid search, if parameters are provided
-        if(param):
+        if(best is None or mean_score > best[0]):
+            best = (mean_score, p)
 
-            # optimize parameters on train set (s is train score)
-            (s, p) = grid_search(data, target, classifier, n, scoring,
-                                 param, cpu=cpu, log_f=log_f)
+    if(log_f):
+        log_f.write('\n')
 
-            # update parameters with the optimized ones
-            classifier_param.update(p)
+    return best
 
-        # use parameters to create new classifier object and train it
-        all_data_cl = type(classifier)(**classifier_param)
-        all_data_cl.fit(data, target)
 
-    # return average score over the cv loops
-    return (cv_scores, cv_params, cv_confusion, cv_all_scores, cv_roc_curves,
-            predictions, all_data_cl)
+def _distance_cv_score(matrix, target, trn_indices, tst_indices, classifier,
+                       classifier_param, scoring):
+    '''
+    This function returns the score of one CV fold, with matrix the
+    precomputed svc kernel or the squared distances for nearest neighbors.
+    The svc is scored with the scorer of GridSearchCV (the decision function
+    for roc_auc), so that the scores equal those of grid_search. The platt
+    scaling probabilities are therefore not required and not fitted.
+    '''
+
+    trn_target = target[trn_indices]
+    tst_target = target[tst_indices]
+
+    if(isinstance(classifier, svm.SVC)):
+        classifier_param = dict(classifier_param)
+        classifier_param['probability'] = False
+        cl = precomputed_svc(classifier, classifier_param)
+        cl.fit(matrix[numpy.ix_(trn_indices, trn_indices)], trn_target)
+        return metrics.SCORERS[scoring](
+            cl, matrix[numpy.ix_(tst_indices, trn_indices)], tst_target)
+
+    (pred, proba) = _neighbors_classify(
+        matrix[numpy.ix_(tst_indices, trn_indices)], trn_target,
+        classifier_param,
+        isinstance(classifier, neighbors.RadiusNeighborsClassifier))
+
+    if(scoring in all_score_input['proba']):
+        return all_score_funcs[scoring](tst_target, proba)
+    else:
+        return all_score_funcs[scoring](tst_target, pred)
+
+
+def uses_kernel_cache(classifier):
+    '''
+    This function returns True if the svc classifier can be trained on a
+    precomputed kernel matrix: svc with linear or rbf kernel.
+    '''
+    return (isinstance(classifier, svm.SVC) and
+            classifier.kernel in ['linear', 'rbf'])
+
+
+def pairwise_matrix(data, classifier):
+    '''
+    This function returns the matrix from which the kernel of the svc
+    classifier is obtained (see precomputed_kernel): the Gram matrix of the
+    data rows for the linear kernel, their squared euclidean distances
+    otherwise.
+    '''
+    gram = data.dot(data.T)
+    if(sparse.issparse(gram)):
+        gram = gram.toarray()
+    gram = numpy.asarray(gram, dtype=float)
+    if(classifier.kernel == 'linear'):
+        return gram
+    norms = numpy.diag(gram).copy()
+    dist = norms[:, numpy.newaxis] + norms - 2.0 * gram
+    numpy.maximum(dist, 0.0, dist)
+    return dist
+
+
+def precomputed_kernel(matrix, classifier_param, num_feats):
+    '''
+    This function returns the svc kernel matrix for the parameters
+    classifier_param from the Gram matrix (linear kernel) or the squared
+    distances (rbf kernel) matrix.
+    '''
+    if(classifier_param['kernel'] == 'linear'):
+        return matrix
+    return numpy.exp(-_svc_gamma(classifier_param, num_feats) * matrix)
+
+
+def precomputed_svc(classifier, classifier_param):
+    '''
+    This function returns an untrained svc with parameters classifier_param
+    that is trained on a precomputed kernel matrix.
+    '''
+    classifier_param = dict(classifier_param)
+    classifier_param['kernel'] = 'precomputed'
+    return type(classifier)(**classifier_param)
+
+
+def _svc_gamma(classifier_param, num_feats):
+    # non-numeric gamma ('auto') means 1 / number of features
+    gamma = classifier_param['gamma']
+    if(isinstance(gamma, str) or gamma == 0.0):
+        gamma = 1.0 / num_feats
+    return gamma
+
+
+def _neighbors_classify(dist, trn_target, classifier_param, radius_based):
+    '''
+    This function classifies test objects with their squared distances dist
+    (test x train objects) to the train objects, like the (radius) nearest
+    neighbors classifiers with uniform or distance weights. Returns (pred,
+    proba) as classify, the radius neighbors classifier does not provide
+    probabilities.
+
+    Raises:
+        ValueError: If a test object has no neighbors within the radius and
+                    no outlier label is set.
+    '''
+
+    (classes, trn_y) = numpy.unique(trn_target, return_inverse=True)
+    dist = numpy.sqrt(dist)
+
+    # select the neighbors of each test object
+    if(radius_based):
+        is_neighbor = dist <= classifier_param['radius']
+    else:
+        k = min(classifier_param['n_neighbors'], dist.shape[1])
+        nearest = numpy.argsort(dist, axis=1, kind='mergesort')[:, :k]
+        is_neighbor = numpy.zeros(dist.shape, dtype=bool)
+        is_neighbor[numpy.arange(dist.shape[0])[:, numpy.newaxis],
+                    nearest] = True
+
+    # neighbor weights, neighbors at distance 0 get all weight
+    if(classifier_param['weights'] == 'distance'):
+        is_zero = is_neighbor & (dist == 0.0)
+        zero_rows = is_zero.any(axis=1)
+        weights = numpy.where(is_neighbor, 1.0 / numpy.maximum(dist, 1e-300),
+                              0.0)
+        weights[zero_rows] = is_zero[zero_rows]
+    else:
+        weights = is_neighbor.astype(float)
+
+    votes = numpy.column_stack([weights[:, trn_y == class_i].sum(axis=1)
+                                for class_i in xrange(len(classes))])
+    pred = classes[votes.argmax(axis=1)]
+
+    if(radius_based):
+        outliers = ~(is_neighbor.any(axis=1))
+        if(outliers.any()):
+            if(classifier_param.get('outlier_label') is None):
+                raise ValueError('No neighbors found within the radius.')
+            pred[outliers] = classifier_param['outlier_label']
+        return (pred, pred)
+
+    proba = votes / votes.sum(axis=1)[:, numpy.newaxis]
+    return (pred, proba[:, 1])
+
+
+def split_cpu(cpu, num_tasks):
+    '''
+    This function splits a budget of cpu workers over num_tasks parallel
+    tasks. Returns the number of tasks that is run at once and the number of
+    workers that is available within each of these tasks.
+    '''
+    outer_cpu = max(1, min(cpu, num_tasks))
+    return (outer_cpu, max(1, cpu // outer_cpu))
+
+
+def map_tasks(func, tasks, cpu):
+    '''
+    This function returns [func(task) for task in tasks], with the tasks run
+    in at most cpu forked worker processes. The task arguments are therefore
+    not copied to the workers, only the results are send back. The workers
+    are not daemonic, so that a task can start its own worker processes
+    (e.g. the n_jobs of GridSearchCV). The results are returned in task
+    order.
+
+    Raises:
+        RuntimeError: If a task fails, with the traceback of the worker.
+    '''
+
+    if(cpu <= 1 or len(tasks) <= 1):
+        return [func(task) for task in tasks]
+
+    queue = multiprocessing.Queue()
+    results = [None] * len(tasks)
+    running = {}
+    next_i = 0
+    num_done = 0
+
+    try:
+        while(num_done < len(tasks)):
+
+            # start tasks while workers are available
+            while(next_i < len(tasks) and len(running) < cpu):
+                proc = multiprocessing.Process(
+                    target=_run_task, args=(func, tasks[next_i], next_i,
+                                            queue))
+                proc.start()
+                running[next_i] = proc
+                next_i += 1
+
+            try:
+                (task_i, success, result) = queue.get(True, 1.0)
+            except Queue.Empty:
+                # check for workers that died without result
+                for proc in running.values():
+                    if(proc.exitcode):
+                        raise RuntimeError('Worker exited with code %i.' %
+                                           (proc.exitcode))
+                continue
+
+            running.pop(task_i).join()
+            if not(success):
+                raise RuntimeError('Task failed:\n%s' % (result))
+            results[task_i] = result
+            num_done += 1
+    finally:
+        for proc in running.values():
+            proc.terminate()
+            proc.join()
+
+    return results
+
+
+def _run_task(func, task, task_i, queue):
+    try:
+        queue.put((task_i, True, func(task)))
+    except Exception:
+        queue.put((task_i, False, traceback.format_exc()))
 
 
 def ffs(data, target, classifier, n, scoring, param=None, cv=None,
-        feat_names=None, log_f=None, standardize=True, cpu=1):
+        feat_names=None, log_f=None, standardize=True, cpu=1,
+        max_features=None, patience=None, min_improvement=0.0, search=None):
     '''
     Forward feature selection. Grid search that includes parameters and all
     possible combinations of features is to extensive. This method limits
     the amount of explored feature combinations.
+
+    The candidate features of a selection round are scored in parallel (see
+    score_feature_subsets). The selection stops if the maximal score is
+    reached, if max_features features are selected, or if the best score did
+    not improve by more than min_improvement in the last patience rounds.
     '''
     #TODO add all_data_cl
 
@@ -287,10 +1414,12 @@ def ffs(data, target, classifier, n, scoring, param=None, cv=None,
 
     (rand_score, max_score) = metric_rand_max_score[scoring]
 
+    # densify sparse data if the classifier can not handle it
+    data = check_sparse(data, classifier)
+
     if(standardize):
         # create scaler and scale the data with it
-        scaler = preprocessing.StandardScaler().fit(data)
-        data = scaler.transform(data)
+        data = get_scaler(data).transform(data)
 
     # outer CV
     for fold_i, (trn_indices, tst_indices) in enumerate(cv):
@@ -320,64 +1449,48 @@ def ffs(data, target, classifier, n, scoring, param=None, cv=None,
         print
 
         # keep selecting new features as long as:
-        # - the score does not decrease
         # - max score has not been reached
+        # - less than max_features features are selected
+        # - the score improved within the last patience rounds
         # - there are more features left
-        #while((select[-1][0] >= select[-2][0]
-        #        and select[-1][0] < max_score)
-        #        and len(select) - 2 < data.shape[1]):
-        for selection_i in xrange(data.shape[1]):
-
-            # store results for each added feature of this loop
-            results = []
-
-            for feat_i in xrange(data.shape[1]):
-
-                sys.stdout.write('.')
-                if((feat_i + 1) % 80 == 0):
-                    sys.stdout.write('\n')
-                sys.stdout.flush()
-
-                # only try features that are not already selected
-                if not(feat_i in select[-1][2]):
-
-                    # add current feature index to selection (copy)
-                    feat_is = select[-1][2][:]
-                    feat_is.append(feat_i)
-
-                    # slice selected features from data
-                    trn_data_part = trn_data[:, feat_is]
-
-                    if(param):
-
-                        # log to grid search file
-                        if(log_f):
-                            log_f.write('%s' % (str(feat_is)))
-                            if(feat_names):
-                                log_f.write('[%s]' % (', '.join([feat_names[i]
-                                            for i in feat_is])))
-                            log_f.write('\n')
-
-                        # run parameter grid search
-                        (best_s, best_p) = grid_search(
-                            trn_data_part, trn_target, classifier, n, scoring,
-                            param, log_f=log_f, cpu=cpu)
-                    else:
-                        # obtain cv score (grid search not neccasary)
-                        best_p = classifier.get_params()
-                        best_s = numpy.mean(cv_scores_no_scaling(
-                            trn_data_part, trn_target, classifier, n, scoring))
-
-                    # store the result
-                    results.append((best_s, best_p, feat_is))
+        num_rounds = data.shape[1]
+        if(max_features):
+            num_rounds = min(max_features, num_rounds)
+        best_score = rand_score
+        no_improvement = 0
+
+        for selection_i in xrange(num_rounds):
+
+            # add each feature that is not already selected to the selection
+            subsets = [select[-1][2] + [feat_i]
+                       for feat_i in xrange(data.shape[1])
+                       if not(feat_i in select[-1][2])]
+
+            results = score_feature_subsets(
+                trn_data, trn_target, classifier, n, scoring, subsets,
+                param=param, feat_names=feat_names, log_f=log_f, cpu=cpu,
+                base=select[-1][2], search=search)
 
             # obtain the best score of this loop
             winner = sorted(results, key=operator.itemgetter(0))[-1]
 
-            print('\nFeature %i: %s' % (len(select) - 1, str(winner)))
+            print('Feature %i: %s' % (len(select) - 1, str(winner)))
+            sys.stdout.flush()
 
             select.append(winner)
 
+            if(winner[0] > best_score + min_improvement):
+                best_score = winner[0]
+                no_improvement = 0
+            else:
+                no_improvement += 1
+
+            if(winner[0] >= max_score):
+                break
+            if(patience and no_improvement >= patience):
+                print('No improvement in %i rounds.' % (no_improvement))
+                break
+
         # pick the best model (the one before last in the selection)
         #if(len(select) == 3):
         #    (trn_score, bestp, feat_is) = select[2]
@@ -429,14 +1542,29 @@ def ffs(data, target, classifier, n, scoring, param=None, cv=None,
 
 
 def bfs(data, target, classifier, n, scoring, param=None, cv=None,
-        feat_names=None, log_f=None, standardize=True, cpu=1):
+        feat_names=None, log_f=None, standardize=True, cpu=1,
+        elimination='exhaustive', step=1, search=None):
     '''
     Backward feature selection. Grid search that includes parameters and all
     possible combinations of features is to extensive. This method limits
     the amount of explored feature combinations.
+
+    Each round eliminates step features, or a fraction step of the remaining
+    features if step is smaller than 1. With elimination 'exhaustive', the
+    removal of each remaining feature is scored (in parallel, see
+    score_feature_subsets) and the features of which the removal scored best
+    are eliminated. With elimination 'rfe', the remaining features are
+    scored once and the features with the smallest weights in the trained
+    linear classifier are eliminated (see rfe).
+
+    Raises:
+        ValueError: If elimination is not 'exhaustive' or 'rfe'.
     '''
     # TODO add all_data_cl
 
+    if not(elimination in ['exhaustive', 'rfe']):
+        raise ValueError('Unknown elimination: %s' % (elimination))
+
     if(feat_names):
         assert(data.shape[1] == len(feat_names))
 
@@ -456,10 +1584,12 @@ def bfs(data, target, classifier, n, scoring, param=None, cv=None,
 
     (rand_score, max_score) = metric_rand_max_score[scoring]
 
+    # densify sparse data if the classifier can not handle it
+    data = check_sparse(data, classifier)
+
     if(standardize):
         # create scaler and scale the data with it
-        scaler = preprocessing.StandardScaler().fit(data)
-        data = scaler.transform(data)
+        data = get_scaler(data).transform(data)
 
     # outer CV
     for fold_i, (trn_indices, tst_indices) in enumerate(cv):
@@ -488,59 +1618,52 @@ def bfs(data, target, classifier, n, scoring, param=None, cv=None,
         print 'FEATURE SELECTION CV-LOOP %i' % (fold_i)
         print
 
-        # for now, let's test until we are at a single feature
-        for selection_i in xrange(data.shape[1] - 1):
-
-            # store results for each added feature of this loop
-            results = []
-
-            for feat_i in xrange(data.shape[1]):
-
-                sys.stdout.write('.')
-                if((feat_i + 1) % 80 == 0):
-                    sys.stdout.write('\n')
-                sys.stdout.flush()
-
-                # only try features that are not already selected
-                if not(feat_i in select[-1][2]):
+        if(elimination == 'rfe'):
+            select.extend(rfe(trn_data, trn_target, classifier, n, scoring,
+                              step, param=param, feat_names=feat_names,
+                              log_f=log_f, cpu=cpu, search=search))
 
-                    # add current feature index to selection (copy)
-                    remove_is = select[-1][2][:]
-                    remove_is.append(feat_i)
-
-                    feat_is = [fi for fi in xrange(data.shape[1])
-                               if not fi in remove_is]
-
-                    # slice selected features from data
-                    trn_data_part = trn_data[:, feat_is]
-
-                    if(param):
-
-                        # log to grid search file
-                        if(log_f):
-                            log_f.write('%s' % (str(feat_is)))
-                            if(feat_names):
-                                log_f.write('[%s]' % (', '.join([feat_names[i]
-                                            for i in feat_is])))
-                            log_f.write('\n')
-
-                        # run parameter grid search
-                        (best_s, best_p) = grid_search(
-                            trn_data_part, trn_target, classifier, n, scoring,
-                            param, log_f=log_f, cpu=cpu)
-                    else:
-                        # obtain cv score (grid search not neccasary)
-                        best_p = classifier.get_params()
-                        best_s = numpy.mean(cv_scores_no_scaling(
-                            trn_data_part, trn_target, classifier, n, scoring))
-
-                    # store the result
-                    results.append((best_s, best_p, remove_is))
-
-            # obtain the best score of this loop
-            winner = sorted(results, key=operator.itemgetter(0))[-1]
-
-            print('\nFeature %i: %s' % (len(select) - 1, str(winner)))
+        # for now, let's test until we are at a single feature
+        while(elimination == 'exhaustive' and
+                len(select[-1][2]) < data.shape[1] - 1):
+
+            # remove each feature that is not already removed
+            removed = set(select[-1][2])
+            base = [fi for fi in xrange(data.shape[1]) if not(fi in removed)]
+            remove_iss = [select[-1][2] + [feat_i] for feat_i in base]
+            subsets = [[fi for fi in base if not(fi == feat_i)]
+                       for feat_i in base]
+
+            results = score_feature_subsets(
+                trn_data, trn_target, classifier, n, scoring, subsets,
+                param=param, feat_names=feat_names, log_f=log_f, cpu=cpu,
+                base=base, search=search)
+            results = [(best_s, best_p, remove_is) for
+                       ((best_s, best_p, feat_is), remove_is) in
+                       zip(results, remove_iss)]
+
+            num_removed = _num_eliminated(step, len(base))
+
+            if(num_removed == 1):
+                # obtain the best score of this loop
+                winner = sorted(results, key=operator.itemgetter(0))[-1]
+            else:
+                # eliminate the features of which the removal scored best,
+                # and score the remaining features
+                order = sorted(range(len(results)),
+                               key=lambda i: results[i][0])
+                remove_is = (select[-1][2] +
+                             [base[i] for i in order[::-1][:num_removed]])
+                removed = set(remove_is)
+                feat_is = [fi for fi in base if not(fi in removed)]
+                (best_s, best_p, _) = score_feature_subsets(
+                    trn_data, trn_target, classifier, n, scoring, [feat_is],
+                    param=param, feat_names=feat_names, log_f=log_f,
+                    cpu=cpu, search=search)[0]
+                winner = (best_s, best_p, remove_is)
+
+            print('Feature %i: %s' % (len(select) - 1, str(winner)))
+            sys.stdout.flush()
 
             select.append(winner)
 
@@ -596,23 +1719,94 @@ def bfs(data, target, classifier, n, scoring, param=None, cv=None,
             cv_featis, predictions)
 
 
-def classify(data, classifier):
+def rfe(data, target, classifier, n, scoring, step, param=None,
+        feat_names=None, log_f=None, cpu=1, search=None):
+    '''
+    Recursive feature elimination. The remaining features are scored (with
+    a grid search if parameters are provided), the classifier is trained on
+    them with the best parameters, and the step features (or fraction step
+    of the features if step is smaller than 1) with the smallest weights are
+    eliminated, until a single feature is left.
 
-    # prediction class labels on data set
-    pred = classifier.predict(data)
+    Returns a list with (cv score, parameters, eliminated feature indices)
+    per round, the eliminated features are those before the round.
 
-    # and predict probabilities (if possible)
-    if(hasattr(classifier, 'predict_proba')):
-        proba = classifier.predict_proba(data)
-        # get the probabilities of class one
-        # TODO this only works for 2-class problems...
-        proba = proba[:, 1]
-    elif(hasattr(classifier, 'decision_function')):
-        proba = classifier.decision_function(data)
+    Raises:
+        ValueError: If the classifier has no feature weights.
+    '''
+
+    rounds = []
+    remove_is = []
+
+    while(True):
+
+        removed = set(remove_is)
+        feat_is = [fi for fi in xrange(data.shape[1]) if not(fi in removed)]
+
+        (best_s, best_p, _) = score_feature_subsets(
+            data, target, classifier, n, scoring, [feat_is], param=param,
+            feat_names=feat_names, log_f=log_f, cpu=cpu, search=search)[0]
+        rounds.append((best_s, best_p, remove_is[:]))
+
+        print('Features %i: %.3f' % (len(feat_is), best_s))
+        sys.stdout.flush()
+
+        if(len(feat_is) == 1):
+            break
+
+        # train classifier with the best parameters on the remaining features
+        classifier_param = classifier.get_params()
+        classifier_param.update(best_p)
+        cl = type(classifier)(**classifier_param)
+        cl.fit(data[:, feat_is], target)
+
+        weights = feature_weights(cl, len(feat_is))
+        if(weights is None):
+            raise ValueError('Recursive feature elimination requires a '
+                             'linear classifier with feature weights.')
+
+        # eliminate the features with the smallest weights
+        num_removed = _num_eliminated(step, len(feat_is))
+        order = numpy.argsort(weights, kind='mergesort')
+        remove_is.extend([feat_is[i] for i in order[:num_removed]])
+
+    return rounds
+
+
+def feature_weights(classifier, num_feats):
+    '''
+    This function returns the weight per feature of a trained linear
+    classifier, the sum over the classes of the squared coefficients, or None
+    if the classifier has no coefficients per feature.
+    '''
+    try:
+        coef = classifier.coef_
+    except (AttributeError, ValueError):
+        return None
+    if(sparse.issparse(coef)):
+        coef = coef.toarray()
+    coef = numpy.atleast_2d(numpy.asarray(coef, dtype=float))
+    if not(coef.shape[1] == num_feats):
+        return None
+    return (coef ** 2).sum(axis=0)
+
+
+def _num_eliminated(step, num_feats):
+    '''
+    This function returns the number of features that is eliminated from
+    num_feats features, step features or a fraction step of them, at least
+    one and at most all but one.
+    '''
+    if(step < 1):
+        num_removed = int(step * num_feats)
     else:
-        proba = pred
+        num_removed = int(step)
+    return min(max(1, num_removed), num_feats - 1)
 
-    return (pred, proba)
+
+def classify(data, classifier):
+    # see predictor.classify, which does not require sklearn
+    return predictor.classify(data, classifier)
 
 
 def test_classifier(tst_data, tst_target, classifier, scoring):
@@ -674,6 +1868,152 @@ def test_classifier(tst_data, tst_target, classifier, scoring):
 #
 
 
+def check_sparse(data, classifier):
+    '''
+    This function returns data as is if it is dense or if the classifier can
+    be trained on sparse data. Otherwise a dense copy of data is returned.
+    '''
+    if(sparse.issparse(data) and
+            not isinstance(classifier, sparse_classifier_types)):
+        return data.toarray()
+    return data
+
+
+def get_scaler(data, standardize=True):
+    '''
+    This function returns a StandardScaler fitted on data. Sparse data is only
+    scaled, centering would make it dense. If standardize is False, a scaler
+    that does not change the data is returned, so that the returned scaler
+    can always be applied to new data.
+    '''
+    with_mean = standardize and not sparse.issparse(data)
+    return preprocessing.StandardScaler(with_mean=with_mean,
+                                        with_std=standardize).fit(data)
+
+
+def export_predictor(classifier, scaler, data, f):
+    '''
+    This function compiles the trained classifier and the scaler of its
+    training data into plain numpy parameters (see spice.predictor) and
+    stores them in file f, so that the classifier can be applied without
+    sklearn. Supported are the linear classifiers (linearsvc, svc_linear,
+    lda), nearest centroid (nc), and gaussian naive bayes (gnb).
+
+    The compiled predictor is only stored if it reproduces the predictions
+    and probabilities of the classifier on (a sample of) the unscaled data
+    rows in data. An existing file f is removed otherwise, so that the
+    classifier is loaded from its joblib file.
+
+    Returns True if the predictor was stored, False otherwise.
+    '''
+
+    if(os.path.exists(f)):
+        os.remove(f)
+
+    # validation sample, evenly spread over the data rows
+    num_rows = min(data.shape[0], EXPORT_VALIDATION_ROWS)
+    rows = numpy.unique(numpy.linspace(0, data.shape[0] - 1,
+                                       num_rows).astype(int))
+    data = check_sparse(data[rows], classifier)
+    num_feats = data.shape[1]
+
+    # the scaler is feature-wise affine, obtain its offset and scale
+    offset = scaler.transform(numpy.zeros((1, num_feats)))[0]
+    scale = scaler.transform(numpy.ones((1, num_feats)))[0] - offset
+    compiled_scaler = predictor.Scaler(scale, offset)
+
+    (ref_pred, ref_proba) = classify(scaler.transform(data), classifier)
+    ref_proba = numpy.ravel(ref_proba)
+    compiled_data = compiled_scaler.transform(data)
+
+    compiled = _compiled_classifier(classifier, num_feats)
+    if(compiled is None):
+        return False
+
+    (pred, proba) = classify(compiled_data, compiled)
+    proba = numpy.ravel(proba)
+
+    if(numpy.array_equal(pred, ref_pred) and
+            proba.shape == ref_proba.shape and
+            numpy.allclose(proba, ref_proba, rtol=1e-4, atol=1e-6)):
+        predictor.save_predictor(f, compiled, compiled_scaler)
+        return True
+
+    return False
+
+
+def _compiled_classifier(classifier, num_feats):
+    '''
+    This function returns the compiled classifier that is equivalent to
+    classifier, or None if its type is not supported. The linear decision
+    function, the class it predicts, and the probability sigmoid are obtained
+    from the fitted attributes of the classifier.
+    '''
+
+    classes = classifier.classes_
+
+    if(isinstance(classifier, svm.SVC) and classifier.kernel == 'linear'):
+
+        # only the two-class libsvm model is a single linear function
+        if not(len(classes) == 2):
+            return None
+
+        # libsvm model, sklearn > 0.14 stores it with flipped signs
+        dual_coef = getattr(classifier, '_dual_coef_', classifier.dual_coef_)
+        intercept = getattr(classifier, '_intercept_', classifier.intercept_)
+        support_vectors = classifier.support_vectors_
+        if(sparse.issparse(dual_coef)):
+            dual_coef = dual_coef.toarray()
+        if(sparse.issparse(support_vectors)):
+            support_vectors = support_vectors.toarray()
+        coef = numpy.dot(dual_coef, support_vectors).T
+        intercept = numpy.ravel(intercept)
+
+        # positive libsvm decision values predict the first class, and platt
+        # scaling gives the probability of the first class as
+        # 1 / (1 + exp(a * dec + b))
+        probA = getattr(classifier, 'probA_', [])
+        if(len(probA)):
+            sigmoid = (-float(probA[0]), -float(classifier.probB_[0]))
+            return predictor.ProbabilisticLinearClassifier(
+                classes, coef, intercept, 0, sigmoid, coupling=True)
+        return predictor.LinearClassifier(classes, coef, intercept, 0)
+
+    elif(isinstance(classifier, svm.LinearSVC)):
+        coef = numpy.atleast_2d(classifier.coef_).T
+        return predictor.LinearClassifier(classes, coef,
+                                          numpy.ravel(classifier.intercept_))
+
+    elif(isinstance(classifier, lda.LDA)):
+
+        coef = numpy.atleast_2d(classifier.coef_).T
+        intercept = numpy.ravel(classifier.intercept_)
+
+        # sklearn 0.14 defines coef_ in the discriminant space
+        # (data - xbar_) . scalings_, transform it to the feature space
+        if not(hasattr(classifier, 'solver')):
+            coef = numpy.dot(classifier.scalings_, coef)
+            intercept = intercept - numpy.dot(classifier.xbar_, coef)
+
+        # softmax of the decision values, or the logistic function of a
+        # single decision column
+        return predictor.ProbabilisticLinearClassifier(classes, coef,
+                                                       intercept)
+
+    elif(isinstance(classifier, neighbors.NearestCentroid) and
+            getattr(classifier, 'metric', 'euclidean') == 'euclidean'):
+        return predictor.CentroidClassifier(classes, classifier.centroids_)
+
+    elif(isinstance(classifier, naive_bayes.GaussianNB)):
+        sigma = getattr(classifier, 'sigma_', None)
+        if(sigma is None):
+            sigma = classifier.var_
+        return predictor.GaussianNBClassifier(classes, classifier.theta_,
+                                              sigma, classifier.class_prior_)
+
+    return None
+
+
 def parse_feature_file(feature_f):
     '''
     Contains list of features to be tested per line in file. The first word
@@ -686,6 +2026,171 @@ def parse_feature_file(feature_f):
             feature_experiments.append((tokens[0], tokens[1:]))
     return feature_experiments
 
+
+def estimate_runtime(data, target, classifier, n, param=None,
+                     feature_selection='none', cpu=1, search=None,
+                     max_features=None, elimination='exhaustive', step=1):
+    '''
+    This function returns the estimated runtime (seconds) of a classification
+    experiment, cv_score, ffs, or bfs with the same arguments. The cost of a
+    fit is modeled as c * num_objects^a * num_feats^b, with c, a, and b
+    obtained from a few timed fits on subsamples of data (see
+    _benchmark_cost). The cost is summed over the fits of the outer and inner
+    CV folds, the grid points, and the feature subsets that are scored by
+    the feature selection. Early stopping of the feature selection and the
+    distance and kernel caches are not taken into account, and the cpu
+    workers are assumed to give a linear speedup.
+    '''
+
+    search = search or {}
+    halving = search.get('halving', False)
+    timeout = search.get('timeout', None)
+
+    (num_objects, num_feats) = data.shape
+    num_configs = len(ParameterGrid(param)) if param else 0
+    cost = _benchmark_cost(data, target, classifier, param)
+
+    # number of train objects of the outer CV folds
+    num_trn = num_objects * (n - 1) // n
+
+    def search_time(num_objects, num_feats, num_configs):
+        return _search_time(cost, num_objects, num_feats, num_configs, n,
+                            halving, timeout)
+
+    if(feature_selection == 'ffs'):
+
+        # in round k, all remaining features are added to k - 1 features
+        num_rounds = min(max_features or num_feats, num_feats)
+        fold_time = sum([(num_feats - k + 1) *
+                         search_time(num_trn, k, max(1, num_configs))
+                         for k in xrange(1, num_rounds + 1)])
+        fold_time += _fit_time(cost, num_trn, num_rounds)
+        total = n * fold_time
+
+    elif(feature_selection == 'bfs'):
+
+        fold_time = 0.0
+        k = num_feats
+        while(k > 1):
+            if(elimination == 'rfe'):
+                # score the remaining features, fit for the weights
+                fold_time += (search_time(num_trn, k, max(1, num_configs)) +
+                              _fit_time(cost, num_trn, k))
+            else:
+                # score the removal of each remaining feature
+                fold_time += k * search_time(num_trn, k - 1,
+                                             max(1, num_configs))
+            k -= _num_eliminated(step, k)
+        fold_time += _fit_time(cost, num_trn, num_feats)
+        total = n * fold_time
+
+    else:
+
+        # outer folds and the refit on all objects
+        total = (n * (search_time(num_trn, num_feats, num_configs) +
+                      _fit_time(cost, num_trn, num_feats)) +
+                 search_time(num_objects, num_feats, num_configs) +
+                 _fit_time(cost, num_objects, num_feats))
+
+    return total / max(1, cpu)
+
+
+def _search_time(cost, num_objects, num_feats, num_configs, n, halving=False,
+                 timeout=None):
+    '''
+    This function returns the estimated time of the n-fold CV of num_configs
+    parameter configurations on num_objects objects, with the rungs of
+    halving_search if halving is set, see estimate_runtime.
+    '''
+
+    if(num_configs == 0):
+        return 0.0
+
+    rung_sizes = [num_objects]
+    if(halving or timeout):
+        num_rungs = 1
+        while(halving_factor ** (num_rungs - 1) < num_configs):
+            num_rungs += 1
+        rung_sizes = [max(2 * n, num_objects //
+                          halving_factor ** (num_rungs - 1 - rung_i))
+                      for rung_i in xrange(num_rungs)]
+
+    total = 0.0
+    for rung_size in rung_sizes:
+        total += num_configs * n * _fit_time(
+            cost, min(rung_size, num_objects) * (n - 1) // n, num_feats)
+        num_configs = max(1, int(numpy.ceil(num_configs /
+                                            float(halving_factor))))
+
+    if(timeout):
+        total = min(total, timeout)
+
+    return total
+
+
+def _fit_time(cost, num_objects, num_feats):
+    (c, a, b) = cost
+    return c * max(1, num_objects) ** a * max(1, num_feats) ** b
+
+
+def _benchmark_cost(data, target, classifier, param=None):
+    '''
+    This function times fits of the classifier, with the middle value of each
+    grid parameter, on a stratified subsample of BENCHMARK_OBJECTS objects,
+    on half of it, and on a quarter of the features. Returns (c, a, b) of the
+    fit time c * num_objects^a * num_feats^b, with a clipped to [1, 3] and b
+    to [0, 1].
+    '''
+
+    classifier_param = classifier.get_params()
+    for key, values in (param or {}).iteritems():
+        classifier_param[key] = sorted(values)[len(values) // 2]
+    cl = type(classifier)(**classifier_param)
+
+    (num_objects, num_feats) = data.shape
+    size = min(num_objects, BENCHMARK_OBJECTS)
+    half_size = max(size // 2, 2 * len(numpy.unique(target)))
+    few_feats = max(1, num_feats // 4)
+
+    object_is = _stratified_sample(target, size)
+    sample = data[object_is, :]
+    sample_target = target[object_is]
+    time_all = _time_fit(cl, sample, sample_target)
+
+    # number of objects exponent
+    a = 2.0
+    if(half_size < size):
+        half_is = _stratified_sample(sample_target, half_size)
+        time_half = _time_fit(cl, sample[half_is, :], sample_target[half_is])
+        a = numpy.log(time_all / time_half) / numpy.log(
+            float(size) / half_size)
+        a = min(3.0, max(1.0, a))
+
+    # number of features exponent
+    b = 1.0
+    if(few_feats < num_feats):
+        time_few = _time_fit(cl, sample[:, :few_feats], sample_target)
+        b = numpy.log(time_all / time_few) / numpy.log(
+            float(num_feats) / few_feats)
+        b = min(1.0, max(0.0, b))
+
+    return (time_all / (size ** a * num_feats ** b), a, b)
+
+
+def _time_fit(classifier, data, target):
+    '''
+    This function returns the average time of fitting the classifier on data
+    and predicting data, repeated for at least BENCHMARK_MIN_TIME seconds.
+    '''
+    start_time = time.time()
+    num_fits = 0
+    while(num_fits == 0 or (time.time() - start_time < BENCHMARK_MIN_TIME and
+                            num_fits < 100)):
+        classifier.fit(data, target)
+        classifier.predict(data)
+        num_fits += 1
+    return max(1e-6, (time.time() - start_time) / num_fits)
+
 '''
 def get_timed_parameter_range(classifier, data, target, standardize,
                               time_limit, param_name, param_range=None):
@@ -3,25 +3,37 @@
 import os
 import sys
 
-# HACK TODO remove if sklearn is updated to 0.14 on compute servers...
-import sklearn
-if not(sklearn.__version__ == '0.14.1'):
-    sys.path.insert(1, os.environ['SKL'])
-    reload(sklearn)
-assert(sklearn.__version__ == '0.14.1')
+import numpy
 
-from sklearn.externals import joblib
-
-from spice import classification
-from spice import featmat
+from spice import predictor
 from biopy import file_io
 
+# sklearn and the spice modules that depend on it are only imported if they
+# are needed, so that compiled classifiers (see spice.predictor) can be
+# applied without sklearn
+
+
+# number of objects that is classified at once, and the number of sequences
+# for which the features are calculated at once
+CHUNK_SIZE = 10000
+SEQUENCE_CHUNK_SIZE = 1000
 
-def classify(fm_dir, cl_dir):
+
+def classify(fm_dir, cl_dir, chunk_size=CHUNK_SIZE):
     '''
     PRE: required features are available in fe_dir!
+
+    The data is standardized with the scaler that was used for the training
+    data of the classifier. Older classifier directories without scaler file
+    are standardized using the statistics of the data itself.
+
+    The objects are classified in chunks of chunk_size objects, with the
+    dense feature matrix blocks memory-mapped, and the predictions are
+    written after each chunk.
     '''
 
+    from spice import featmat
+
     f_pre = os.path.basename(os.path.dirname(os.path.dirname(fm_dir)))
 
     # create dir to store the classification output and feature calc...
@@ -29,29 +41,217 @@ def classify(fm_dir, cl_dir):
     if not(os.path.exists(out_dir)):
         os.makedirs(out_dir)
 
+    # load trained classifier, its scaler, and the feature ids that were
+    # used to train the classifier
+    (classifier, scaler, feature_ids) = load_classifier(cl_dir)
+
+    # obtain feature matrix
+    fm = featmat.FeatureMatrix.load_from_dir(fm_dir, mmap_mode='r')
+    feat_is = fm.feature_indices(feature_ids)
+    num_objects = len(fm.object_ids)
+
+    if(scaler is None):
+        print 'No scaler available, data is standardized on its own.'
+        from spice import classification
+        data = classification.check_sparse(
+            fm.slice(feat_is, range(num_objects)), classifier)
+        scaler = classification.get_scaler(data)
+
+    pred_f = os.path.join(out_dir, '%s_pred.txt' % (f_pre))
+    proba_f = os.path.join(out_dir, '%s_proba.txt' % (f_pre))
+
+    with open(pred_f, 'w') as pred_out, open(proba_f, 'w') as proba_out:
+
+        for start in xrange(0, num_objects, chunk_size):
+
+            end = min(start + chunk_size, num_objects)
+
+            # densify sparse data if the classifier can not handle it
+            data = _check_sparse(
+                fm.slice(feat_is, numpy.arange(start, end)), classifier)
+            data = scaler.transform(data)
+
+            # run classify method
+            preds, probas = predictor.classify(data, classifier)
+
+            object_ids = fm.object_ids[start:end]
+            for oid, pred, proba in zip(object_ids, preds, probas):
+                pred_out.write('%s\t%s\n' % (oid, str(pred)))
+                proba_out.write('%s\t%s\n' % (oid, str(proba)))
+            pred_out.flush()
+            proba_out.flush()
+
+def load_classifier(cl_dir):
+    '''
+    This function loads the trained classifier in classifier directory
+    cl_dir, together with the scaler of its training data (None if not
+    available) and the list of feature ids that the classifier uses.
+
+    If the classifier was exported to plain numpy parameters, the compiled
+    classifier and scaler are loaded (see spice.predictor), which does not
+    require unpickling sklearn objects. Otherwise the joblib files are used.
+    '''
+
     # read feature ids that were used to train the classifier
     cl_settings_f = os.path.join(cl_dir, 'settings.txt')
     settings_dict = file_io.read_settings_dict(cl_settings_f)
     feature_ids = settings_dict['feature_names']
 
-    # obtain feature matrix STANDARDIZED DATA
-    fm = featmat.FeatureMatrix.load_from_dir(fm_dir)
-    feat_is = fm.feature_indices(feature_ids)
-    object_is = range(len(fm.object_ids))
-    data = fm.standardized_slice(feat_is, object_is)
+    # load the compiled classifier and scaler, if available
+    predictor_f = os.path.join(cl_dir, 'predictor.npz')
+    if(os.path.exists(predictor_f)):
+        (classifier, scaler) = predictor.load_predictor(predictor_f)
+        return (classifier, scaler, feature_ids)
+
+    # HACK TODO remove if sklearn is updated to 0.14 on compute servers...
+    import sklearn
+    if not(sklearn.__version__ == '0.14.1'):
+        sys.path.insert(1, os.environ['SKL'])
+        reload(sklearn)
+    assert(sklearn.__version__ == '0.14.1')
+
+    from sklearn.externals import joblib
 
     # load trained classifier
     cl_f = os.path.join(cl_dir, 'classifier.joblib.pkl')
     classifier = joblib.load(cl_f)
 
-    # run classify method
-    preds, probas = classification.classify(data, classifier)
+    # load the scaler of the training data
+    scaler_f = os.path.join(cl_dir, 'scaler.joblib.pkl')
+    if(os.path.exists(scaler_f)):
+        scaler = joblib.load(scaler_f)
+    else:
+        scaler = None
 
-    pred_f = os.path.join(out_dir, '%s_pred.txt' % (f_pre))
-    proba_f = os.path.join(out_dir, '%s_proba.txt' % (f_pre))
+    return (classifier, scaler, feature_ids)
+
+
+def classifier_files(cl_dir):
+    '''
+    This function returns the files in classifier directory cl_dir that are
+    loaded by load_classifier.
+    '''
+
+    files = [os.path.join(cl_dir, 'settings.txt')]
+
+    predictor_f = os.path.join(cl_dir, 'predictor.npz')
+    if(os.path.exists(predictor_f)):
+        files.append(predictor_f)
+    else:
+        files.append(os.path.join(cl_dir, 'classifier.joblib.pkl'))
+        scaler_f = os.path.join(cl_dir, 'scaler.joblib.pkl')
+        if(os.path.exists(scaler_f)):
+            files.append(scaler_f)
+
+    return files
+
+
+def sequence_features(sequences, feature_ids):
+    '''
+    This function calculates the provided protein features for a list of
+    (protein id, protein sequence) tuples. Only the feature categories of the
+    requested features are calculated, in memory. The feature values are
+    returned with the columns in the order of feature_ids, as sparse matrix
+    if all features are sparse (see FeatureMatrix.slice).
+
+    Raises:
+        ValueError: If a feature requires other data than the sequence.
+    '''
+
+    from spice import featext
+
+    featcat_ids = featext.FeatureExtraction.protein_featcat_ids(feature_ids)
+    if not(featext.FeatureExtraction.sequence_based(featcat_ids)):
+        raise ValueError('Features can not be calculated from the protein '
+                         'sequence only.')
+
+    fe = featext.FeatureExtraction()
+    fe.set_protein_ids([str(pid) for pid, seq in sequences])
+    fe.protein_data_set.set_data_source(
+        'prot_seq', [(str(pid), str(seq)) for pid, seq in sequences])
+
+    for featcat_id in featcat_ids:
+        fe.calculate_protein_features(featcat_id)
+
+    fm = fe.fm_protein
+    return fm.slice(fm.feature_indices(feature_ids),
+                    range(len(fm.object_ids)))
+
+
+def classify_fasta(fasta_f, cl_dir, name=None, chunk_size=SEQUENCE_CHUNK_SIZE):
+    '''
+    This function classifies the protein sequences in fasta file fasta_f with
+    the trained classifier in classifier directory cl_dir, without storing a
+    feature matrix. Only the features used by the classifier are calculated,
+    in memory, for chunks of chunk_size sequences. The features are scaled
+    with the scaler of the training data, and the predictions are written
+    after each chunk to the class_output dir, using the file name prefix
+    name (the fasta file name by default).
+
+    Raises:
+        ValueError: If a feature requires other data than the sequence.
+        ValueError: If no scaler is available for the classifier.
+    '''
+
+    if(name is None):
+        name = os.path.splitext(os.path.basename(fasta_f))[0]
+
+    # create dir to store the classification output
+    out_dir = os.path.join(cl_dir, 'class_output')
+    if not(os.path.exists(out_dir)):
+        os.makedirs(out_dir)
+
+    # load trained classifier, its scaler, and its feature ids
+    (classifier, scaler, feature_ids) = load_classifier(cl_dir)
+
+    if(scaler is None):
+        raise ValueError('No scaler available for this classifier.')
+
+    pred_f = os.path.join(out_dir, '%s_pred.txt' % (name))
+    proba_f = os.path.join(out_dir, '%s_proba.txt' % (name))
+
+    with open(pred_f, 'w') as pred_out, open(proba_f, 'w') as proba_out:
+
+        sequences = []
+        for seq_tuple in file_io.read_fasta(fasta_f):
+
+            sequences.append(seq_tuple)
+
+            if(len(sequences) == chunk_size):
+                _classify_sequences(sequences, feature_ids, classifier,
+                                    scaler, pred_out, proba_out)
+                sequences = []
+
+        if(sequences):
+            _classify_sequences(sequences, feature_ids, classifier, scaler,
+                                pred_out, proba_out)
+
+
+def _classify_sequences(sequences, feature_ids, classifier, scaler, pred_out,
+                        proba_out):
+
+    data = sequence_features(sequences, feature_ids)
+
+    # densify sparse data if the classifier can not handle it
+    data = _check_sparse(data, classifier)
+    preds, probas = predictor.classify(scaler.transform(data), classifier)
+
+    for (pid, seq), pred, proba in zip(sequences, preds, probas):
+        pred_out.write('%s\t%s\n' % (pid, str(pred)))
+        proba_out.write('%s\t%s\n' % (pid, str(proba)))
+    pred_out.flush()
+    proba_out.flush()
+
+
+def _check_sparse(data, classifier):
+
+    # the compiled classifiers handle sparse data themselves
+    if(isinstance(classifier, predictor.CLASSIFIER_TYPES)):
+        return data
+
+    from spice import classification
+    return classification.check_sparse(data, classifier)
 
-    file_io.write_tuple_list(pred_f, zip(fm.object_ids, preds))
-    file_io.write_tuple_list(proba_f, zip(fm.object_ids, probas))
 
 #if __name__ == '__main__':
 # TODO add test runs
@@ -10,6 +10,7 @@
 import os
 
 import numpy
+from scipy import sparse
 
 from spice import featmat
 from spice import data_set
@@ -383,14 +384,30 @@ class FeatureExtraction(object):
     assert(sorted(MUTATION_FEATURE_CATEGORY_IDS) ==
            sorted(MUTATION_FEATURE_CATEGORIES.keys()))
 
-    def __init__(self):
+    # feature categories with integer values (counts and indicators), these
+    # are stored as integer column blocks if this is lossless
+    INTEGER_FEATURE_CATEGORY_IDS = [
+        'teraac', 'len', 'mutvec', 'seqenv', 'pfam', 'interaction',
+        'codonvec', 'codonenv'
+    ]
+
+    # feature categories with mostly zero values, these are stored as sparse
+    # column blocks
+    SPARSE_FEATURE_CATEGORY_IDS = [
+        'dc', 'cc', 'cu', 'codonvec', 'codonenv'
+    ]
+
+    def __init__(self, dtype=None):
 
         # define file location if we want to store data
         self.root_dir = None
 
+        # storage type of the feature matrices (float32 if None)
+        self.dtype = dtype
+
         # initialize empty feature matrices
-        self.fm_protein = featmat.FeatureMatrix()
-        self.fm_missense = featmat.FeatureMatrix()
+        self.fm_protein = featmat.FeatureMatrix(dtype)
+        self.fm_missense = featmat.FeatureMatrix(dtype)
 
         # initialize protein data set
         self.protein_data_set = data_set.ProteinDataSet()
@@ -490,14 +507,13 @@ class FeatureExtraction(object):
         # append feature id to feature category id
         feat_ids = ['%s_%s' % (featcat_id, i) for i in ids]
 
-        # initialize empty feature matrix
-        fm = numpy.empty((len(self.fm_protein.object_ids), len(feat_ids)))
-
-        # fill the matrix
-        for index, o in enumerate(self.protein_data_set.get_proteins()):
-            fm[index, :] = featcat.feature_func(o, *args)
+        # calculate the feature values
+        fm = self._feature_block(fc_id, featcat, args,
+                                 self.protein_data_set.get_proteins(),
+                                 len(feat_ids), self.fm_protein.dtype)
 
-        self.fm_protein.add_features(feat_ids, fm, feature_names=names)
+        self.fm_protein.add_features(feat_ids, fm, feature_names=names,
+                                     dtype=self._block_dtype(fc_id, fm))
 
     def calculate_missense_features(self, featcat_id):
 
@@ -532,14 +548,65 @@ class FeatureExtraction(object):
         # append feature id to feature category id
         feat_ids = ['%s_%s' % (featcat_id, i) for i in ids]
 
-        # initialize empty feature matrix
-        fm = numpy.empty((len(self.fm_missense.object_ids), len(feat_ids)))
+        # calculate the feature values
+        fm = self._feature_block(fc_id, featcat, args,
+                                 self.protein_data_set.get_mutations(),
+                                 len(feat_ids), self.fm_missense.dtype)
+
+        self.fm_missense.add_features(feat_ids, fm, feature_names=names,
+                                      dtype=self._block_dtype(fc_id, fm))
+
+    def _feature_block(self, fc_id, featcat, args, objects, num_features,
+                       dtype):
+        '''
+        This function calculates the feature values of category fc_id for
+        each of the objects. Sparse feature categories are collected row by
+        row in a sparse (CSR) matrix, without creating a dense matrix first.
+        '''
+
+        if(fc_id in self.SPARSE_FEATURE_CATEGORY_IDS):
+
+            if(len(objects) == 0):
+                return sparse.csr_matrix((0, num_features), dtype=dtype)
+
+            data = []
+            indices = []
+            indptr = [0]
+
+            # store the non-zero values of each row
+            for o in objects:
+                row = numpy.asarray(featcat.feature_func(o, *args),
+                                    dtype=dtype)
+                nonzero = numpy.flatnonzero(row)
+                data.append(row[nonzero])
+                indices.append(nonzero)
+                indptr.append(indptr[-1] + len(nonzero))
+
+            return sparse.csr_matrix(
+                (numpy.concatenate(data), numpy.concatenate(indices), indptr),
+                shape=(len(indptr) - 1, num_features))
+
+        else:
+
+            # initialize empty feature matrix
+            fm = numpy.empty((len(objects), num_features), dtype=dtype)
 
-        # fill the matrix
-        for index, m in enumerate(self.protein_data_set.get_mutations()):
-            fm[index, :] = featcat.feature_func(m, *args)
+            # fill the matrix
+            for index, o in enumerate(objects):
+                fm[index, :] = featcat.feature_func(o, *args)
 
-        self.fm_missense.add_features(feat_ids, fm, feature_names=names)
+            return fm
+
+    def _block_dtype(self, fc_id, fm):
+        '''
+        This function returns the type used to store the feature values fm of
+        feature category fc_id. Integer feature categories are stored with the
+        smallest integer type that stores the values without loss.
+        '''
+        if(fc_id in self.INTEGER_FEATURE_CATEGORY_IDS):
+            return featmat.compact_dtype(fm, fm.dtype)
+        else:
+            return fm.dtype
 
     def available_protein_featcat_ids(self):
         '''
@@ -558,6 +625,35 @@ class FeatureExtraction(object):
 
         return featcat_ids
 
+    @classmethod
+    def protein_featcat_ids(cls, feature_ids):
+        '''
+        This function returns the sorted list of protein feature category ids,
+        including the category parameters (e.g. aac_2), of the provided
+        feature ids.
+        '''
+        featcat_ids = set()
+        for f in feature_ids:
+            parts = f.split('_')
+            if(len(parts) < 3):
+                featcat_ids.add('_'.join(parts[:1]))
+            else:
+                featcat_ids.add('_'.join(parts[:2]))
+        return sorted(featcat_ids)
+
+    @classmethod
+    def sequence_based(cls, featcat_ids):
+        '''
+        This function returns True if the provided protein feature categories
+        can be calculated using only the protein sequence.
+        '''
+        for featcat_id in featcat_ids:
+            featcat = cls.PROTEIN_FEATURE_CATEGORIES[featcat_id.split('_')[0]]
+            for (data_func, required) in featcat.required_data:
+                if not(data_func == protein.Protein.get_protein_sequence):
+                    return False
+        return True
+
     def categorized_protein_feature_ids(self):
         '''
         This function returns all feature ids sorted by feature category and
@@ -601,10 +697,12 @@ class FeatureExtraction(object):
         assert(self.root_dir)
 
         # load the feature matrices
-        fmp = featmat.FeatureMatrix.load_from_dir(self.fm_protein_d)
+        fmp = featmat.FeatureMatrix.load_from_dir(self.fm_protein_d,
+                                                  self.dtype)
         self.fm_protein = fmp
 
-        fmm = featmat.FeatureMatrix.load_from_dir(self.fm_missense_d)
+        fmm = featmat.FeatureMatrix.load_from_dir(self.fm_missense_d,
+                                                  self.dtype)
         self.fm_missense = fmm
 
         # load protein data set
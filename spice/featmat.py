@@ -8,8 +8,10 @@
 import os
 import sys
 import glob
+import multiprocessing
 
 import numpy
+from scipy import sparse
 from scipy import stats
 from scipy.cluster import hierarchy
 from scipy.spatial import distance
@@ -56,6 +58,20 @@ class FeatureMatrix(object):
 
     Zero or more `Labeling` objects can be attatched to the feature matrix.
 
+    Feature values are stored as a list of column blocks, one block for each
+    call to `add_features`. By default the blocks are stored as float32
+    values, the storage type can be changed with the `dtype` argument. A
+    different type can also be provided per block, which is used to store
+    count features as (smaller) integer blocks. The full feature matrix is
+    only assembled when the `feature_matrix` variable is requested, and it is
+    not kept. The feature matrix and its slices are always returned in the
+    storage type, `get_dataset` can upcast them on request.
+
+    Features with mostly zero values, such as dipeptide or codon compositions,
+    can be added as scipy sparse matrix. These are stored as sparse (CSR)
+    column blocks next to the dense ones. Data sets that only contain columns
+    of sparse blocks are returned as sparse matrix by `get_dataset`.
+
     """
 
     # labeling name and class name of the default one-class labeling
@@ -63,25 +79,59 @@ class FeatureMatrix(object):
     ONE_CLASS_LABEL = 'all'
 
     # file names and directory structure used when saving a feature matrix
+    MANIFEST_F = 'manifest.txt'
     OBJECT_IDS_F = 'object_ids.txt'
-    FEATURE_MATRIX_F = 'feature_matrix.mat'
-    FEATURE_IDS_F = 'feature_ids.txt'
-    FEATURE_NAMES_F = 'feature_names.txt'
+    BLOCK_D = 'blocks'
     LABELING_D = 'labels'
     IMG_D = 'img'
     HISTOGRAM_D = os.path.join(IMG_D, 'histogram')
     SCATTER_D = os.path.join(IMG_D, 'scatter')
     HEATMAP_D = os.path.join(IMG_D, 'heatmap')
 
+    # files of feature matrices saved before the journaled format, these can
+    # still be loaded
+    FEATURE_MATRIX_F = 'feature_matrix.mat'
+    FEATURE_IDS_F = 'feature_ids.txt'
+    FEATURE_NAMES_F = 'feature_names.txt'
+    FEATURE_DTYPES_F = 'feature_dtypes.txt'
+
+    # number of column blocks above which adjacent blocks are merged on save
+    COMPACT_BLOCKS = 32
+
     # default name prefix for added features without feature id/name
     CUSTOM_FEAT_PRE = 'cus'
     CUSTOM_FEAT_NAME = 'Custom feature vector'
 
-    def __init__(self):
+    # default storage type of the feature values
+    DTYPE = numpy.float32
 
-        # The feature matrix, object ids (rows), and feature ids (columns)
-        self._feature_matrix = None
+    # available statistical tests and the number of features tested at once
+    STAT_TESTS = ['ttest', 'welch', 'mannwhitney']
+    STAT_CHUNK_SIZE = 1024
+
+    # maximum number of objects and features that are hierarchically
+    # clustered, larger numbers are clustered on a random sample
+    CLUST_MAX_OBJECTS = 2000
+    CLUST_MAX_FEATURES = 1000
+
+    # maximum number of clustered heatmap rows, above this the (ordered)
+    # objects are averaged in groups
+    HEATMAP_MAX_ROWS = 1000
+
+    def __init__(self, dtype=None):
+
+        # storage type of the feature values
+        if(dtype is None):
+            dtype = self.DTYPE
+        if not(numpy.dtype(dtype).kind == 'f'):
+            raise ValueError('Storage type should be a floating point type.')
+        self._dtype = numpy.dtype(dtype)
+
+        # The feature matrix column blocks, object ids (rows), and feature ids
+        # (columns), the full feature matrix is assembled on request
+        self._feature_blocks = []
         self._object_ids = None
+        self._object_index = None
         self._feature_ids = []
 
         # optional feature annotation
@@ -90,6 +140,15 @@ class FeatureMatrix(object):
         # labelings
         self._labeling_dict = {}
 
+        # journal state: the directory to which this feature matrix is saved
+        # (or from which it is loaded), the file of each saved column block,
+        # the saved labelings, and the block and labeling files listed in the
+        # manifest when it was last loaded or saved
+        self._saved_dir = None
+        self._block_files = []
+        self._saved_labelings = set()
+        self._listed_files = set()
+
     @property
     def object_ids(self):
         return self._object_ids
@@ -102,16 +161,50 @@ class FeatureMatrix(object):
     def feature_ids(self):
         self._delete_all_features()
 
+    @property
+    def dtype(self):
+        return self._dtype
+
     @property
     def feature_matrix(self):
-        return self._feature_matrix
+        '''
+        The dense feature matrix in the storage type. It is assembled from the
+        column blocks on each request and not kept, a single block that has
+        the storage type is returned as is.
+        '''
+        if not(self._feature_blocks):
+            return None
+        if(len(self._feature_blocks) == 1):
+            return _dense(self._feature_blocks[0]).astype(self.dtype,
+                                                          copy=False)
+        return numpy.hstack([_dense(b).astype(self.dtype, copy=False)
+                             for b in self._feature_blocks])
 
     @feature_matrix.deleter
     def feature_matrix(self):
         self._delete_all_features()
 
+    @property
+    def feature_blocks(self):
+        return self._feature_blocks
+
+    def _block_offsets(self):
+        '''
+        This function returns the feature matrix column index of the first
+        column of each block, followed by the total number of columns.
+        '''
+        return numpy.cumsum([0] + [b.shape[1] for b in self._feature_blocks])
+
+    def _all_sparse(self, block_is=None):
+        if(block_is is None):
+            block_is = range(len(self._feature_blocks))
+        return (len(block_is) > 0 and
+                all([sparse.issparse(self._feature_blocks[b])
+                     for b in block_is]))
+
     def _delete_all_features(self):
-        self._feature_matrix = None
+        self._feature_blocks = []
+        self._block_files = []
         self._feature_ids = []
         self._feature_names = {}
 
@@ -158,11 +251,14 @@ class FeatureMatrix(object):
         if(len(object_ids) == 0):
             raise ValueError('The object ids list is empty.')
 
-        # check and store object ids
-        if not(len(object_ids) == len(set(object_ids))):
+        # check and store object ids, together with an object id to row index
+        # mapping
+        object_index = dict((oid, i) for i, oid in enumerate(object_ids))
+        if not(len(object_ids) == len(object_index)):
             raise ValueError('The list of object ids contains duplicates.')
 
         self._object_ids = object_ids
+        self._object_index = object_index
 
         # by default set one_class labeling
         label_dict = dict(zip(self._object_ids, [0] * len(self._object_ids)))
@@ -223,7 +319,8 @@ class FeatureMatrix(object):
         l = Labeling.load_from_file(labeling_name, labeling_f)
         self.add_labeling(l.name, l.label_dict, l.class_names)
 
-    def add_features(self, feature_ids, feature_matrix, feature_names=None):
+    def add_features(self, feature_ids, feature_matrix, feature_names=None,
+                     dtype=None):
         '''
         This function extends the feature matrix, adding the provided features.
 
@@ -231,12 +328,20 @@ class FeatureMatrix(object):
         in the same order as the object ids. TODO how to improve this? Use
         merge instead?
 
+        The features are stored as a new column block. The values are stored
+        using the storage type of this feature matrix, unless another type is
+        provided with dtype. The compact_dtype function can be used to obtain
+        an integer type that stores the values without loss. A scipy sparse
+        feature matrix is stored as sparse (CSR) block.
+
         Args:
             feature_ids ([str]): List with feature ids.
-            feature_matrix (numpy.array): The feature values.
+            feature_matrix (numpy.array or scipy.sparse matrix): The feature
+                                                                 values.
 
         Kwargs:
             feature_names ([str]): Optional list of feature names.
+            dtype (numpy.dtype): Storage type of this block.
 
         Raises:
             ValueError: If feature_ids contains duplicates.
@@ -272,14 +377,19 @@ class FeatureMatrix(object):
                              'does not correspond to the number of ' +
                              'provided feature ids.')
 
+        if(dtype is None):
+            dtype = self.dtype
+
         # append feature ids
         self.feature_ids.extend(feature_ids)
-        # create feature matrix or append to feature matrix
-        if(self.feature_matrix is None):
-            self._feature_matrix = feature_matrix
+
+        # add column block
+        if(sparse.issparse(feature_matrix)):
+            block = sparse.csr_matrix(feature_matrix, dtype=dtype)
         else:
-            self._feature_matrix = numpy.hstack([self._feature_matrix,
-                                                feature_matrix])
+            block = numpy.asarray(feature_matrix, dtype=dtype)
+        self._feature_blocks.append(block)
+        self._block_files.append(None)
 
         # create feature id to name mapping
         if(feature_names is None):
@@ -310,9 +420,26 @@ class FeatureMatrix(object):
             if(len(fis) == len(self.feature_ids)):
                 del self.feature_matrix
             else:
-                # otherwise delete columns from feature matrix
-                self._feature_matrix = numpy.delete(self.feature_matrix,
-                                                    fis, 1)
+                # otherwise delete columns from each of the column blocks
+                fis = numpy.array(fis)
+                blocks = []
+                block_files = []
+                start = 0
+                for block, block_f in zip(self._feature_blocks,
+                                          self._block_files):
+                    end = start + block.shape[1]
+                    keep = numpy.ones(block.shape[1], dtype=bool)
+                    keep[fis[(fis >= start) & (fis < end)] - start] = False
+                    if(numpy.all(keep)):
+                        blocks.append(block)
+                        block_files.append(block_f)
+                    elif(numpy.any(keep)):
+                        # changed blocks need to be saved again
+                        blocks.append(block[:, numpy.flatnonzero(keep)])
+                        block_files.append(None)
+                    start = end
+                self._feature_blocks = blocks
+                self._block_files = block_files
 
                 # and delete feature ids and names
                 for fid in feature_ids:
@@ -323,22 +450,145 @@ class FeatureMatrix(object):
             raise ValueError('Feature id not in the feature matrix.')
 
     def merge(self, other):
+        '''
+        This function adds the features and labelings of feature matrix other
+        to this feature matrix. The rows of other are matched to the rows of
+        this feature matrix by object id, so the objects do not need to be in
+        the same order. Labelings that are available in both feature matrices
+        should be the same.
 
-        # check if other has the same objects and labels (same order as well)
-        if not(self.object_ids == other.object_ids):
+        Args:
+            other (FeatureMatrix): The feature matrix to merge with.
+        Raises:
+            ValueError: If the object ids of this feature matrix are not set.
+            ValueError: If other does not contain all objects of this feature
+                        matrix.
+            ValueError: If a labeling with the same name but different labels
+                        exists.
+        '''
+
+        if(self.object_ids is None):
+            raise ValueError('Object ids are not set.')
+
+        rows = other._object_rows(self.object_ids)
+        if(numpy.any(rows < 0)):
             raise ValueError('Object of the two feature matrices ' +
                              'do not correspond.')
 
-        # TODO merge labelings???
+        self._add_rows_from(other, rows)
+
+    def join(self, other, how='inner'):
+        '''
+        This function returns a new feature matrix with the features and
+        labelings of this feature matrix and feature matrix other, with rows
+        matched by object id.
+
+        With an inner join, the result contains the objects that are in both
+        feature matrices. With a left join, it contains all objects of this
+        feature matrix, and the features of other are missing (NaN, or zero
+        for sparse blocks) for objects that are not in other. Labelings of
+        other are only added if other contains all resulting objects. The
+        objects retain the order of this feature matrix.
+
+        Args:
+            other (FeatureMatrix): The feature matrix to join with.
+        Kwargs:
+            how (str): 'inner' (default) or 'left'.
+        Raises:
+            ValueError: If how is not 'inner' or 'left'.
+            ValueError: If the feature matrices have no objects in common.
+            ValueError: If a feature id is in both feature matrices.
+            ValueError: If a labeling with the same name but different labels
+                        exists.
+        '''
+
+        if not(how in ['inner', 'left']):
+            raise ValueError('Join type should be inner or left.')
+
+        rows = other._object_rows(self.object_ids)
+        if(how == 'inner'):
+            self_rows = numpy.flatnonzero(rows >= 0)
+            rows = rows[self_rows]
+        else:
+            self_rows = numpy.arange(len(self.object_ids))
+
+        if(len(self_rows) == 0):
+            raise ValueError('The feature matrices have no objects in common.')
+
+        fm = FeatureMatrix(self.dtype)
+        fm.object_ids = [self.object_ids[i] for i in self_rows]
+        fm._add_rows_from(self, self_rows)
+        fm._add_rows_from(other, rows)
+        return fm
 
-        # add the feature ids and extend the feature matrix
-        self.add_features(other.feature_ids, other.feature_matrix)
+    def _object_rows(self, object_ids):
+        '''
+        This function returns an array with for each of the provided object
+        ids the row index in this feature matrix, or -1 if the object is not
+        in this feature matrix.
+        '''
+        if(self.object_ids is None):
+            return -numpy.ones(len(object_ids), dtype=int)
+        return numpy.array([self._object_index.get(oid, -1)
+                            for oid in object_ids], dtype=int)
+
+    def _add_rows_from(self, other, rows):
+        '''
+        This function adds the column blocks and labelings of other, of which
+        row rows[i] corresponds to row i of this feature matrix. Rows -1 are
+        missing in other.
+        '''
 
-    def add_custom_features(self, feature_matrix):
+        missing = numpy.any(rows < 0)
+        identity = (not missing and len(rows) == len(other.object_ids) and
+                    numpy.array_equal(rows, numpy.arange(len(rows))))
+
+        # add the feature ids and extend the feature matrix, per column block
+        # to retain the storage type of each block
+        start = 0
+        for block in other.feature_blocks:
+            end = start + block.shape[1]
+            fids = other.feature_ids[start:end]
+            if not(identity):
+                block = _take_rows(block, rows, other.dtype)
+            self.add_features(fids, block,
+                              [other.feature_names[f] for f in fids],
+                              dtype=block.dtype)
+            start = end
+
+        if(missing):
+            return
+
+        # add labelings, with only the classes of the selected objects
+        for lname in sorted(other.labeling_dict.keys()):
+            if(lname == self.ONE_CLASS_LABELING):
+                continue
+            l = other.labeling_dict[lname]
+            labels = l.labels[rows]
+            present = numpy.unique(labels)
+            class_names = [l.class_names[i] for i in present]
+            labels = numpy.searchsorted(present, labels)
+
+            if(lname in self.labeling_dict.keys()):
+                own = self.labeling_dict[lname]
+                if not(own.class_names == class_names and
+                       numpy.array_equal(own.labels, labels)):
+                    raise ValueError('Labelings with the same name differ: ' +
+                                     lname)
+            else:
+                self.add_labeling(lname,
+                                  dict(zip(self.object_ids, labels.tolist())),
+                                  class_names)
+
+    def add_custom_features(self, feature_matrix, object_ids=None):
         '''
         Rename this... is the same as add_features, but without supplying
         feature_ids (names). So maybe combine the two and turn feature_ids
         into a kwargs which defaults to None.
+
+        If object_ids is provided, row i of feature_matrix contains the
+        features of object object_ids[i] and the rows are reordered to the
+        object order of this feature matrix.
         '''
 
         num_obj, num_feat = feature_matrix.shape
@@ -347,6 +597,15 @@ class FeatureMatrix(object):
             raise ValueError('Number of feature matrix rows does not '
                              'correspond to number of objects.')
 
+        if not(object_ids is None):
+            row_index = dict((oid, i) for i, oid in enumerate(object_ids))
+            try:
+                rows = [row_index[oid] for oid in self.object_ids]
+            except KeyError:
+                raise ValueError('The object ids do not correspond to the '
+                                 'objects of the feature matrix.')
+            feature_matrix = feature_matrix[rows]
+
         cust_feats = self.get_custom_features().values()
         cust_feats = [c[0].split('_')[0] for c in cust_feats]
 
@@ -365,18 +624,79 @@ class FeatureMatrix(object):
                                       i) for i in xrange(num_feat)]
         self.add_features(feat_ids, feature_matrix, feature_names=feat_names)
 
-    def slice(self, feat_is, object_is):
-        data = self.feature_matrix[:, feat_is]
-        return data[object_is, :]
+    def slice(self, feat_is, object_is, copy=True):
+        '''
+        This function returns the feature matrix values of the columns
+        feat_is and rows object_is. The values are gathered per column block,
+        a sparse (CSR) matrix is returned if all selected columns are part of
+        a sparse block. The values are returned in the storage type.
+
+        Each block is gathered with a single copy, or without copy if both the
+        rows and the columns are a contiguous range. If copy is False and all
+        columns are part of one (dense) block, such a view on the stored
+        feature values is returned as is. Only use this for read-only access.
+        '''
+        feat_is = numpy.asarray(feat_is, dtype=int)
+        object_is = numpy.asarray(object_is, dtype=int)
+
+        if(len(feat_is) == 0):
+            return numpy.empty((len(object_is), 0), dtype=self.dtype)
+
+        # determine the block and block column index of each selected column
+        offsets = self._block_offsets()
+        block_is = numpy.searchsorted(offsets, feat_is, side='right') - 1
+        all_sparse = self._all_sparse(set(block_is))
+
+        # gather runs of consecutive selected columns within the same block
+        parts = []
+        run_starts = numpy.concatenate(
+            [[0], numpy.flatnonzero(numpy.diff(block_is)) + 1])
+        for run in numpy.split(numpy.arange(len(feat_is)), run_starts[1:]):
+            block_i = block_is[run[0]]
+            block = self._feature_blocks[block_i]
+            part = _gather(block, object_is, feat_is[run] - offsets[block_i])
+            if not(all_sparse):
+                part = _dense(part)
+            # integer blocks are returned in the storage type
+            if not(part.dtype == self.dtype):
+                part = part.astype(self.dtype)
+            parts.append(part)
+
+        if(all_sparse):
+            return sparse.hstack(parts, format='csr')
+        elif(len(parts) == 1):
+            part = parts[0]
+            if(copy and numpy.may_share_memory(part, self._feature_blocks[
+                    block_is[0]])):
+                part = part.copy()
+            return part
+        else:
+            return numpy.hstack(parts)
 
     def standardized(self):
         return self._standardize(self.feature_matrix)
 
     def standardized_slice(self, feat_is, object_is):
-        return self._standardize(self.slice(feat_is, object_is))
+        # no copy required, standardization returns a new matrix
+        return self._standardize(self.slice(feat_is, object_is, copy=False))
 
     def _standardize(self, mat):
-        result = numpy.copy(mat)
+
+        # integer blocks are standardized to the (float) storage type
+        dtype = numpy.result_type(mat.dtype, self.dtype)
+
+        # sparse data is only scaled, centering would make it dense
+        if(sparse.issparse(mat)):
+            result = sparse.csr_matrix(mat, dtype=dtype, copy=True)
+            mean = numpy.asarray(result.mean(axis=0)).ravel()
+            sq_mean = numpy.asarray(
+                result.multiply(result).mean(axis=0)).ravel()
+            std = numpy.sqrt(numpy.maximum(sq_mean - mean ** 2, 0.0))
+            std[std == 0.0] = 1.0
+            result.data /= std[result.indices]
+            return result
+
+        result = numpy.array(mat, dtype=dtype)
         # column wise (features)
         mean = numpy.mean(result, axis=0)
         std = numpy.std(result, axis=0)
@@ -398,7 +718,11 @@ class FeatureMatrix(object):
         Raises:
             ValueError: if one of the feature_ids is not in the list.
         '''
-        return [self.feature_ids.index(fid) for fid in feature_ids]
+        index_dict = dict(zip(self.feature_ids, xrange(len(self.feature_ids))))
+        try:
+            return [index_dict[fid] for fid in feature_ids]
+        except KeyError as e:
+            raise ValueError('%s is not in list' % (e))
 
     def object_indices(self, object_ids):
         '''
@@ -412,14 +736,14 @@ class FeatureMatrix(object):
         Raises:
             ValueError: if one of the object_ids is not in the list.
         '''
-        return [self.object_ids.index(oid) for oid in object_ids]
+        try:
+            return [self._object_index[oid] for oid in object_ids]
+        except KeyError as e:
+            raise ValueError('%s is not in list' % (e))
 
     def filtered_object_indices(self, labeling_name, class_ids):
         labeling = self.labeling_dict[labeling_name]
-        indices = []
-        for c in class_ids:
-            indices.extend(labeling.object_indices_per_class[c])
-        return sorted(indices)
+        return labeling.class_object_indices(class_ids)
 
     def class_indices(self, labeling_name, class_ids):
         labeling = self.labeling_dict[labeling_name]
@@ -444,7 +768,23 @@ class FeatureMatrix(object):
         return feat_dict
 
     def get_dataset(self, feat_ids=None, labeling_name=None, class_ids=None,
-                    standardized=True):
+                    standardized=True, dtype=None, copy=True):
+        '''
+        This function returns the (standardized) feature matrix data for the
+        provided features and the objects with one of the provided class
+        labels, together with the sample names, feature names, target labels,
+        and target names.
+
+        The data is returned using the storage type, which is float32 by
+        default. Use dtype to obtain the data as another type, e.g. float64.
+        If all selected features are stored in sparse blocks, the data is
+        returned as sparse (CSR) matrix. Sparse data is scaled to unit variance
+        but not centered.
+
+        Set copy to False to obtain a view on the stored (not standardized)
+        feature values when possible, see slice. This is only allowed for
+        read-only use of the data.
+        '''
 
         if (labeling_name is None):
             labeling_name = 'one_class'
@@ -457,41 +797,51 @@ class FeatureMatrix(object):
             if not(class_ids):
                 class_ids = labeling.class_names
 
-            feat_is = sorted(self.feature_indices(feat_ids))
-            object_is = self.filtered_object_indices(labeling_name, class_ids)
+            feat_is = numpy.sort(self.feature_indices(feat_ids))
+            object_is = self.filtered_object_indices(labeling_name,
+                                                     class_ids)
             class_is = self.class_indices(labeling_name, class_ids)
             if standardized:
                 fm = self.standardized_slice(feat_is, object_is)
             else:
-                fm = self.slice(feat_is, object_is)
+                fm = self.slice(feat_is, object_is, copy=copy)
 
-            target = [labeling.labels[i] for i in object_is]
             target_names = [labeling.class_names[i] for i in class_is]
             sample_names = [self.object_ids[i] for i in object_is]
             feature_names = [self.feature_ids[i] for i in feat_is]
 
             # map target to use 0,1,2,... as labels
-            target_map = dict(zip(class_is, range(len(class_is))))
+            target_map = numpy.zeros(len(labeling.class_names))
+            target_map[class_is] = numpy.arange(len(class_is))
 
             # targets are floats because liblinear classification wants this...
-            target = numpy.array([float(target_map[t]) for t in target])
+            target = target_map[labeling.labels[object_is]]
         else:
-            if standardized:
-                fm = self.standardized()
+            if(self._all_sparse()):
+                fm = sparse.hstack(self._feature_blocks, format='csr',
+                                   dtype=self.dtype)
             else:
                 fm = self.feature_matrix
-            target = numpy.array([float(l) for l in labeling.labels])
+            if standardized:
+                fm = self._standardize(fm)
+            target = labeling.labels.astype(float)
             target_names = labeling.class_names
             sample_names = self.object_ids
             feature_names = self.feature_ids
 
+        # upcast on request
+        if not(dtype is None or fm.dtype == dtype):
+            fm = fm.astype(dtype)
+
         return (fm, sample_names, feature_names, target, target_names)
 
     def get_sklearn_dataset(self, feat_ids=None, labeling_name=None,
-                            class_ids=None, standardized=True):
+                            class_ids=None, standardized=True, dtype=None,
+                            copy=True):
 
         (fm, sample_names, feature_names, target, target_names) =\
-            self.get_dataset(feat_ids, labeling_name, class_ids, standardized)
+            self.get_dataset(feat_ids, labeling_name, class_ids, standardized,
+                             dtype, copy)
 
         return Bunch(data=fm,
                      target=target,
@@ -501,18 +851,29 @@ class FeatureMatrix(object):
                      #DESCR='')# TODO
 
     @classmethod
-    def load_from_dir(cls, d):
+    def load_from_dir(cls, d, dtype=None, mmap_mode=None):
         '''
         This class method returns a FeatureMatrix object that has been
         constructed using data loaded from a feature matrix directory.
 
         Args:
             | **d** *(str)*: The path to the feature matrix directory.
+            | **dtype** *(numpy.dtype)*: The storage type, float32 if None.
+            | **mmap_mode** *(str)*: Memory-map the dense column blocks with
+                                     this mode (e.g. 'r'), see numpy.load.
+                                     Only used for journaled directories.
         Raises:
 
         '''
         # initilaze empty feature matrix object
-        fm = cls()
+        fm = cls(dtype)
+
+        # load journaled feature matrix directory
+        if(os.path.exists(os.path.join(d, cls.MANIFEST_F))):
+            fm._load_manifest(d, mmap_mode)
+            return fm
+
+        # otherwise load the separate files of the previous format
 
         # first load object ids, if available
         f = os.path.join(d, cls.OBJECT_IDS_F)
@@ -530,6 +891,7 @@ class FeatureMatrix(object):
 
             fids = None
             fnames = None
+            fblocks = None
             featmat = None
 
             # read feature ids
@@ -544,6 +906,12 @@ class FeatureMatrix(object):
                 with open(f, 'r') as fin:
                     fnames = [n for n in file_io.read_names(fin)]
 
+            # read column block sizes, types, and storage format
+            f = os.path.join(d, cls.FEATURE_DTYPES_F)
+            if(os.path.exists(f)):
+                with open(f, 'r') as fin:
+                    fblocks = [line.split() for line in fin if line.strip()]
+
             # read feature matrix
             f = os.path.join(d, cls.FEATURE_MATRIX_F)
             if(os.path.exists(f)):
@@ -555,62 +923,241 @@ class FeatureMatrix(object):
                     featmat = featmat.reshape((n, 1))
 
             if not(featmat is None):
-                fm.add_features(fids, featmat, fnames)
+
+                # feature matrices without block types are stored as a single
+                # dense block using the storage type
+                if(fblocks is None):
+                    fblocks = [(featmat.shape[1], fm.dtype.name)]
+                if(fnames is None):
+                    fnames = fids
+
+                start = 0
+                for block in fblocks:
+                    end = start + int(block[0])
+                    values = featmat[:, start:end]
+                    if(len(block) > 2 and block[2] == 'sparse'):
+                        values = sparse.csr_matrix(values)
+                    fm.add_features(fids[start:end], values,
+                                    fnames[start:end], dtype=block[1])
+                    start = end
 
         return fm
 
-    def save_to_dir(self, d):
+    def _load_manifest(self, d, mmap_mode=None):
+        '''
+        This function loads the object ids, column blocks, and labelings that
+        are listed in the manifest of feature matrix directory d.
+        '''
+
+        with open(os.path.join(d, self.MANIFEST_F), 'r') as fin:
+            entries = [line.strip().split('\t') for line in fin
+                       if line.strip()]
+
+        for entry in entries:
+
+            if(entry[0] == 'object_ids'):
+                self.load_object_ids(os.path.join(d, entry[1]))
+
+            elif(entry[0] == 'block'):
+                base = entry[1]
+                (fids, fnames, block) = self._load_block(
+                    os.path.join(d, base), entry[2] == 'sparse', mmap_mode)
+                self.add_features(fids, block, fnames, dtype=block.dtype)
+                self._block_files[-1] = base
+
+            elif(entry[0] == 'labeling'):
+                (label_dict, class_names) = file_io.read_labeling(
+                    os.path.join(d, entry[2]))
+                self.add_labeling(entry[1], label_dict, class_names)
+                self._saved_labelings.add(entry[1])
+
+        self._saved_dir = os.path.abspath(d)
+        self._listed_files = self._manifest_files(entries)
+
+    def _load_block(self, base, is_sparse, mmap_mode):
+        with open(base + '_ids.txt', 'r') as fin:
+            fids = [i for i in file_io.read_ids(fin)]
+        with open(base + '_names.txt', 'r') as fin:
+            fnames = [n for n in file_io.read_names(fin)]
+        if(is_sparse):
+            arrays = numpy.load(base + '.npz')
+            block = sparse.csr_matrix((arrays['data'], arrays['indices'],
+                                       arrays['indptr']),
+                                      shape=tuple(arrays['shape']))
+        else:
+            block = numpy.load(base + '.npy', mmap_mode=mmap_mode)
+        return (fids, fnames, block)
+
+    def save_to_dir(self, d, compact=False):
         '''
         This function stores the current feature matrix object to directory.
 
+        The directory is used as a journal. Each column block and labeling is
+        stored in its own file and a manifest lists the files that together
+        form the feature matrix. If this feature matrix was loaded from (or
+        saved to) the same directory, only the blocks and labelings that were
+        added since then are written. The manifest is replaced atomically
+        after the new files have been written. Only the block and labeling
+        files that this feature matrix listed before and no longer lists
+        (removed or merged blocks) are removed afterwards, so that the files
+        written by another process that saves to the same directory are kept.
+
+        Adjacent blocks with the same storage type are merged and stored
+        again if compact is True, or if the number of blocks exceeds
+        COMPACT_BLOCKS.
+
         Args:
             | **d** *(str)*: The path to the directory where the feature matrix
                              data will be stored.
+            | **compact** *(bool)*: Merge blocks before saving.
         Raises:
 
         '''
         if not(os.path.exists(d)):
             os.makedirs(d)
-        self._save_object_ids(os.path.join(d, self.OBJECT_IDS_F))
-        self._save_feature_ids(os.path.join(d, self.FEATURE_IDS_F))
-        self._save_feature_names(os.path.join(d, self.FEATURE_NAMES_F))
-        self._save_feature_matrix(os.path.join(d, self.FEATURE_MATRIX_F))
-        self._save_labelings(os.path.join(d, self.LABELING_D))
 
-    def _save_object_ids(self, f):
+        manifest_f = os.path.join(d, self.MANIFEST_F)
+        block_d = os.path.join(d, self.BLOCK_D)
+        lab_d = os.path.join(d, self.LABELING_D)
+        for sub_d in [block_d, lab_d]:
+            if not(os.path.exists(sub_d)):
+                os.makedirs(sub_d)
+
+        # write everything if this feature matrix is not in sync with d
+        in_sync = (self._saved_dir == os.path.abspath(d) and
+                   os.path.exists(manifest_f))
+        if not(in_sync):
+            self._block_files = [None] * len(self._feature_blocks)
+            self._saved_labelings = set()
+            self._listed_files = set()
+
+        if(compact or len(self._feature_blocks) > self.COMPACT_BLOCKS):
+            self._merge_blocks()
+
+        entries = []
+
+        # object ids can only be set once, so these are written only once
         if(self.object_ids):
-            with open(f, 'w') as fout:
-                file_io.write_ids(fout, self.object_ids)
+            if not(in_sync):
+                with open(os.path.join(d, self.OBJECT_IDS_F), 'w') as fout:
+                    file_io.write_ids(fout, self.object_ids)
+            entries.append(['object_ids', self.OBJECT_IDS_F])
+
+        # write new column blocks, never overwriting existing block files
+        block_i = self._next_block_index(block_d)
+        start = 0
+        for index, block in enumerate(self._feature_blocks):
+            end = start + block.shape[1]
+            if(self._block_files[index] is None):
+                base = os.path.join(self.BLOCK_D, str(block_i))
+                self._save_block(os.path.join(d, base), block,
+                                 self.feature_ids[start:end])
+                self._block_files[index] = base
+                block_i += 1
+            entries.append(['block', self._block_files[index],
+                            'sparse' if sparse.issparse(block) else 'dense'])
+            start = end
+
+        # write new labelings, the one class labeling is created on load
+        for lname in sorted(self.labeling_dict.keys()):
+            if not(lname == self.ONE_CLASS_LABELING):
+                f = os.path.join(self.LABELING_D, '%s.txt' % (lname))
+                if not(lname in self._saved_labelings):
+                    l = self.labeling_dict[lname]
+                    file_io.write_labeling(os.path.join(d, f),
+                                           self.object_ids, l.labels,
+                                           l.class_names)
+                    self._saved_labelings.add(lname)
+                entries.append(['labeling', lname, f])
+
+        # atomically replace the manifest
+        tmp_f = manifest_f + '.tmp'
+        with open(tmp_f, 'w') as fout:
+            for entry in entries:
+                fout.write('%s\n' % ('\t'.join(entry)))
+        os.rename(tmp_f, manifest_f)
+
+        self._saved_dir = os.path.abspath(d)
+
+        # remove the files that were replaced by this save
+        listed_files = self._manifest_files(entries)
+        self._remove_files(d, self._listed_files - listed_files)
+        self._listed_files = listed_files
+
+    def _save_block(self, base, block, fids):
+        if(sparse.issparse(block)):
+            numpy.savez(base + '.npz', data=block.data, indices=block.indices,
+                        indptr=block.indptr, shape=numpy.array(block.shape))
+        else:
+            numpy.save(base + '.npy', block)
+        with open(base + '_ids.txt', 'w') as fout:
+            file_io.write_ids(fout, fids)
+        with open(base + '_names.txt', 'w') as fout:
+            file_io.write_names(fout, [self.feature_names[fid]
+                                       for fid in fids])
+
+    def _next_block_index(self, block_d):
+        indices = [int(f.split('.')[0].split('_')[0])
+                   for f in os.listdir(block_d) if f[0].isdigit()]
+        return max(indices) + 1 if indices else 0
+
+    def _merge_blocks(self):
+        '''
+        This function merges adjacent column blocks that have the same type
+        and are both dense or both sparse. Merged blocks need to be saved
+        again.
+        '''
+        groups = []
+        for block, block_f in zip(self._feature_blocks, self._block_files):
+            if(groups and groups[-1][0][0].dtype == block.dtype and
+                    sparse.issparse(groups[-1][0][0]) ==
+                    sparse.issparse(block)):
+                groups[-1].append((block, block_f))
+            else:
+                groups.append([(block, block_f)])
+
+        self._feature_blocks = []
+        self._block_files = []
+        for group in groups:
+            if(len(group) == 1):
+                self._feature_blocks.append(group[0][0])
+                self._block_files.append(group[0][1])
+            else:
+                blocks = [b for b, f in group]
+                if(sparse.issparse(blocks[0])):
+                    merged = sparse.hstack(blocks, format='csr')
+                else:
+                    merged = numpy.hstack(blocks)
+                self._feature_blocks.append(merged)
+                self._block_files.append(None)
+
+    def _manifest_files(self, entries):
+        '''
+        This function returns the block and labeling files (paths relative to
+        the feature matrix directory) that are listed in the manifest entries.
+        '''
+        files = set()
+        for entry in entries:
+            if(entry[0] == 'block'):
+                files.update([entry[1] + ext for ext in
+                              ['.npy', '.npz', '_ids.txt', '_names.txt']])
+            elif(entry[0] == 'labeling'):
+                files.add(entry[2])
+        return files
+
+    def _remove_files(self, d, files):
+        '''
+        This function removes the files (paths relative to d) that exist, as
+        well as the files of the previous (not journaled) format.
+        '''
+        for f in files:
+            if(os.path.exists(os.path.join(d, f))):
+                os.remove(os.path.join(d, f))
 
-    def _save_feature_ids(self, f):
-        if not(self.feature_ids is None):
-            with open(f, 'w') as fout:
-                file_io.write_ids(fout, self.feature_ids)
-        elif(os.path.exists(f)):
-            os.remove(f)
-
-    def _save_feature_names(self, f):
-        if not(self.feature_names is None):
-            feat_names = [self.feature_names[fid] for fid in self.feature_ids]
-            with open(f, 'w') as fout:
-                file_io.write_names(fout, feat_names)
-        elif(os.path.exists(f)):
-            os.remove(f)
-
-    def _save_feature_matrix(self, f):
-        if not(self.feature_matrix is None):
-            numpy.savetxt(f, self.feature_matrix, fmt='%.4e')
-        elif(os.path.exists(f)):
-            os.remove(f)
-
-    def _save_labelings(self, d):
-        if(self.labeling_dict):
-            if not(os.path.exists(d)):
-                os.makedirs(d)
-            for lname, l in self.labeling_dict.iteritems():
-                f = os.path.join(d, '%s.txt' % (lname))
-                file_io.write_labeling(f, self.object_ids, l.labels,
-                                       l.class_names)
+        for f in [self.FEATURE_MATRIX_F, self.FEATURE_IDS_F,
+                  self.FEATURE_NAMES_F, self.FEATURE_DTYPES_F]:
+            if(os.path.exists(os.path.join(d, f))):
+                os.remove(os.path.join(d, f))
 
     def __str__(self):
 
@@ -626,44 +1173,211 @@ class FeatureMatrix(object):
 
         return s
 
-    def ttest(self, labeling_name, label0, label1, object_is=None):
+    def ttest(self, labeling_name, label0, label1, object_is=None,
+              test='ttest', chunk_size=None):
+        '''
+        This function tests for each feature if the values of the objects with
+        label1 differ from the values of the objects with label0.
+
+        Args:
+            | **labeling_name** *(str)*: The name of the labeling.
+            | **label0** *(str)*: The class name of the first group.
+            | **label1** *(str)*: The class name of the second group.
+            | **object_is** *([int])*: Optional subset of objects to test.
+            | **test** *(str)*: One of STAT_TESTS, ttest is Student's t-test
+                                (equal variances), welch is Welch's t-test,
+                                and mannwhitney the Mann-Whitney U test.
+            | **chunk_size** *(int)*: Number of features tested at once,
+                                      STAT_CHUNK_SIZE if None.
+        Returns:
+            List with a (statistic, p-value) tuple for each feature.
+        Raises:
+            | **ValueError**: If the labeling or a label does not exist.
+            | **ValueError**: If the test does not exist.
+        '''
 
         ts = []
 
         if(self.feature_ids):
 
+            obj_is_per_class = self._obj_is_per_class(labeling_name,
+                                                      object_is)
             try:
-                labeling = self.labeling_dict[labeling_name]
-            except KeyError:
-                raise ValueError('Labeling does not exist: %s.' %
-                                 (labeling_name))
-            try:
-                obj_is_per_class = labeling.get_obj_is_per_class(object_is)
                 lab0_indices = obj_is_per_class[label0]
                 lab1_indices = obj_is_per_class[label1]
             except KeyError:
                 raise ValueError('Non-existing label provided.')
 
-            for f_i in xrange(len(self.feature_ids)):
-                # TODO check for class variations, to determine if equal_val
-                # should be set to False? In that case a Welch's t-test is
-                # performed.
-                #
-                # Maybe for current situation equal sample sizes are assumed
-                # as well. Check the scipy code and compare with the t-test
-                # formulas on wikipedia.
-                # DONE: looks like the unequal sample sizes, equal variance
-                #       formula
-                ts.append(stats.ttest_ind(
-                          self.feature_matrix[lab1_indices, f_i],
-                          self.feature_matrix[lab0_indices, f_i]))
+            # testing label1 versus the rest (label0) of the two groups
+            results = self._one_vs_rest_tests([lab0_indices, lab1_indices],
+                                              test, chunk_size)
+            ts = zip(*results[1])
 
         return ts
 
+    def one_vs_rest_test(self, labeling_name, object_is=None, test='ttest',
+                         chunk_size=None):
+        '''
+        This function tests for each class and each feature if the values of
+        the objects in the class differ from the values of the other objects.
+
+        Returns a dictionary with for each class name a list with a
+        (statistic, p-value) tuple for each feature. See ttest for the
+        arguments.
+        '''
+
+        result = {}
+
+        if(self.feature_ids):
+
+            obj_is_per_class = self._obj_is_per_class(labeling_name,
+                                                      object_is)
+            class_names = [c for c in
+                           self.labeling_dict[labeling_name].class_names
+                           if c in obj_is_per_class]
+
+            results = self._one_vs_rest_tests(
+                [obj_is_per_class[c] for c in class_names], test, chunk_size)
+
+            for c, (stat, p) in zip(class_names, results):
+                result[c] = zip(stat, p)
+
+        return result
+
+    def _obj_is_per_class(self, labeling_name, object_is):
+        try:
+            labeling = self.labeling_dict[labeling_name]
+        except KeyError:
+            raise ValueError('Labeling does not exist: %s.' % (labeling_name))
+        return labeling.get_obj_is_per_class(object_is)
+
+    def _one_vs_rest_tests(self, groups, test, chunk_size):
+        '''
+        This function tests, for each feature, the values of each group of
+        objects (list of row indices) against the values of the other groups.
+
+        The features are tested in chunks of columns. For each chunk the rows
+        of all groups are gathered once, after which the per group moments
+        (or ranks for the Mann-Whitney test) are used for all groups.
+
+        Returns a list with a (statistics, p-values) tuple of arrays for each
+        group.
+        '''
+
+        if not(test in self.STAT_TESTS):
+            raise ValueError('Statistical test does not exist: %s' % (test))
+
+        if(chunk_size is None):
+            chunk_size = self.STAT_CHUNK_SIZE
+
+        num_feat = len(self.feature_ids)
+        results = [(numpy.empty(num_feat), numpy.empty(num_feat))
+                   for g in groups]
+
+        # row indices of all groups and the group boundaries
+        group_is = numpy.concatenate(
+            [numpy.asarray(g, dtype=int) for g in groups])
+        bounds = numpy.cumsum([0] + [len(g) for g in groups])
+
+        for start in xrange(0, num_feat, chunk_size):
+
+            end = min(start + chunk_size, num_feat)
+            data = numpy.asarray(_dense(self.slice(range(start, end),
+                                                   group_is)),
+                                 dtype=numpy.float64)
+
+            if(test == 'mannwhitney'):
+                chunk_results = _mannwhitney_one_vs_rest(data, bounds)
+            else:
+                chunk_results = _ttest_one_vs_rest(data, bounds,
+                                                   test == 'welch')
+
+            for (stat, p), (chunk_stat, chunk_p) in zip(results,
+                                                        chunk_results):
+                stat[start:end] = chunk_stat
+                p[start:end] = chunk_p
+
+        return results
+
     def save_histogram(self, feat_id, labeling_name, class_ids=None,
                        colors=None, img_format='png', root_dir='.',
                        title=None, standardized=False):
 
+        (labeling, class_ids, colors, feature_index, out_f) =\
+            self._histogram_settings(feat_id, labeling_name, class_ids,
+                                     colors, img_format, root_dir)
+
+        # standardize data
+        if(standardized):
+            fm = self.standardized()
+        else:
+            fm = self.feature_matrix
+
+        hist_data = []
+        for lab_i, lab in enumerate(class_ids):
+
+            lab_indices = labeling.object_indices_per_class[lab]
+
+            # fetch feature column with only the object rows with label lab
+            h_data = fm[lab_indices, feature_index]
+            hist_data.append(h_data)
+
+        fig = pyplot.figure(figsize=PLOT_SIZES['histogram'])
+        ax = fig.add_subplot(1, 1, 1)
+        _draw_histogram(ax, hist_data, self.feature_names[feat_id], class_ids,
+                        colors, title)
+        fig.savefig(out_f, bbox_inches='tight')
+
+        pyplot.close(fig)
+
+        self._write_plot_settings(out_f, (standardized, colors, title))
+
+        return out_f
+
+    def save_histograms(self, feat_ids, labeling_name, class_ids=None,
+                        colors=None, img_format='png', root_dir='.',
+                        title=None, standardized=False, cpu=1):
+        '''
+        This function saves a histogram for each of the provided features,
+        see save_histogram, and returns the list of image files.
+
+        Only the columns of the provided features are (standardized and)
+        fetched, after which the figures are rendered in a pool of cpu
+        processes using the Agg backend. Each process reuses one figure.
+        Images that are newer than the saved feature matrix, and that were
+        rendered with the same settings (standardized, colors, title), are
+        not rendered again.
+        '''
+
+        settings = [self._histogram_settings(fid, labeling_name, class_ids,
+                                             colors, img_format, root_dir)
+                    for fid in feat_ids]
+
+        out_fs = [s[-1] for s in settings]
+        plot_settings = [(standardized, s[2], title) for s in settings]
+        todo = [i for i, out_f in enumerate(out_fs)
+                if not(self._is_up_to_date(out_f, plot_settings[i]))]
+
+        if(todo):
+            fm = self._plot_columns([settings[i][3] for i in todo],
+                                    standardized)
+            tasks = []
+            for col_i, i in enumerate(todo):
+                (labeling, cids, cols, feature_index, out_f) = settings[i]
+                hist_data = [fm[labeling.object_indices_per_class[lab], col_i]
+                             for lab in cids]
+                tasks.append(('histogram', out_f,
+                              (hist_data, self.feature_names[feat_ids[i]],
+                               cids, cols, title)))
+            _render_plots(tasks, cpu)
+            for i in todo:
+                self._write_plot_settings(out_fs[i], plot_settings[i])
+
+        return out_fs
+
+    def _histogram_settings(self, feat_id, labeling_name, class_ids, colors,
+                            img_format, root_dir):
+
         try:
             labeling = self.labeling_dict[labeling_name]
         except KeyError:
@@ -678,18 +1392,10 @@ class FeatureMatrix(object):
             class_ids = labeling.class_names
 
         try:
-            feature_index = self.feature_ids.index(feat_id)
+            feature_index = self.feature_indices([feat_id])[0]
         except ValueError:
             raise ValueError('Feature %s does not exist.' % (feat_id))
 
-        feat_name = self.feature_names[feat_id]
-
-        # standardize data
-        if(standardized):
-            fm = self.standardized()
-        else:
-            fm = self.feature_matrix
-
         #feat_hists = []
         lab_str = labeling_name + '_' + '_'.join([str(l) for l in class_ids])
 
@@ -698,33 +1404,97 @@ class FeatureMatrix(object):
             os.makedirs(d)
         out_f = os.path.join(d, '%s_%s.%s' % (feat_id, lab_str, img_format))
 
-        hist_data = []
-        for lab_i, lab in enumerate(class_ids):
+        return (labeling, class_ids, colors, feature_index, out_f)
 
-            lab_indices = labeling.object_indices_per_class[lab]
+    def save_scatter(self, feat_id0, feat_id1, labeling_name=None,
+                     class_ids=None, colors=None, img_format='png',
+                     root_dir='.', feat0_pre=None, feat1_pre=None,
+                     standardized=False):
 
-            # fetch feature column with only the object rows with label lab
-            h_data = fm[lab_indices, feature_index]
-            hist_data.append(h_data)
+        (labeling, class_ids, colors, feature_index0, feature_index1,
+            feat_names, out_f) = self._scatter_settings(
+                feat_id0, feat_id1, labeling_name, class_ids, colors,
+                img_format, root_dir, feat0_pre, feat1_pre, 'scatter')
+
+        if(standardized):
+            # standardize data NOTE that fm is standardized before the objects
+            # are sliced out!!!
+            # not sure if this is the desired situation...
+            fm = self.standardized()
+        else:
+            fm = self.feature_matrix
+
+        # for each class id, fetch the object rows that have that class label
+        scatter_data = []
+        for class_id in class_ids:
+            object_is = labeling.object_indices_per_class[class_id]
+            scatter_data.append((fm[object_is, feature_index0],
+                                 fm[object_is, feature_index1]))
 
-        fig = pyplot.figure(figsize=(8.8, 2.5))
+        fig = pyplot.figure(figsize=PLOT_SIZES['scatter'])
         ax = fig.add_subplot(1, 1, 1)
-        ax.hist(hist_data, bins=40, color=colors[:len(class_ids)])
-        ax.set_xlabel(feat_name)
-        ax.legend(class_ids)
-        ax.grid()
-        if(title):
-            ax.set_title(title)
+        _draw_scatter(ax, scatter_data, feat_names, class_ids, colors)
         fig.savefig(out_f, bbox_inches='tight')
 
         pyplot.close(fig)
 
+        self._write_plot_settings(out_f, (labeling.name, class_ids,
+                                          standardized, colors))
+
         return out_f
 
-    def save_scatter(self, feat_id0, feat_id1, labeling_name=None,
-                     class_ids=None, colors=None, img_format='png',
-                     root_dir='.', feat0_pre=None, feat1_pre=None,
-                     standardized=False):
+    def save_scatters(self, feat_id_pairs, labeling_name=None,
+                      class_ids=None, colors=None, img_format='png',
+                      root_dir='.', standardized=False, cpu=1):
+        '''
+        This function saves a scatter plot for each of the provided feature id
+        pairs, see save_scatter, and returns the list of image files. The
+        images are named after the two feature ids and the labeling. See
+        save_histograms for how the figures are rendered.
+        '''
+
+        settings = []
+        for feat_id0, feat_id1 in feat_id_pairs:
+            name = '%s_%s' % (feat_id0, feat_id1)
+            settings.append(self._scatter_settings(
+                feat_id0, feat_id1, labeling_name, class_ids, colors,
+                img_format, root_dir, None, None, name))
+
+        out_fs = [s[-1] for s in settings]
+        plot_settings = [(s[0].name, s[1], standardized, s[2])
+                         for s in settings]
+        todo = [i for i, out_f in enumerate(out_fs)
+                if not(self._is_up_to_date(out_f, plot_settings[i]))]
+
+        if(todo):
+            feat_is = sorted(set([fi for i in todo
+                                  for fi in settings[i][3:5]]))
+            col_is = dict((fi, col_i) for col_i, fi in enumerate(feat_is))
+            fm = self._plot_columns(feat_is, standardized)
+            tasks = []
+            for i in todo:
+                (labeling, cids, cols, fi0, fi1, feat_names, out_f) =\
+                    settings[i]
+                scatter_data = []
+                for class_id in cids:
+                    object_is = labeling.object_indices_per_class[class_id]
+                    scatter_data.append((fm[object_is, col_is[fi0]],
+                                         fm[object_is, col_is[fi1]]))
+                tasks.append(('scatter', out_f,
+                              (scatter_data, feat_names, cids, cols)))
+            _render_plots(tasks, cpu)
+            for i in todo:
+                self._write_plot_settings(out_fs[i], plot_settings[i])
+
+        return out_fs
+
+    def _scatter_settings(self, feat_id0, feat_id1, labeling_name, class_ids,
+                          colors, img_format, root_dir, feat0_pre, feat1_pre,
+                          name):
+
+        if not(labeling_name):
+            labeling_name = self.labeling_dict[sorted(
+                self.labeling_dict.keys())[0]].name
 
         try:
             labeling = self.labeling_dict[labeling_name]
@@ -736,16 +1506,12 @@ class FeatureMatrix(object):
                       '#c17d11', '#729fcf', '#4e9a06', '#fcaf3e', '#ad7fa8',
                       '#8f5902']
 
-        if not(labeling_name):
-            labeling_name = self.labeling_dict[sorted(
-                self.labeling_dict.keys())[0]].name
-
         if not(class_ids):
-            class_ids = self.labeling_dict[labeling_name].class_names
+            class_ids = labeling.class_names
 
         try:
-            feature_index0 = self.feature_ids.index(feat_id0)
-            feature_index1 = self.feature_ids.index(feat_id1)
+            (feature_index0, feature_index1) = self.feature_indices(
+                [feat_id0, feat_id1])
         except ValueError:
             raise ValueError('Feature %s or %s does not exist.' %
                              (feat_id0, feat_id1))
@@ -761,42 +1527,75 @@ class FeatureMatrix(object):
         d = os.path.join(root_dir, self.SCATTER_D)
         if not(os.path.exists(d)):
             os.makedirs(d)
-        out_f = os.path.join(d, 'scatter.%s' % (img_format))
+        out_f = os.path.join(d, '%s.%s' % (name, img_format))
 
-        if(standardized):
-            # standardize data NOTE that fm is standardized before the objects
-            # are sliced out!!!
-            # not sure if this is the desired situation...
-            fm = self.standardized()
-        else:
-            fm = self.feature_matrix
-
-        fig = pyplot.figure(figsize=(6, 6))
-        ax = fig.add_subplot(1, 1, 1)
+        return (labeling, class_ids, colors, feature_index0, feature_index1,
+                (feat_name0, feat_name1), out_f)
 
-        # for each class id, add object ids that have that class label
-        for index, class_id in enumerate(class_ids):
-            object_is = labeling.object_indices_per_class[class_id]
-            x = fm[object_is, feature_index0]
-            y = fm[object_is, feature_index1]
-            c = colors[index]
-            ax.scatter(x, y, s=30, c=c, marker='o', label=class_id)
-
-        ax.set_xlabel(feat_name0)
-        ax.set_ylabel(feat_name1)
-        ax.legend(loc='upper right')
-        ax.grid()
-        fig.savefig(out_f, bbox_inches='tight')
-
-        pyplot.close(fig)
+    def _plot_columns(self, feat_is, standardized):
+        '''
+        This function returns the dense values of columns feat_is for all
+        objects, standardized over all objects if requested (as done by
+        standardized).
+        '''
+        fm = _dense(self.slice(feat_is, self._all_rows(), copy=False))
+        if(standardized):
+            fm = self._standardize(fm)
+        return fm
 
-        return out_f
+    def _is_up_to_date(self, out_f, plot_settings):
+        '''
+        This function returns True if out_f exists, is newer than the saved
+        feature matrix, and was rendered with plot_settings (see
+        _write_plot_settings). Without saved feature matrix, images are never
+        up to date.
+        '''
+        if(self._saved_dir is None or not(os.path.exists(out_f))):
+            return False
+        manifest_f = os.path.join(self._saved_dir, self.MANIFEST_F)
+        if not(os.path.exists(manifest_f)):
+            return False
+        settings_f = out_f + '.settings'
+        if not(os.path.exists(settings_f)):
+            return False
+        with open(settings_f, 'r') as fin:
+            if not(fin.read() == repr(plot_settings)):
+                return False
+        return os.path.getmtime(out_f) > os.path.getmtime(manifest_f)
+
+    def _write_plot_settings(self, out_f, plot_settings):
+        '''
+        This function stores the settings with which image out_f was rendered
+        next to the image, as they are not part of the image file name.
+        '''
+        with open(out_f + '.settings', 'w') as fout:
+            fout.write(repr(plot_settings))
 
     def get_clustdist_path(self, feature_ids=None, labeling_name=None,
-                           class_ids=None, vmin=-3.0, vmax=3.0, root_dir='.'):
+                           class_ids=None, vmin=-3.0, vmax=3.0, root_dir='.',
+                           max_objects=None, max_features=None,
+                           max_rows=None):
+        '''
+        This function creates a heatmap of the standardized feature matrix,
+        with objects and features ordered by hierarchical clustering.
+
+        For large feature matrices, the objects (or features) are clustered on
+        a random sample of max_objects objects (max_features features), after
+        which each object is placed next to its nearest sampled object. If
+        there are more than max_rows objects, the ordered objects are averaged
+        in groups of consecutive objects and only a PNG image is created. The
+        defaults are CLUST_MAX_OBJECTS, CLUST_MAX_FEATURES, and
+        HEATMAP_MAX_ROWS.
+        '''
 
         if not(labeling_name):
             labeling_name = 'one_class'
+        if(max_objects is None):
+            max_objects = self.CLUST_MAX_OBJECTS
+        if(max_features is None):
+            max_features = self.CLUST_MAX_FEATURES
+        if(max_rows is None):
+            max_rows = self.HEATMAP_MAX_ROWS
         #labeling = self.labeling_dict[labeling_name]
 
         (fm, sample_names, feature_names, target, target_names) =\
@@ -816,30 +1615,78 @@ class FeatureMatrix(object):
         img_format = 'png'
         file_path = os.path.join(d, 'fm_clustered.%s' % (img_format))
 
-        # reorder feature matrix rows (objects)
-        object_indices = hierarchy.leaves_list(self.clust_object(fm))
-        fm = fm[object_indices, :]
+        # order feature matrix rows (objects)
+        object_indices = self._clust_order(fm, max_objects)
 
-        # reorder standardized feature matrix columns (feats)
-        feat_indices = hierarchy.leaves_list(self.clust_feat(fm))
-        fm = fm[:, feat_indices]
+        # order standardized feature matrix columns (feats), using (a sample
+        # of) the objects
+        sample_is = _sample_indices(fm.shape[0], max_objects)
+        feat_indices = self._clust_order(_dense(fm[sample_is]).T,
+                                         max_features)
 
-        # add labels of all available labelings (reordered using object_is)
-        #lablists = [[l.labels[i] for i in object_indices]
-        #                         for l in self.labeling_dict.values()
-        #                         if not l.name == 'one_class']
-        lablists = [[target[i] for i in object_indices]]
-        class_names = [target_names]
-
-        # reorder the feature and object ids
+        # reorder the feature ids
         fs = [feature_names[i] for i in feat_indices]
-        gs = [sample_names for i in object_indices]
+
+        if(len(object_indices) <= max_rows):
+
+            fm = _dense(fm[object_indices])[:, feat_indices]
+
+            # add labels of all available labelings (reordered using
+            # object_is)
+            #lablists = [[l.labels[i] for i in object_indices]
+            #                         for l in self.labeling_dict.values()
+            #                         if not l.name == 'one_class']
+            lablists = [[target[i] for i in object_indices]]
+            gs = [sample_names[i] for i in object_indices]
+            formats = ['png', 'svg']
+
+        else:
+
+            # average groups of consecutive objects, labeled with the most
+            # frequent label of the group
+            groups = numpy.array_split(object_indices, max_rows)
+            fm = numpy.array([_dense(fm[g])[:, feat_indices].mean(axis=0)
+                              for g in groups])
+            lablists = [[numpy.bincount(target[g].astype(int)).argmax()
+                         for g in groups]]
+            gs = ['%s (+%i)' % (sample_names[g[0]], len(g) - 1)
+                  for g in groups]
+            formats = ['png']
+
+        class_names = [target_names]
 
         heatmap.heatmap_labeled_fig(fm, fs, gs, lablists, class_names,
-                                    file_path, vmin=vmin, vmax=vmax)
+                                    file_path, vmin=vmin, vmax=vmax,
+                                    formats=formats)
 
         return file_path
 
+    def _clust_order(self, data, max_items, linkage='complete'):
+        '''
+        This function returns the order of the rows of data obtained with
+        hierarchical clustering. If data has more than max_items rows, a
+        random sample of max_items rows is clustered and the other rows are
+        placed next to the nearest sampled row. Distances to the sample are
+        computed in chunks of rows, so that memory use is bounded.
+        '''
+        num_items = data.shape[0]
+        if(num_items <= max_items):
+            return hierarchy.leaves_list(self._clust(_dense(data), 0, linkage))
+
+        sample_is = _sample_indices(num_items, max_items)
+        sample = _dense(data[sample_is])
+        leaves = hierarchy.leaves_list(self._clust(sample, 0, linkage))
+        rank = numpy.empty(len(leaves), dtype=int)
+        rank[leaves] = numpy.arange(len(leaves))
+
+        nearest = numpy.empty(num_items, dtype=int)
+        for start in xrange(0, num_items, self.STAT_CHUNK_SIZE):
+            end = min(start + self.STAT_CHUNK_SIZE, num_items)
+            dist = distance.cdist(_dense(data[start:end]), sample)
+            nearest[start:end] = dist.argmin(axis=1)
+
+        return numpy.argsort(rank[nearest], kind='mergesort')
+
     def dist_feat(self, fm, metric='euclidian'):
         return self._dist(fm, 1, metric)
 
@@ -847,7 +1694,6 @@ class FeatureMatrix(object):
     #    return self._dist(fm, 0, metric)
 
     def _dist(self, fm, axis, metric):
-        fm = fm.copy()
         if(axis == 1):
             fm = fm.transpose()
         # calculate and return dist matrix (condensed matrix as result!)
@@ -882,6 +1728,479 @@ class FeatureMatrix(object):
         heatmap.heatmap_fig(corr_matrix, xlab, ylab, f, vmin=-1.0, vmax=1.0)
         return f
 
+    def constant_features(self, feat_ids=None, chunk_size=None):
+        '''
+        This function returns the ids of the features that have the same value
+        for all objects (zero variance).
+
+        Kwargs:
+            feat_ids ([str]): The features to check, all features by default.
+            chunk_size (int): Number of features that is processed at once,
+                              STAT_CHUNK_SIZE by default.
+        '''
+        feat_is = self._redundancy_feat_is(feat_ids)
+        constant = []
+        for start, data in self._column_chunks(feat_is, chunk_size):
+            is_const = numpy.all(data == data[0], axis=0)
+            constant.extend(feat_is[start + numpy.flatnonzero(is_const)])
+        return [self.feature_ids[fi] for fi in sorted(constant)]
+
+    def duplicate_features(self, feat_ids=None, chunk_size=None):
+        '''
+        This function returns groups of features with exactly the same values
+        for all objects. Columns are hashed and only columns with the same
+        hash are compared.
+
+        Returns a list with a list of feature ids for each group of
+        duplicates, in feature matrix column order.
+
+        Kwargs:
+            See constant_features.
+        '''
+        feat_is = self._redundancy_feat_is(feat_ids)
+
+        # group columns by hash of their values
+        hash_groups = {}
+        for start, data in self._column_chunks(feat_is, chunk_size):
+            columns = numpy.ascontiguousarray(data.T)
+            for index, column in enumerate(columns):
+                key = hash(column.tostring())
+                hash_groups.setdefault(key, []).append(feat_is[start + index])
+
+        # compare the columns within each hash group
+        groups = []
+        for fis in hash_groups.values():
+            while(len(fis) > 1):
+                data = numpy.asarray(_dense(self.slice(fis, self._all_rows())),
+                                     dtype=numpy.float64)
+                same = numpy.all(data == data[:, :1], axis=0)
+                same[0] = True
+                if(numpy.sum(same) > 1):
+                    groups.append([fi for fi, s in zip(fis, same) if s])
+                fis = [fi for fi, s in zip(fis, same) if not s]
+
+        return [[self.feature_ids[fi] for fi in g] for g in sorted(groups)]
+
+    def correlated_features(self, threshold=0.95, feat_ids=None,
+                            chunk_size=None):
+        '''
+        This function returns the pairs of features with an absolute Pearson
+        correlation of at least threshold. The correlations are computed for
+        pairs of column chunks, so that the full correlation matrix is never
+        stored. Constant features are skipped.
+
+        Returns a list with (feature id, feature id, correlation) tuples, in
+        feature matrix column order.
+
+        Kwargs:
+            threshold (float): Minimal absolute correlation.
+            See constant_features for the other arguments.
+        '''
+        feat_is = self._redundancy_feat_is(feat_ids)
+        const = set(self.feature_indices(
+            self.constant_features([self.feature_ids[fi] for fi in feat_is],
+                                   chunk_size)))
+        feat_is = numpy.array([fi for fi in feat_is if not fi in const],
+                              dtype=int)
+
+        if(chunk_size is None):
+            chunk_size = self.STAT_CHUNK_SIZE
+        starts = range(0, len(feat_is), chunk_size)
+
+        pairs = []
+        for a_i, a_start in enumerate(starts):
+            a_is = feat_is[a_start:a_start + chunk_size]
+            a_data = _zscores(self.slice(a_is, self._all_rows()))
+            for b_start in starts[a_i:]:
+                b_is = feat_is[b_start:b_start + chunk_size]
+                if(b_start == a_start):
+                    b_data = a_data
+                else:
+                    b_data = _zscores(self.slice(b_is, self._all_rows()))
+                corr = numpy.dot(a_data.T, b_data) / a_data.shape[0]
+                high = numpy.abs(corr) >= threshold
+                if(b_start == a_start):
+                    high = numpy.triu(high, 1)
+                for i, j in zip(*numpy.nonzero(high)):
+                    pairs.append((a_is[i], b_is[j],
+                                  max(-1.0, min(1.0, corr[i, j]))))
+
+        return [(self.feature_ids[i], self.feature_ids[j], c)
+                for i, j, c in sorted(pairs)]
+
+    def redundant_features(self, threshold=None, feat_ids=None,
+                           chunk_size=None):
+        '''
+        This function returns the ids of the features that can be removed
+        without losing information: constant features, and all but the first
+        feature of each group of duplicate features. If threshold is
+        provided, the second feature of each pair of features with an absolute
+        correlation of at least threshold is added as well, unless the first
+        one is allready removed.
+
+        Kwargs:
+            threshold (float): Minimal absolute correlation, correlated
+                               features are not removed by default.
+            See constant_features for the other arguments.
+        '''
+        redundant = set(self.constant_features(feat_ids, chunk_size))
+
+        for group in self.duplicate_features(feat_ids, chunk_size):
+            if not(group[0] in redundant):
+                redundant.update(group[1:])
+
+        if not(threshold is None):
+            for fid0, fid1, corr in self.correlated_features(
+                    threshold, feat_ids, chunk_size):
+                if not(fid0 in redundant):
+                    redundant.add(fid1)
+
+        return [fid for fid in self.feature_ids if fid in redundant]
+
+    def _redundancy_feat_is(self, feat_ids):
+        if(feat_ids is None):
+            return numpy.arange(len(self.feature_ids))
+        return numpy.sort(self.feature_indices(feat_ids))
+
+    def _all_rows(self):
+        return numpy.arange(len(self.object_ids))
+
+    def _column_chunks(self, feat_is, chunk_size):
+        '''
+        This generator yields, per chunk of the columns feat_is, the index of
+        the first column in feat_is and the (dense, float64) chunk data.
+        '''
+        if(chunk_size is None):
+            chunk_size = self.STAT_CHUNK_SIZE
+        for start in xrange(0, len(feat_is), chunk_size):
+            chunk_is = feat_is[start:start + chunk_size]
+            yield (start, numpy.asarray(
+                _dense(self.slice(chunk_is, self._all_rows())),
+                dtype=numpy.float64))
+
+
+def _dense(mat):
+    '''
+    This function returns mat as dense numpy array.
+    '''
+    if(sparse.issparse(mat)):
+        return mat.toarray()
+    return mat
+
+
+# figure size of the histogram and scatter plots
+PLOT_SIZES = {'histogram': (8.8, 2.5), 'scatter': (6, 6)}
+
+# figures reused by the processes that render plots, one per plot type
+_plot_figures = {}
+
+
+def _draw_histogram(ax, hist_data, feat_name, class_ids, colors, title):
+    ax.hist(hist_data, bins=40, color=colors[:len(class_ids)])
+    ax.set_xlabel(feat_name)
+    ax.legend(class_ids)
+    ax.grid()
+    if(title):
+        ax.set_title(title)
+
+
+def _draw_scatter(ax, scatter_data, feat_names, class_ids, colors):
+    for index, class_id in enumerate(class_ids):
+        (x, y) = scatter_data[index]
+        c = colors[index]
+        ax.scatter(x, y, s=30, c=c, marker='o', label=class_id)
+
+    ax.set_xlabel(feat_names[0])
+    ax.set_ylabel(feat_names[1])
+    ax.legend(loc='upper right')
+    ax.grid()
+
+
+def _init_plot_worker():
+    pyplot.switch_backend('Agg')
+
+
+def _render_plot(task):
+    '''
+    This function draws a (plot type, output file, draw arguments) task on
+    the reused figure of the plot type and saves it.
+    '''
+    (plot_type, out_f, args) = task
+    if not(plot_type in _plot_figures):
+        _plot_figures[plot_type] = pyplot.figure(
+            figsize=PLOT_SIZES[plot_type])
+    fig = _plot_figures[plot_type]
+    fig.clf()
+    ax = fig.add_subplot(1, 1, 1)
+    if(plot_type == 'histogram'):
+        _draw_histogram(ax, *args)
+    else:
+        _draw_scatter(ax, *args)
+    fig.savefig(out_f, bbox_inches='tight')
+    return out_f
+
+
+def _render_plots(tasks, cpu):
+    '''
+    This function renders the plot tasks in a pool of cpu processes, or in
+    this process if cpu is 1.
+    '''
+    if(cpu > 1 and len(tasks) > 1):
+        pool = multiprocessing.Pool(min(cpu, len(tasks)),
+                                    initializer=_init_plot_worker)
+        try:
+            pool.map(_render_plot, tasks,
+                     chunksize=max(1, len(tasks) // (4 * cpu)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        try:
+            for task in tasks:
+                _render_plot(task)
+        finally:
+            for fig in _plot_figures.values():
+                pyplot.close(fig)
+            _plot_figures.clear()
+
+
+def _sample_indices(num_items, max_items):
+    '''
+    This function returns the sorted indices of a random (but reproducible)
+    sample of at most max_items out of num_items items.
+    '''
+    if(num_items <= max_items):
+        return numpy.arange(num_items)
+    random_state = numpy.random.RandomState(0)
+    return numpy.sort(random_state.permutation(num_items)[:max_items])
+
+
+def _zscores(mat):
+    '''
+    This function returns the column-wise z-scores of mat as dense float64
+    array. Constant columns are set to zero.
+    '''
+    data = numpy.array(_dense(mat), dtype=numpy.float64)
+    data -= data.mean(axis=0)
+    std = data.std(axis=0)
+    std[std == 0.0] = 1.0
+    data /= std
+    return data
+
+
+def _ttest_one_vs_rest(data, bounds, welch):
+    '''
+    This function returns for each group of rows in data (group i are the rows
+    bounds[i] to bounds[i + 1]) the column-wise t-test statistics and p-values
+    of the group versus the other rows. The moments of the other rows are
+    obtained by combining the moments of the other groups.
+    '''
+
+    num_groups = len(bounds) - 1
+
+    # single pass over the groups to obtain counts, means, and squared
+    # deviation sums
+    ns = numpy.diff(bounds).astype(float)
+    means = []
+    m2s = []
+    for gi in xrange(num_groups):
+        group = data[bounds[gi]:bounds[gi + 1]]
+        mean = group.mean(axis=0) if len(group) else numpy.zeros(data.shape[1])
+        means.append(mean)
+        m2s.append(((group - mean) ** 2).sum(axis=0))
+
+    results = []
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+
+        for gi in xrange(num_groups):
+
+            n1 = ns[gi]
+            mean1 = means[gi]
+            var1 = m2s[gi] / (n1 - 1)
+
+            # combine the moments of the other groups
+            others = [gj for gj in xrange(num_groups) if not(gj == gi)]
+            n0 = sum([ns[gj] for gj in others])
+            mean0 = sum([ns[gj] * means[gj] for gj in others]) / n0
+            m20 = sum([m2s[gj] + ns[gj] * (means[gj] - mean0) ** 2
+                       for gj in others])
+            var0 = m20 / (n0 - 1)
+
+            d = mean1 - mean0
+
+            if(welch):
+                se1 = var1 / n1
+                se0 = var0 / n0
+                denom = numpy.sqrt(se1 + se0)
+                df = (se1 + se0) ** 2 / (se1 ** 2 / (n1 - 1) +
+                                         se0 ** 2 / (n0 - 1))
+            else:
+                df = n1 + n0 - 2.0
+                svar = ((n1 - 1) * var1 + (n0 - 1) * var0) / df
+                denom = numpy.sqrt(svar * (1.0 / n1 + 1.0 / n0))
+
+            t = d / denom
+            p = stats.t.sf(numpy.abs(t), df) * 2.0
+
+            # identical constant values, no difference
+            same = (d == 0.0) & (denom == 0.0)
+            t[same] = 0.0
+            p = numpy.where(same, 1.0, p)
+
+            results.append((t, p))
+
+    return results
+
+
+def _mannwhitney_one_vs_rest(data, bounds):
+    '''
+    This function returns for each group of rows in data (group i are the rows
+    bounds[i] to bounds[i + 1]) the column-wise Mann-Whitney U statistics of
+    the group versus the other rows, together with the two-sided p-values
+    obtained with the tie corrected normal approximation. The rows are ranked
+    once for all groups.
+    '''
+
+    n = float(data.shape[0])
+    ranks, tie_sum = _rank_columns(data)
+
+    results = []
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+
+        for gi in xrange(len(bounds) - 1):
+
+            n1 = float(bounds[gi + 1] - bounds[gi])
+            n0 = n - n1
+
+            rank_sum = ranks[bounds[gi]:bounds[gi + 1]].sum(axis=0)
+            u = rank_sum - n1 * (n1 + 1.0) / 2.0
+
+            sd = numpy.sqrt(n1 * n0 / 12.0 *
+                            ((n + 1.0) - tie_sum / (n * (n - 1.0))))
+            z = (u - n1 * n0 / 2.0) / sd
+
+            # all values tied, no difference
+            z[sd == 0.0] = 0.0
+            p = stats.norm.sf(numpy.abs(z)) * 2.0
+
+            results.append((u, p))
+
+    return results
+
+
+def _rank_columns(data):
+    '''
+    This function returns the column-wise ranks (starting at 1) of data, tied
+    values obtain their average rank. The column-wise tie correction sums,
+    sum(t^3 - t) over the groups of t tied values, are returned as well.
+    '''
+
+    (num_rows, num_cols) = data.shape
+
+    rows = numpy.arange(num_rows)[:, numpy.newaxis]
+    cols = numpy.arange(num_cols)
+
+    order = numpy.argsort(data, axis=0, kind='mergesort')
+    sorted_data = data[order, cols]
+
+    # flag first and last position of each group of tied values
+    first_flag = numpy.ones(sorted_data.shape, dtype=bool)
+    first_flag[1:] = sorted_data[1:] != sorted_data[:-1]
+    last_flag = numpy.ones(sorted_data.shape, dtype=bool)
+    last_flag[:-1] = first_flag[1:]
+
+    # first and last position of the tied group of each position
+    first = numpy.maximum.accumulate(numpy.where(first_flag, rows, 0), axis=0)
+    last = numpy.minimum.accumulate(
+        numpy.where(last_flag, rows, num_rows - 1)[::-1], axis=0)[::-1]
+
+    ranks = numpy.empty(sorted_data.shape)
+    ranks[order, cols] = (first + last) / 2.0 + 1.0
+
+    # each of the t positions of a tied group adds t^2 - 1
+    tie_sum = ((last - first + 1.0) ** 2 - 1.0).sum(axis=0)
+
+    return (ranks, tie_sum)
+
+
+def _as_range(indices):
+    '''
+    This function returns a slice object if indices is a contiguous increasing
+    range of indices, and None otherwise.
+    '''
+    if(len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1 and
+            numpy.all(numpy.diff(indices) == 1)):
+        return slice(indices[0], indices[-1] + 1)
+    return None
+
+
+def _gather(mat, row_is, col_is):
+    '''
+    This function returns rows row_is and columns col_is of mat. Contiguous
+    ranges are obtained with basic slicing, which results in a view on mat if
+    both are contiguous. Otherwise a single copy is made using numpy.ix_.
+    '''
+    rows = _as_range(row_is)
+    cols = _as_range(col_is)
+
+    if(sparse.issparse(mat)):
+        mat = mat[row_is if rows is None else rows, :]
+        return mat[:, col_is if cols is None else cols]
+    elif(rows is None and cols is None):
+        return mat[numpy.ix_(row_is, col_is)]
+    else:
+        return mat[row_is if rows is None else rows,
+                   col_is if cols is None else cols]
+
+
+def _take_rows(mat, rows, dtype):
+    '''
+    This function returns the rows of mat, with an empty row for row index -1.
+    Empty rows of a dense matrix are set to NaN, for which the matrix is
+    converted to (at least) type dtype.
+    '''
+    missing = rows < 0
+    if not(numpy.any(missing)):
+        return _gather(mat, rows, numpy.arange(mat.shape[1]))
+    elif(sparse.issparse(mat)):
+        empty = sparse.csr_matrix((1, mat.shape[1]), dtype=mat.dtype)
+        rows = numpy.where(missing, mat.shape[0], rows)
+        return sparse.vstack([mat, empty], format='csr')[rows]
+    else:
+        result = numpy.take(mat, rows, axis=0).astype(
+            numpy.result_type(mat.dtype, dtype))
+        result[missing] = numpy.nan
+        return result
+
+
+def compact_dtype(data, dtype=FeatureMatrix.DTYPE):
+    '''
+    This function returns the smallest integer type that can store the values
+    in data without loss. If data contains non-integer values, dtype is
+    returned.
+
+    Args:
+        data (numpy.array): The feature values.
+    Kwargs:
+        dtype (numpy.dtype): The type used for non-integer data.
+    '''
+    if(sparse.issparse(data)):
+        data = data.data
+    data = numpy.asarray(data)
+
+    if(data.size == 0 or not numpy.all(numpy.isfinite(data)) or
+            not numpy.all(numpy.mod(data, 1) == 0)):
+        return numpy.dtype(dtype)
+
+    for int_type in [numpy.int8, numpy.int16, numpy.int32]:
+        info = numpy.iinfo(int_type)
+        if(data.min() >= info.min and data.max() <= info.max):
+            return numpy.dtype(int_type)
+
+    return numpy.dtype(dtype)
+
 
 class Labeling(object):
 
@@ -892,12 +2211,13 @@ class Labeling(object):
         initiate with a dict?
         '''
 
-        label_set = set(labels)
+        labels = numpy.asarray(labels, dtype=int)
+        label_set = numpy.unique(labels)
 
         if not(len(object_ids) == len(labels)):
             raise ValueError('Number of object ids and labels is different.')
         # ??? should I add this ???
-        if not(label_set == set(range(len(label_set)))):
+        if not(numpy.array_equal(label_set, numpy.arange(len(label_set)))):
             raise ValueError('Labels should be 0, 1, ...')
         if not(len(label_set) == len(class_names)):
             raise ValueError('Number of class names does not correspond to ' +
@@ -906,13 +2226,22 @@ class Labeling(object):
         self._name = name
         self._object_ids = object_ids
         self._labels = labels
-        self._label_dict = dict(zip(object_ids, labels))
+        self._label_dict = dict(zip(object_ids, labels.tolist()))
         self._class_names = class_names
+        self._class_label = dict((c, i) for i, c in enumerate(class_names))
 
+        # sorted object indices per class, obtained with one stable sort
+        order = numpy.argsort(labels, kind='mergesort')
+        bounds = numpy.searchsorted(labels[order],
+                                    numpy.arange(len(class_names) + 1))
         self._object_indices_per_class = {}
-        for index, o in enumerate(self._object_ids):
-            c = self._class_names[self.labels[index]]
-            self._object_indices_per_class.setdefault(c, []).append(index)
+        for index, c in enumerate(class_names):
+            obj_is = order[bounds[index]:bounds[index + 1]]
+            obj_is.flags.writeable = False
+            self._object_indices_per_class[c] = obj_is
+
+        # sorted object indices of class subsets, filled on request
+        self._class_subset_indices = {}
 
     @property
     def name(self):
@@ -949,12 +2278,43 @@ class Labeling(object):
         if(object_is is None):
             return self.object_indices_per_class
         else:
+            object_is = numpy.asarray(object_is, dtype=int)
+            object_labels = self.labels[object_is]
             obj_is = {}
-            for object_i in object_is:
-                cl = self.class_names[self.labels[object_i]]
-                obj_is.setdefault(cl, []).append(object_i)
+            for index, cl in enumerate(self.class_names):
+                cl_is = object_is[object_labels == index]
+                if(len(cl_is) > 0):
+                    obj_is[cl] = cl_is
             return obj_is
 
+    def class_mask(self, class_names):
+        '''
+        This function returns a boolean array that is True for the objects
+        that have one of the provided class labels.
+
+        Raises:
+            KeyError: If one of the class names does not exist.
+        '''
+        selected = numpy.zeros(len(self.class_names), dtype=bool)
+        selected[[self._class_label[c] for c in class_names]] = True
+        return selected[self.labels]
+
+    def class_object_indices(self, class_names):
+        '''
+        This function returns the sorted indices of the objects that have one
+        of the provided class labels. The result is cached per class subset
+        and should not be modified.
+
+        Raises:
+            KeyError: If one of the class names does not exist.
+        '''
+        key = tuple(sorted(set(class_names)))
+        if not(key in self._class_subset_indices):
+            obj_is = numpy.flatnonzero(self.class_mask(key))
+            obj_is.flags.writeable = False
+            self._class_subset_indices[key] = obj_is
+        return self._class_subset_indices[key]
+
     @classmethod
     def load_from_file(cls, labeling_name, f):
         (label_dict, class_names) = file_io.read_labeling(f)
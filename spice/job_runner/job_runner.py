@@ -14,6 +14,10 @@ max_num_jobs = [1, 1, 1]
 # maximal allowed number of jobs per job type
 max_jobs = dict(zip(job_types, max_num_jobs))
 
+# maximal number of runtime estimates of waiting classification jobs that run
+# at once, see run_estimates
+max_estimates = 1
+
 # pause between checking for jobs in queue
 sleep_interval = 5
 
@@ -36,6 +40,11 @@ class JobQueueManager(Daemon):
         self.running_jobs = dict(zip(
             job_types, [[] for i in xrange(len(job_types))]))
 
+        # running runtime estimates per job output dir, and the output dirs of
+        # the waiting classification jobs of which the estimate is started
+        self.running_estimates = {}
+        self.estimated = set()
+
     def run(self):
 
         while True:
@@ -84,6 +93,9 @@ class JobQueueManager(Daemon):
                         .append((project_d, job_f, cmd, t,
                                  job_stdout_f, job_stderr_f))
 
+            # estimate the runtime of the waiting classification jobs
+            self.run_estimates(jobs['classification'])
+
             # for each job type
             for job_type in job_types:
 
@@ -93,6 +105,17 @@ class JobQueueManager(Daemon):
 
                     # sort jobs current job type by timestamp and select first
                     first_job = sorted(jobs[job_type], key=itemgetter(3))[0]
+
+                    # select the classification job that is expected to
+                    # finish first, minus the time it has been waiting, if
+                    # the runtime of all waiting jobs is estimated
+                    if(job_type == 'classification' and
+                            len(jobs[job_type]) > 1):
+                        priorities = [self.job_priority(j)
+                                      for j in jobs[job_type]]
+                        if not(None in priorities):
+                            first_job = min(zip(priorities, jobs[job_type]),
+                                            key=itemgetter(0))[1]
                     project_d, job_f, cmd, _, jobout_f, joberr_f = first_job
 
                     # define file paths
@@ -101,6 +124,10 @@ class JobQueueManager(Daemon):
                     done_f = os.path.join(project_d, 'jobs', 'done', job_f)
                     err_f = os.path.join(project_d, 'jobs', 'error', job_f)
 
+                    # a job that is started does not need its estimate
+                    if(job_type == 'classification'):
+                        self.stop_estimate(self.job_output_dir(cmd))
+
                     fout = open(jobout_f, 'w')
                     ferr = open(joberr_f, 'w')
                     job = subprocess.Popen(cmd, shell=True, stdout=fout,
@@ -126,6 +153,93 @@ class JobQueueManager(Daemon):
             # then sleep for a while before going to the next loop
             time.sleep(sleep_interval)
 
+    def run_estimates(self, jobs):
+        '''
+        This function starts the runtime estimate (classification
+        --estimate_only) of the waiting classification jobs that are not
+        estimated yet, at most max_estimates at once. The estimate is stored
+        in the job output dir (see job_priority). Each job is estimated once,
+        a failed estimate is not retried.
+        '''
+
+        # remove finished estimates
+        for out_dir, estimate in self.running_estimates.items():
+            if not(estimate.poll() is None):
+                del self.running_estimates[out_dir]
+
+        # only keep track of the jobs that are still waiting
+        out_dirs = [self.job_output_dir(job[2]) for job in jobs]
+        self.estimated &= set(out_dirs)
+
+        # estimate the jobs first come first served
+        for job, out_dir in sorted(zip(jobs, out_dirs),
+                                   key=lambda j: j[0][3]):
+
+            if(len(self.running_estimates) >= max_estimates):
+                break
+
+            if(out_dir is None or out_dir in self.estimated):
+                continue
+            self.estimated.add(out_dir)
+
+            if(os.path.exists(os.path.join(out_dir, 'runtime_estimate.txt'))):
+                continue
+
+            # exec, so that the estimate can be stopped (see stop_estimate)
+            with open(os.devnull, 'w') as fnull:
+                self.running_estimates[out_dir] = subprocess.Popen(
+                    'exec %s --estimate_only' % (job[2].strip()), shell=True,
+                    stdout=fnull, stderr=fnull)
+
+    def stop_estimate(self, out_dir):
+        '''
+        This function stops the runtime estimate of the job with output dir
+        out_dir, if it is running.
+        '''
+
+        estimate = self.running_estimates.pop(out_dir, None)
+        if not(estimate is None) and estimate.poll() is None:
+            estimate.terminate()
+            estimate.wait()
+
+    def job_output_dir(self, cmd):
+        '''
+        This function returns the output dir (-o) of the job command cmd, or
+        None if it has no output dir.
+        '''
+
+        tokens = cmd.split()
+        if not('-o' in tokens):
+            return None
+        return tokens[tokens.index('-o') + 1]
+
+    def job_priority(self, job):
+        '''
+        This function returns the scheduling priority (lowest first) of a
+        waiting classification job: its estimated runtime minus the time it
+        has been waiting, so that long jobs are not postponed forever. The
+        runtime is estimated while the job is waiting (see run_estimates),
+        and stored in the job output dir. None is returned if the estimate is not (yet) available, the
+        waiting jobs are then run first come first served.
+        '''
+
+        project_d, job_f, cmd, t, _, _ = job
+        wait_f = os.path.join(project_d, 'jobs', 'waiting', job_f)
+
+        # the job output dir
+        out_dir = self.job_output_dir(cmd)
+        if(out_dir is None):
+            return None
+        estimate_f = os.path.join(out_dir, 'runtime_estimate.txt')
+
+        try:
+            with open(estimate_f, 'r') as fin:
+                estimate = float(fin.readline())
+        except (IOError, ValueError):
+            return None
+
+        return estimate - (time.time() - os.path.getmtime(wait_f))
+
 
 #if __name__ == "__main__":
 # TODO add test runs
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+import os
+import json
+import socket
+import threading
+import SocketServer
+from collections import OrderedDict
+
+import numpy
+
+from daemon import Daemon
+from spice import classification
+from spice import classify
+from spice.project_management import ProjectManager
+
+# maximal number of loaded classifiers that is kept in memory
+max_models = 8
+
+
+class ModelServer(Daemon):
+    '''
+    Long-running prediction service that listens on a Unix socket. Trained
+    classifiers are loaded on first use and kept in a least recently used
+    cache, so that predictions do not require starting a new process and
+    loading the classifier.
+
+    Each request is a single line with a JSON object:
+
+        {"user_id": ..., "project_id": ..., "classifier_id": ...,
+         "features": [[...], ...]}
+
+    with one feature row per object, in the order of the classifier features,
+    or with "sequences": [[protein id, protein sequence], ...] instead of
+    "features", in which case the classifier features are calculated from the
+    protein sequences. The response is a line with a JSON object with the
+    "predictions" and "probabilities", or with an "error" message.
+    '''
+
+    def __init__(self, pidfile, project_dir, socket_f, stdin='/dev/null',
+                 stdout='/dev/null', stderr='/dev/null'):
+
+        super(ModelServer, self).__init__(pidfile, stdin, stdout, stderr)
+
+        # somehow a print is required here, to get output for the stdout...
+        # HACK, don't remove!
+        print('')
+
+        # projects directory and socket file, absolute because the daemon
+        # changes its working directory
+        self.project_dir = os.path.abspath(project_dir)
+        self.socket_f = os.path.abspath(socket_f)
+
+        # loaded classifiers {classifier dir: (modification times of the
+        # loaded files, classifier, scaler, feature ids)}, least recently
+        # used first
+        self.models = OrderedDict()
+        self.models_lock = threading.Lock()
+
+    def run(self):
+
+        if(os.path.exists(self.socket_f)):
+            os.remove(self.socket_f)
+
+        # only the daemon user may connect, the daemon runs with umask 0, so
+        # the socket is created with a restrictive umask
+        prev_umask = os.umask(0077)
+        try:
+            server = ThreadingUnixStreamServer(self.socket_f, RequestHandler)
+        finally:
+            os.umask(prev_umask)
+        os.chmod(self.socket_f, 0600)
+        server.model_server = self
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            if(os.path.exists(self.socket_f)):
+                os.remove(self.socket_f)
+
+    def predict(self, request):
+        '''
+        This function returns the response (dict) for a request (dict).
+        '''
+
+        try:
+            user_id = request['user_id']
+            project_id = request['project_id']
+            cl_id = request['classifier_id']
+        except KeyError as e:
+            return {'error': 'Missing request field: %s' % (e)}
+
+        # the ids are used as paths, only accept existing directory entries
+        pm = ProjectManager(self.project_dir, None)
+        if not(_valid_id(self.project_dir, user_id)):
+            return {'error': 'Unknown user.'}
+        pm.set_user(user_id)
+        if not(_valid_id(pm.user_dir, project_id)):
+            return {'error': 'Unknown project.'}
+        pm.set_project(project_id)
+        if not(_valid_id(pm.cl_dir, cl_id)):
+            return {'error': 'Classifier not available.'}
+
+        cl_f = None
+        if(pm.get_cl_dir(cl_id)):
+            cl_f = pm.get_classifier_f(cl_id)
+        if(cl_f is None):
+            return {'error': 'Classifier not available.'}
+
+        (classifier, scaler, feature_ids) = self.get_model(
+            os.path.dirname(cl_f))
+
+        if(scaler is None):
+            return {'error': 'No scaler available for this classifier.'}
+
+        if('features' in request):
+            data = numpy.array(request['features'], dtype=float)
+            if not(data.ndim == 2 and data.shape[1] == len(feature_ids)):
+                return {'error': 'Provide one row with %i features per '
+                                 'object.' % (len(feature_ids))}
+        elif('sequences' in request):
+            data = classify.sequence_features(request['sequences'],
+                                              feature_ids)
+        else:
+            return {'error': 'Provide features or sequences.'}
+
+        data = classification.check_sparse(data, classifier)
+        preds, probas = classification.classify(scaler.transform(data),
+                                                classifier)
+
+        return {'predictions': [float(p) for p in preds],
+                'probabilities': [float(p) for p in probas]}
+
+    def get_model(self, cl_d):
+        '''
+        This function returns the (classifier, scaler, feature ids) of
+        classifier dir cl_d, from the cache if none of the files that are
+        loaded from it (see classify.classifier_files) changed since they
+        were loaded.
+        '''
+
+        cl_d = os.path.abspath(cl_d)
+        mtimes = [(f, os.path.getmtime(f))
+                  for f in classify.classifier_files(cl_d)]
+
+        with self.models_lock:
+            model = self.models.pop(cl_d, None)
+
+        if(model is None or not(model[0] == mtimes)):
+            model = (mtimes,) + classify.load_classifier(cl_d)
+
+        with self.models_lock:
+            self.models[cl_d] = model
+            while(len(self.models) > max_models):
+                self.models.popitem(last=False)
+
+        return model[1:]
+
+
+class ThreadingUnixStreamServer(SocketServer.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+
+        # handle requests until the client closes the connection
+        for line in iter(self.rfile.readline, ''):
+
+            if not(line.strip()):
+                continue
+
+            try:
+                response = self.server.model_server.predict(json.loads(line))
+            except Exception as e:
+                response = {'error': str(e)}
+
+            self.wfile.write('%s\n' % (json.dumps(response)))
+            self.wfile.flush()
+
+
+def _valid_id(d, name):
+    '''
+    This function returns True if name is the name of an existing directory
+    in directory d, and not a path (no path separators, '.', or '..').
+    '''
+    if not(isinstance(name, basestring)) or name in ['', '.']:
+        return False
+    if(os.sep in name or (os.altsep and os.altsep in name) or '..' in name or
+            '\0' in name):
+        return False
+    return os.path.isdir(os.path.join(d, name))
+
+
+def predict(socket_f, request):
+    '''
+    This function sends a request (dict) to the model server listening on
+    socket_f and returns the response (dict), see ModelServer.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_f)
+        fio = sock.makefile('rw')
+        fio.write('%s\n' % (json.dumps(request)))
+        fio.flush()
+        return json.loads(fio.readline())
+    finally:
+        sock.close()
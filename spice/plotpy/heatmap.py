@@ -10,6 +10,10 @@ from matplotlib import pyplot, colors, cm, gridspec, colorbar, ticker
 
 from spice.plotpy import color
 
+# maximum number of tick labels per heatmap axis and maximum figure height
+MAX_LABELS = 100
+MAX_HEIGHT = 30.0
+
 def heatmap_fig(data, xlab, ylab, file_name, vmin=-3.0, vmax=3.0):
     
     fig = pyplot.figure(figsize=(8,8))
@@ -33,16 +37,18 @@ def heatmap_fig(data, xlab, ylab, file_name, vmin=-3.0, vmax=3.0):
 
 
 def heatmap_labeled_fig(data, xlab, ylab, label_lists, class_names, file_path, 
-                        vmin=-3.0, vmax=3.0):
+                        vmin=-3.0, vmax=3.0, formats=('png', 'svg')):
     '''
     returns figure with heatmap of provided data, and a column for each
-    provided label list.
+    provided label list. The figure is saved in each of the provided formats.
+    The heatmap is rasterized and the figure height is limited to MAX_HEIGHT
+    inches, so large data results in a downsampled image.
     '''
 
     (nrows, ncols) = data.shape    
 
     width = min(6.4, ncols * 0.5)
-    height = nrows * 0.03
+    height = min(MAX_HEIGHT, nrows * 0.03)
     fig = pyplot.figure(figsize=(width, height))
 
     pyplot.subplots_adjust(bottom=0.2)
@@ -101,10 +107,11 @@ def heatmap_labeled_fig(data, xlab, ylab, label_lists, class_names, file_path,
             ax0.add_patch(r)
     '''
 
-    fig.savefig(file_path + '.png', bbox_inches='tight')
-    fig.savefig(file_path + '.svg', bbox_inches='tight')
+    for img_format in formats:
+        fig.savefig(file_path + '.' + img_format, bbox_inches='tight')
     #fig.savefig(file_path + '.png')
     #fig.savefig(file_path + '.svg')
+    pyplot.close(fig)
 
 def _heatmap_axes(ax, data, xlab, ylab, vmin, vmax):
     
@@ -116,9 +123,12 @@ def _heatmap_axes(ax, data, xlab, ylab, vmin, vmax):
     if not(numy == len(ylab)):
         print('Error: incorrect number of y-labels')
 
-    # set x-labels, feature names, at the top
-    ax.xaxis.set_ticks(range(numx))
-    ax.xaxis.set_ticklabels(xlab)
+    # set x-labels, feature names, at the top (skip if there are too many)
+    if(numx <= MAX_LABELS):
+        ax.xaxis.set_ticks(range(numx))
+        ax.xaxis.set_ticklabels(xlab)
+    else:
+        ax.xaxis.set_ticks([])
     ax.xaxis.set_ticks_position('top')
 
     # rotate x-axis tick labels
@@ -149,6 +159,7 @@ def _heatmap_axes(ax, data, xlab, ylab, vmin, vmax):
                          vmin = vmin,
                          vmax = vmax)
     hm.set_interpolation('nearest')
+    hm.set_rasterized(True)
     hm.set_cmap(my_cmap())
     #hm.set_cmap(cm.get_cmap('RdBu'))
 
@@ -174,6 +185,7 @@ def _labeling_axes(ax, label_list):
                                vmin = 0,
                                vmax = len(lset))
     lm.set_interpolation('nearest')
+    lm.set_rasterized(True)
     lm.set_cmap(colormap)
 
 def my_cmap():
@@ -0,0 +1,287 @@
+'''
+Trained classifiers that are compiled into plain numpy parameters, so that
+they can be loaded and applied to new data without unpickling sklearn
+objects. The classifiers in this module only depend on numpy and mimic the
+part of the sklearn interface that is used for classification (predict,
+decision_function, predict_proba, and transform for the scaler).
+
+The parameters are obtained and validated by classification.export_predictor
+and stored with save_predictor in a single numpy .npz file.
+'''
+
+import numpy
+from scipy import sparse
+
+# compiled predictor types
+LINEAR = 'linear'
+CENTROID = 'centroid'
+GAUSSIAN_NB = 'gaussian_nb'
+
+
+class Scaler(object):
+    '''
+    Applies the feature-wise standardization data * scale + offset.
+    '''
+
+    def __init__(self, scale, offset):
+        self.scale = numpy.asarray(scale, dtype=float)
+        self.offset = numpy.asarray(offset, dtype=float)
+
+    def transform(self, data):
+        if(sparse.issparse(data)):
+            data = data.toarray()
+        return numpy.asarray(data, dtype=float) * self.scale + self.offset
+
+
+class LinearClassifier(object):
+    '''
+    Linear decision function data . coef + intercept, with one column per
+    class, or a single column for two-class problems, in which case class
+    classes[pos_class_i] is predicted for positive decision values.
+    '''
+
+    def __init__(self, classes, coef, intercept, pos_class_i=1):
+        self.classes_ = numpy.asarray(classes)
+        self.coef = numpy.asarray(coef, dtype=float)
+        self.intercept = numpy.asarray(intercept, dtype=float)
+        self.pos_class_i = int(pos_class_i)
+
+    def decision_function(self, data):
+        dec = numpy.dot(_dense(data), self.coef) + self.intercept
+        if(self.coef.shape[1] == 1):
+            dec = dec.ravel()
+        return dec
+
+    def predict(self, data):
+        dec = self.decision_function(data)
+        if(dec.ndim == 1):
+            class_is = numpy.where(dec > 0, self.pos_class_i,
+                                   1 - self.pos_class_i)
+        else:
+            class_is = dec.argmax(axis=1)
+        return self.classes_[class_is]
+
+
+class ProbabilisticLinearClassifier(LinearClassifier):
+    '''
+    Linear classifier with class probabilities. For a single decision column
+    the probability of the second class is 1 / (1 + exp(a * dec + b)), with
+    (a, b) the sigmoid parameters, followed by the pairwise coupling of
+    libsvm if coupling is set (platt scaling of libsvm classifiers).
+    Otherwise the probabilities are the softmax of the decision values.
+    '''
+
+    def __init__(self, classes, coef, intercept, pos_class_i=1,
+                 sigmoid=(-1.0, 0.0), coupling=False):
+        super(ProbabilisticLinearClassifier, self).__init__(
+            classes, coef, intercept, pos_class_i)
+        self.sigmoid = numpy.asarray(sigmoid, dtype=float)
+        self.coupling = bool(coupling)
+
+    def predict_proba(self, data):
+        dec = self.decision_function(data)
+        if(dec.ndim == 1):
+            proba = 1.0 / (1.0 + numpy.exp(self.sigmoid[0] * dec +
+                                           self.sigmoid[1]))
+            if(self.coupling):
+                proba = _libsvm_coupling(proba)
+            return numpy.column_stack((1.0 - proba, proba))
+        return _softmax(dec)
+
+
+class CentroidClassifier(object):
+    '''
+    Predicts the class of the nearest (euclidean) class centroid.
+    '''
+
+    def __init__(self, classes, centroids):
+        self.classes_ = numpy.asarray(classes)
+        self.centroids = numpy.asarray(centroids, dtype=float)
+
+    def predict(self, data):
+        data = _dense(data)
+        # squared distances without the constant squared norm of the rows
+        dist = (-2.0 * numpy.dot(data, self.centroids.T) +
+                (self.centroids ** 2).sum(axis=1))
+        return self.classes_[dist.argmin(axis=1)]
+
+
+class GaussianNBClassifier(object):
+    '''
+    Gaussian naive Bayes with per class feature means theta, variances sigma,
+    and class priors.
+    '''
+
+    def __init__(self, classes, theta, sigma, class_prior):
+        self.classes_ = numpy.asarray(classes)
+        self.theta = numpy.asarray(theta, dtype=float)
+        self.sigma = numpy.asarray(sigma, dtype=float)
+        self.class_prior = numpy.asarray(class_prior, dtype=float)
+
+    def _joint_log_likelihood(self, data):
+        data = _dense(data)
+        # sum over features of (x - theta)^2 / sigma, expanded to products
+        inv = 1.0 / self.sigma
+        jll = (numpy.dot(data ** 2, inv.T) -
+               2.0 * numpy.dot(data, (self.theta * inv).T) +
+               (self.theta ** 2 * inv).sum(axis=1))
+        return (numpy.log(self.class_prior) -
+                0.5 * numpy.log(2.0 * numpy.pi * self.sigma).sum(axis=1) -
+                0.5 * jll)
+
+    def predict(self, data):
+        return self.classes_[self._joint_log_likelihood(data).argmax(axis=1)]
+
+    def predict_proba(self, data):
+        return _softmax(self._joint_log_likelihood(data))
+
+
+# compiled classifiers, these handle sparse data themselves
+CLASSIFIER_TYPES = (LinearClassifier, CentroidClassifier,
+                    GaussianNBClassifier)
+
+
+def classify(data, classifier):
+    '''
+    This function returns the predicted class labels of the rows in data, and
+    the probabilities of the second class if the classifier provides them,
+    its decision values otherwise.
+    '''
+
+    # prediction class labels on data set
+    pred = classifier.predict(data)
+
+    # and predict probabilities (if possible)
+    if(hasattr(classifier, 'predict_proba')):
+        proba = classifier.predict_proba(data)
+        # get the probabilities of class one
+        # TODO this only works for 2-class problems...
+        proba = proba[:, 1]
+    elif(hasattr(classifier, 'decision_function')):
+        proba = classifier.decision_function(data)
+    else:
+        proba = pred
+
+    return (pred, proba)
+
+
+def save_predictor(f, classifier, scaler):
+    '''
+    This function stores the compiled classifier and scaler in numpy file f.
+    '''
+
+    param = {'scale': scaler.scale, 'offset': scaler.offset,
+             'classes': classifier.classes_}
+
+    if(isinstance(classifier, LinearClassifier)):
+        param['kind'] = LINEAR
+        param['coef'] = classifier.coef
+        param['intercept'] = classifier.intercept
+        param['pos_class_i'] = classifier.pos_class_i
+        if(isinstance(classifier, ProbabilisticLinearClassifier)):
+            param['sigmoid'] = classifier.sigmoid
+            param['coupling'] = classifier.coupling
+    elif(isinstance(classifier, CentroidClassifier)):
+        param['kind'] = CENTROID
+        param['centroids'] = classifier.centroids
+    elif(isinstance(classifier, GaussianNBClassifier)):
+        param['kind'] = GAUSSIAN_NB
+        param['theta'] = classifier.theta
+        param['sigma'] = classifier.sigma
+        param['class_prior'] = classifier.class_prior
+    else:
+        raise ValueError('Unknown compiled classifier.')
+
+    with open(f, 'wb') as fout:
+        numpy.savez(fout, **param)
+
+
+def load_predictor(f):
+    '''
+    This function loads the (classifier, scaler) stored in numpy file f.
+
+    Raises:
+        ValueError: If the file contains an unknown classifier type.
+    '''
+
+    npz = numpy.load(f)
+    try:
+        param = dict([(key, npz[key]) for key in npz.files])
+    finally:
+        npz.close()
+
+    kind = str(param['kind'])
+    classes = param['classes']
+
+    if(kind == LINEAR):
+        if('sigmoid' in param):
+            classifier = ProbabilisticLinearClassifier(
+                classes, param['coef'], param['intercept'],
+                param['pos_class_i'], param['sigmoid'],
+                param['coupling'])
+        else:
+            classifier = LinearClassifier(classes, param['coef'],
+                                          param['intercept'],
+                                          param['pos_class_i'])
+    elif(kind == CENTROID):
+        classifier = CentroidClassifier(classes, param['centroids'])
+    elif(kind == GAUSSIAN_NB):
+        classifier = GaussianNBClassifier(classes, param['theta'],
+                                          param['sigma'],
+                                          param['class_prior'])
+    else:
+        raise ValueError('Unknown compiled classifier: %s' % (kind))
+
+    return (classifier, Scaler(param['scale'], param['offset']))
+
+
+def _dense(data):
+    if(sparse.issparse(data)):
+        data = data.toarray()
+    return numpy.asarray(data, dtype=float)
+
+
+def _softmax(values):
+    values = numpy.exp(values - values.max(axis=1)[:, numpy.newaxis])
+    return values / values.sum(axis=1)[:, numpy.newaxis]
+
+
+def _libsvm_coupling(proba, min_proba=1e-7, max_iter=100):
+    '''
+    Two-class version of the iterative pairwise coupling of libsvm
+    (multiclass_probability), which stops as soon as the error is below its
+    tolerance and therefore slightly changes the sigmoid probabilities.
+    '''
+
+    r = numpy.clip(proba, min_proba, 1.0 - min_proba)
+
+    # Q matrix of libsvm for the pairwise probabilities r and 1 - r
+    q_diag = [r ** 2, (1.0 - r) ** 2]
+    q_off = -r * (1.0 - r)
+    p = [numpy.empty(len(r)), numpy.empty(len(r))]
+    p[0].fill(0.5)
+    p[1].fill(0.5)
+    eps = 0.005 / 2
+
+    active = numpy.ones(len(r), dtype=bool)
+    for iteration in xrange(max_iter):
+
+        qp = [q_diag[0] * p[0] + q_off * p[1], q_off * p[0] + q_diag[1] * p[1]]
+        pqp = p[0] * qp[0] + p[1] * qp[1]
+        max_error = numpy.maximum(numpy.abs(qp[0] - pqp),
+                                  numpy.abs(qp[1] - pqp))
+        active &= max_error >= eps
+        if not(active.any()):
+            break
+
+        for t in xrange(2):
+            diff = numpy.where(active, (pqp - qp[t]) / q_diag[t], 0.0)
+            p[t] = p[t] + diff
+            pqp = ((pqp + diff * (diff * q_diag[t] + 2.0 * qp[t])) /
+                   (1.0 + diff) ** 2)
+            q_t = [q_diag[0], q_off] if t == 0 else [q_off, q_diag[1]]
+            for j in xrange(2):
+                qp[j] = (qp[j] + diff * q_t[j]) / (1.0 + diff)
+                p[j] = p[j] / (1.0 + diff)
+
+    return p[1]
@@ -17,7 +17,8 @@ from biopy import file_io
 
 class ProjectManager(object):
 
-    TIMEOUT = 20  # sec
+    CV_CACHE_D = 'cv_cache'
+    CV_CACHE_SIZE = 256  # MB
 
     def __init__(self, root_dir, ref_data_dir):
         self.root_dir = root_dir
@@ -321,6 +322,28 @@ class ProjectManager(object):
                 error += line
         return error
 
+    def get_classifier_eta(self, cl_id):
+        '''
+        This function returns the estimated remaining runtime (seconds) of
+        classification job cl_id, the full estimate if the job did not start
+        yet, or None if no estimate is available (not yet, or the estimate
+        failed, see JobQueueManager.run_estimates).
+        '''
+
+        f = os.path.join(self.cl_dir, cl_id, 'runtime_estimate.txt')
+        if not(os.path.exists(f)):
+            return None
+
+        # estimated runtime, and start time once the job is started
+        with open(f, 'r') as fin:
+            values = [int(v) for v in fin.read().split()]
+
+        if(len(values) == 0):
+            return None
+        elif(len(values) < 2):
+            return values[0]
+        return max(0, values[0] - (int(time.time()) - values[1]))
+
     def get_classifier_finished(self, cl_id):
         cl_d = self.get_cl_dir(cl_id)
         if(cl_d):
@@ -738,11 +761,9 @@ class ProjectManager(object):
             return 'The number of rows in the feature matrix does not ' +\
                    'correspond to the number of proteins in this project.'
 
-        # reorder feature matrix rows
-        featmat = featmat[fm.object_indices(object_ids)]
-
         try:
-            fm.add_custom_features(featmat)
+            # rows are reordered to the object order of the feature matrix
+            fm.add_custom_features(featmat, object_ids)
         except ValueError as e:
             return str(e)
         except Exception as e:
@@ -826,7 +847,8 @@ class ProjectManager(object):
             '--classes %s' % (' '.join(class_ids)),
             '--features %s' % (' '.join(feat_ids.split(','))),
             '--standardize',
-            '--timeout %i' % (self.TIMEOUT),
+            '--cache_dir %s' % (os.path.join(self.user_dir, self.CV_CACHE_D)),
+            '--cache_size %i' % (self.CV_CACHE_SIZE),
             '-o %s' % (out_dir)]
 
         # create command
@@ -847,43 +869,57 @@ class ProjectManager(object):
         settings_dict = self.get_classifier_settings(cl_id)
         feature_ids = settings_dict['feature_names']
 
-        feature_cats = set()
-        for f in feature_ids:
-            fparts = f.split('_')
-            if(len(fparts) < 3):
-                feature_cats.add('_'.join(fparts[:1]))
-            else:
-                feature_cats.add('_'.join(fparts[:2]))
+        feature_cats = set(
+            featext.FeatureExtraction.protein_featcat_ids(feature_ids))
 
         # path to trained classifier file
         classifier_f = self.get_classifier_f
 
+        # the classify job can calculate sequence-based features itself,
+        # if the scaler of the classifier training data is available
+        cl_d = self.get_cl_dir(cl_id)
+        fused = (featext.FeatureExtraction.sequence_based(feature_cats) and
+                 os.path.exists(os.path.join(cl_d, 'scaler.joblib.pkl')))
+
         # SWITCH TO OTHER PROJECT FOR FEATURE CALCULATION
         prev_proj = self.project_id
         self.set_project(project_id)
 
-        # load feature extraction and obtain calculated feature categories
-        fe = self.get_feature_extraction()
-        calculated_feature_cats = fe.available_protein_featcat_ids()
+        # protein sequences of the other project
+        fasta_f = os.path.join(self.fe_dir, 'protein_data_set', 'protein.fsa')
+
+        if(fused and os.path.exists(fasta_f)):
 
-        # determine missing feature categories
-        missing_feature_cats = sorted(feature_cats - calculated_feature_cats)
+            # classify the sequences directly, without feature matrix
+            input_options = ['--fasta %s' % (fasta_f),
+                             '--name %s' % (project_id)]
 
-        # queue feature calculation job if neccesary
-        if(len(missing_feature_cats) > 0):
-            self.run_feature_extraction(missing_feature_cats)
+        else:
+
+            # load feature extraction and obtain calculated feature categories
+            fe = self.get_feature_extraction()
+            calculated_feature_cats = fe.available_protein_featcat_ids()
+
+            # determine missing feature categories
+            missing_feature_cats = sorted(feature_cats -
+                                          calculated_feature_cats)
 
-        # sleep for a second, to make sure feat calc job is first in queue
-        time.sleep(2)
+            # queue feature calculation job if neccesary
+            if(len(missing_feature_cats) > 0):
+                self.run_feature_extraction(missing_feature_cats)
 
-        # store path to feature matrix dir
-        fm_dir = self.fm_dir
+                # sleep for a second, to make sure feat calc job is first in
+                # queue
+                time.sleep(2)
+
+            # store path to feature matrix dir
+            input_options = ['-f %s' % (self.fm_dir)]
 
         # SWITCH BACK TO ORIGINAL PROJECT
         self.set_project(prev_proj)
 
         # output dir
-        out_d = os.path.join(self.get_cl_dir(cl_id), 'class_output')
+        out_d = os.path.join(cl_d, 'class_output')
         if not(os.path.exists(out_d)):
             os.mkdir(out_d)
 
@@ -892,10 +928,7 @@ class ProjectManager(object):
         error_f = os.path.join(out_d, 'error.txt')
 
         # create the list of options for the classification command
-        options = [
-            '-f %s' % (fm_dir),
-            '-c %s' % (self.get_cl_dir(cl_id))
-        ]
+        options = input_options + ['-c %s' % (cl_d)]
 
         # create command
         cmd = 'classify %s' % (' '.join(options))
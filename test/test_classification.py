@@ -0,0 +1,166 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from sklearn import preprocessing
+
+from spice import classification
+from spice import predictor
+
+
+class TestDistanceCache(unittest.TestCase):
+    '''
+    Feature selection of distance based classifiers on the cached distance
+    matrix (see score_feature_subsets) selects the same features and
+    parameters as without the cache.
+    '''
+
+    def setUp(self):
+        rng = numpy.random.RandomState(1)
+        self.data = rng.randn(90, 5)
+        self.target = rng.randint(0, 2, 90)
+        self.data[self.target == 1, :2] += 1.0
+        self.max_entries = classification.DISTANCE_CACHE_MAX_ENTRIES
+
+    def tearDown(self):
+        classification.DISTANCE_CACHE_MAX_ENTRIES = self.max_entries
+
+    def _selections(self, func, classifier_str, param, **kwargs):
+        selections = []
+        for max_entries in [self.max_entries, 0]:
+            classification.DISTANCE_CACHE_MAX_ENTRIES = max_entries
+            result = func(self.data, self.target,
+                          classification.get_classifier(classifier_str), 3,
+                          'roc_auc', param=param, **kwargs)
+            # cv parameters and selected features per cv loop
+            selections.append((result[1], result[5]))
+        return selections
+
+    def test_ffs_svc_rbf(self):
+        (cached, uncached) = self._selections(
+            classification.ffs, 'svc_rbf', {'C': [0.1, 10], 'gamma': [0.1, 1]},
+            max_features=2)
+        self.assertEqual(cached, uncached)
+
+    def test_bfs_svc_rbf(self):
+        (cached, uncached) = self._selections(
+            classification.bfs, 'svc_rbf', {'C': [0.1, 10], 'gamma': [0.1, 1]})
+        self.assertEqual(cached, uncached)
+
+    def test_ffs_neighbors(self):
+        (cached, uncached) = self._selections(
+            classification.ffs, 'kn_uniform', {'n_neighbors': [3, 5]},
+            max_features=3)
+        self.assertEqual(cached, uncached)
+
+    def test_bfs_neighbors(self):
+        (cached, uncached) = self._selections(
+            classification.bfs, 'kn_distance', {'n_neighbors': [3, 5]})
+        self.assertEqual(cached, uncached)
+
+
+class TestResultCache(unittest.TestCase):
+    '''
+    The result cache returns stored results, and removes the least recently
+    used results once it exceeds its maximal size.
+    '''
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def _set_used(self, key, t):
+        f = os.path.join(self.d, key)
+        os.utime(f, (t, t))
+
+    def test_hit(self):
+        cache = classification.ResultCache(self.d)
+        key = classification.cache_key(numpy.arange(5), {'C': [1, 10]})
+        self.assertEqual(cache.get(key), None)
+        cache.put(key, (0.5, {'C': 1}))
+        self.assertEqual(cache.get(key), (0.5, {'C': 1}))
+        # shared with other processes through the cache directory
+        self.assertEqual(classification.ResultCache(self.d).get(key),
+                         (0.5, {'C': 1}))
+
+    def test_key(self):
+        data = numpy.arange(6.0).reshape(3, 2)
+        key = classification.cache_key(data, {'C': [1, 10]})
+        self.assertEqual(key, classification.cache_key(data.copy(),
+                                                       {'C': [1, 10]}))
+        self.assertNotEqual(key, classification.cache_key(data,
+                                                          {'C': [1, 100]}))
+        self.assertNotEqual(key, classification.cache_key(data + 1,
+                                                          {'C': [1, 10]}))
+
+    def test_eviction(self):
+        value = 'x' * 1000
+        cache = classification.ResultCache(self.d)
+        cache.put('a', value)
+        size = os.path.getsize(os.path.join(self.d, 'a'))
+        cache = classification.ResultCache(self.d, max_size=3.5 * size)
+        cache.put('b', value)
+        cache.put('c', value)
+        self._set_used('a', 100)
+        self._set_used('b', 200)
+        self._set_used('c', 300)
+        # a is used, b is the least recently used result
+        self.assertEqual(cache.get('a'), value)
+        cache.put('d', value)
+        self.assertEqual(sorted(os.listdir(self.d)), ['a', 'c', 'd'])
+
+
+class TestExportPredictor(unittest.TestCase):
+    '''
+    The exported predictor gives the predictions and probabilities of the
+    sklearn classifier and scaler.
+    '''
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.f = os.path.join(self.d, 'predictor.npz')
+        rng = numpy.random.RandomState(3)
+        self.data = rng.randn(80, 4) * [1.0, 10.0, 0.1, 1.0] + 5.0
+        self.target = rng.randint(0, 2, 80)
+        self.data[self.target == 1, :2] += 2.0
+        self.tst_data = rng.randn(40, 4) * [1.0, 10.0, 0.1, 1.0] + 6.0
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def _export(self, classifier_str):
+        cl = classification.get_classifier(classifier_str)
+        scaler = preprocessing.StandardScaler().fit(self.data)
+        cl.fit(scaler.transform(self.data), self.target)
+        return (cl, scaler, classification.export_predictor(
+            cl, scaler, self.data, self.f))
+
+    def test_supported(self):
+        for classifier_str in ['linearsvc', 'svc_linear', 'lda', 'nc',
+                               'gnb']:
+            (cl, scaler, exported) = self._export(classifier_str)
+            self.assertTrue(exported, classifier_str)
+            (compiled, compiled_scaler) = predictor.load_predictor(self.f)
+            (ref_pred, ref_proba) = classification.classify(
+                scaler.transform(self.tst_data), cl)
+            (pred, proba) = classification.classify(
+                compiled_scaler.transform(self.tst_data), compiled)
+            self.assertTrue(numpy.array_equal(pred, ref_pred),
+                            classifier_str)
+            self.assertTrue(numpy.allclose(proba, ref_proba, rtol=1e-4,
+                                           atol=1e-6), classifier_str)
+
+    def test_unsupported(self):
+        self._export('lda')
+        self.assertTrue(os.path.exists(self.f))
+        (cl, scaler, exported) = self._export('svc_rbf')
+        self.assertFalse(exported)
+        self.assertFalse(os.path.exists(self.f))
+
+
+if __name__ == '__main__':
+    unittest.main()
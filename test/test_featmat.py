@@ -0,0 +1,131 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from scipy import sparse
+from scipy import stats
+
+from spice import featmat
+
+
+class TestSaveLoad(unittest.TestCase):
+    '''
+    A feature matrix with dense, integer, and sparse column blocks is loaded
+    from its journaled directory as it was saved, also after features are
+    added and removed between saves.
+    '''
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        rng = numpy.random.RandomState(1)
+        self.fm = featmat.FeatureMatrix()
+        self.fm.object_ids = ['o%i' % (i) for i in xrange(20)]
+        self.fm.add_labeling('lab', dict(zip(self.fm.object_ids,
+                                             [0] * 12 + [1] * 8)),
+                             ['neg', 'pos'])
+        self.fm.add_features(['d0', 'd1', 'd2'], rng.randn(20, 3),
+                             feature_names=['dense 0', 'dense 1', 'dense 2'])
+        self.fm.add_features(['i0', 'i1'], rng.randint(-5, 5, (20, 2)),
+                             dtype=numpy.int8)
+        self.fm.add_features(['s0', 's1', 's2', 's3'], sparse.rand(
+            20, 4, density=0.2, format='csr', random_state=rng))
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def assertSameMatrix(self, fm, loaded):
+        self.assertEqual(loaded.object_ids, fm.object_ids)
+        self.assertEqual(loaded.feature_ids, fm.feature_ids)
+        self.assertEqual(loaded.feature_names, fm.feature_names)
+        self.assertEqual([b.dtype for b in loaded.feature_blocks],
+                         [b.dtype for b in fm.feature_blocks])
+        self.assertEqual([sparse.issparse(b) for b in loaded.feature_blocks],
+                         [sparse.issparse(b) for b in fm.feature_blocks])
+        self.assertTrue(numpy.array_equal(loaded.feature_matrix,
+                                          fm.feature_matrix))
+        self.assertEqual(sorted(loaded.labeling_dict.keys()),
+                         sorted(fm.labeling_dict.keys()))
+        self.assertTrue(numpy.array_equal(loaded.labeling_dict['lab'].labels,
+                                          fm.labeling_dict['lab'].labels))
+
+    def test_round_trip(self):
+        self.fm.save_to_dir(self.d)
+        loaded = featmat.FeatureMatrix.load_from_dir(self.d)
+        self.assertEqual([str(b.dtype) for b in loaded.feature_blocks],
+                         ['float32', 'int8', 'float32'])
+        self.assertSameMatrix(self.fm, loaded)
+
+    def test_journal(self):
+        self.fm.save_to_dir(self.d)
+        loaded = featmat.FeatureMatrix.load_from_dir(self.d)
+        loaded.add_features(['d3'], numpy.arange(20.0).reshape(20, 1))
+        loaded.remove_features(['i1', 's2'])
+        loaded.save_to_dir(self.d)
+        self.assertSameMatrix(loaded,
+                              featmat.FeatureMatrix.load_from_dir(self.d))
+
+    def test_compact(self):
+        self.fm.add_features(['d3'], numpy.arange(20.0).reshape(20, 1))
+        self.fm.save_to_dir(self.d)
+        self.fm.save_to_dir(self.d, compact=True)
+        loaded = featmat.FeatureMatrix.load_from_dir(self.d)
+        self.assertSameMatrix(self.fm, loaded)
+
+
+class TestStatisticalTests(unittest.TestCase):
+    '''
+    The chunked two group and one versus rest tests give the statistics and
+    p-values of scipy.stats.
+    '''
+
+    def setUp(self):
+        rng = numpy.random.RandomState(2)
+        self.data = rng.randn(30, 7)
+        self.data[:, 3] = rng.randint(0, 3, 30)
+        self.labels = numpy.array([0] * 10 + [1] * 8 + [2] * 12)
+        self.data[self.labels == 1] += 0.8
+        self.fm = featmat.FeatureMatrix(dtype=numpy.float64)
+        self.fm.object_ids = ['o%i' % (i) for i in xrange(30)]
+        self.fm.add_labeling('lab', dict(zip(self.fm.object_ids,
+                                             self.labels)),
+                             ['a', 'b', 'c'])
+        self.fm.add_features(['f%i' % (i) for i in xrange(7)], self.data)
+
+    def _scipy_test(self, test, x1, x0):
+        if(test == 'mannwhitney'):
+            (u, p) = stats.mannwhitneyu(x1, x0, use_continuity=False)
+            return (u, 2.0 * p)
+        return stats.ttest_ind(x1, x0, equal_var=(test == 'ttest'))
+
+    def _assert_test(self, test, result, x1, x0):
+        for col, (stat, p) in enumerate(result):
+            (ref_stat, ref_p) = self._scipy_test(test, x1[:, col],
+                                                 x0[:, col])
+            # scipy returns the smaller of the two U statistics
+            if(test == 'mannwhitney'):
+                stat = min(stat, len(x1) * len(x0) - stat)
+            self.assertAlmostEqual(stat, ref_stat)
+            self.assertAlmostEqual(p, ref_p)
+
+    def test_two_groups(self):
+        for test in featmat.FeatureMatrix.STAT_TESTS:
+            result = self.fm.ttest('lab', 'a', 'b', test=test, chunk_size=3)
+            self._assert_test(test, result, self.data[self.labels == 1],
+                              self.data[self.labels == 0])
+
+    def test_one_vs_rest(self):
+        for test in featmat.FeatureMatrix.STAT_TESTS:
+            result = self.fm.one_vs_rest_test('lab', test=test, chunk_size=3)
+            for label, c in enumerate(['a', 'b', 'c']):
+                self._assert_test(test, result[c],
+                                  self.data[self.labels == label],
+                                  self.data[self.labels != label])
+
+    def test_non_existing_test(self):
+        self.assertRaises(ValueError, self.fm.ttest, 'lab', 'a', 'b',
+                          test='ztest')
+
+
+if __name__ == '__main__':
+    unittest.main()
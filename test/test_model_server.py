@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from spice.job_runner import model_server
+from spice.project_management import ProjectManager
+
+
+class TestValidId(unittest.TestCase):
+    '''
+    Only the names of existing directories in the given directory are valid
+    ids, paths that could lead out of the directory are rejected.
+    '''
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.d, 'u1'))
+        os.mkdir(os.path.join(self.d, 'u1', 'p1'))
+        with open(os.path.join(self.d, 'file'), 'w') as fout:
+            fout.write('\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def test_existing_dir(self):
+        self.assertTrue(model_server._valid_id(self.d, 'u1'))
+        self.assertTrue(model_server._valid_id(self.d, u'u1'))
+
+    def test_rejected(self):
+        for name in ['', None, 1, ['u1'], 'missing', 'file', '.', '..',
+                     '../u1', 'u1/..', 'u1/p1', '/tmp', 'u1\0',
+                     os.path.join(self.d, 'u1')]:
+            self.assertFalse(model_server._valid_id(self.d, name),
+                             repr(name))
+
+    def test_predict_rejects_paths(self):
+        server = model_server.ModelServer(
+            os.path.join(self.d, 'pid'), self.d,
+            os.path.join(self.d, 'socket'))
+        pm = ProjectManager(self.d, None)
+        pm.set_user('u1')
+        pm.set_project('p1')
+        if not(os.path.exists(pm.cl_dir)):
+            os.makedirs(pm.cl_dir)
+
+        requests = [
+            ({'user_id': '..', 'project_id': 'p1', 'classifier_id': 'c'},
+             'Unknown user.'),
+            ({'user_id': 'u1', 'project_id': '../u1', 'classifier_id': 'c'},
+             'Unknown project.'),
+            ({'user_id': 'u1', 'project_id': 'p1',
+              'classifier_id': '../../../u1'},
+             'Classifier not available.')]
+        for request, error in requests:
+            self.assertEqual(server.predict(request), {'error': error})
+
+
+if __name__ == '__main__':
+    unittest.main()